@@ -42,6 +42,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'main.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -137,4 +138,94 @@ TOTAL = 50
 
 # 要改
 LABEL_STUDIO_TOKEN = ""
-MY_UID = 102090  # /user/account/membership-info 可以查看
\ No newline at end of file
+MY_UID = 102090  # /user/account/membership-info 可以查看
+
+# access token 快取：填 cache alias（例如 "default"）讓多個 worker 共用，None 只存在行程內
+LABEL_STUDIO_TOKEN_CACHE = None
+# token 到期前幾秒就先 refresh
+LABEL_STUDIO_TOKEN_REFRESH_MARGIN = 60
+
+# 上游 HTTP：(connect, read) timeout 秒數與 429/5xx 重試次數
+LABEL_STUDIO_TIMEOUT = (5, 30)
+LABEL_STUDIO_MAX_RETRIES = 3
+
+# 用 ASGI 部署時設為 True，index / table / edit 改走 async views（需要 httpx）
+LABEL_STUDIO_ASYNC_VIEWS = False
+# async views 同時打上游的上限
+LABEL_STUDIO_ASYNC_CONCURRENCY = 32
+
+# ---- 下面幾個會改變寫入 / 發題行為的功能預設都關著，現有的 deployment 照舊直接讀寫 Label Studio ----
+# 要用時：
+#   1. python manage.py migrate（鏡像、outbox、租約都存在本地 DB）
+#   2. 把想要的開關改成 True（OUTBOX 要連 MIRROR 一起開；PROPAGATION 改成 "prefill" 或 "submit"）
+#   3. 重開所有 worker（這些開關在啟動時讀）
+
+# index / table 改讀本地 task 鏡像，上游只用來寫入與背景同步
+LABEL_STUDIO_MIRROR = False
+# 鏡像超過幾秒沒同步就在背景補抓
+LABEL_STUDIO_SYNC_INTERVAL = 30
+
+# 不用鏡像也不用租約時，在背景預抓下一批；buffer 存活秒數
+LABEL_STUDIO_PREFETCH = False
+LABEL_STUDIO_PREFETCH_TTL = 120
+
+# index POST 先寫進本地 outbox 就回應，背景再送上游（寫入變成非同步；需搭配 LABEL_STUDIO_MIRROR）
+LABEL_STUDIO_OUTBOX = False
+LABEL_STUDIO_OUTBOX_MAX_ATTEMPTS = 8
+# 修改碰到正在送出的項目：最多等它們送完幾秒，再照一般修改 PATCH（批次修改整批共用這個期限）
+LABEL_STUDIO_OUTBOX_AMEND_WAIT = 30
+
+# 每位標註者各自租一段 inner_id 區間（多人 / 多 worker 同時標註）；租約存活秒數
+# 打開後 index POST 只收自己租約裡的 task，租約過期回 409
+LABEL_STUDIO_LEASES = False
+LABEL_STUDIO_LEASE_TTL = 1800
+
+# table 歷史頁快取：最多幾頁、幾秒後過期
+LABEL_STUDIO_HISTORY_CACHE_PAGES = 64
+LABEL_STUDIO_HISTORY_CACHE_TTL = 300
+
+# 商品圖縮圖代理的磁碟快取位置與大小上限（bytes）；縮圖需要 Pillow，沒裝就回原圖
+LABEL_STUDIO_IMAGE_CACHE_DIR = BASE_DIR / "image_cache"
+LABEL_STUDIO_IMAGE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# 上游呼叫與 view 的延遲直方圖（GET /metrics，Prometheus 文字格式）與 Server-Timing header
+LABEL_STUDIO_METRICS = True
+
+# 打上游的流量控制（全 process 共用）：每秒請求數與 burst（0 = 不限）、AIMD 並行數的上下限；
+# LABEL_STUDIO_MAX_WORKERS 是起始並行數，延遲超過基準 LATENCY_TOLERANCE 倍就降
+LABEL_STUDIO_RATE_LIMIT = 50
+LABEL_STUDIO_RATE_BURST = 100
+LABEL_STUDIO_CONCURRENCY_MIN = 2
+LABEL_STUDIO_CONCURRENCY_MAX = 32
+LABEL_STUDIO_LATENCY_TOLERANCE = 2.0
+
+# 上游慢或掛掉時：手上有舊資料就最多等幾秒、過期多久內先回舊的再背景重抓（秒）
+LABEL_STUDIO_STALE_WAIT = 3
+LABEL_STUDIO_STALE_WINDOW = 300
+# 斷路器：連續幾次連線錯誤 / 5xx 就斷開、斷開後冷卻幾秒再放探測請求
+LABEL_STUDIO_BREAKER_FAILURES = 5
+LABEL_STUDIO_BREAKER_COOLDOWN = 30
+
+# index GET 先回空殼，卡片由前端打 /api/batch/（精簡 JSON、ETag、gzip / br）分段畫；
+# 回應小於 COMPRESS_MIN_BYTES 不壓縮
+# 關著時 index 照舊在伺服器端把卡片畫好
+LABEL_STUDIO_INDEX_SHELL = False
+LABEL_STUDIO_COMPRESS_MIN_BYTES = 1024
+# 專案計數（已標註數）快取幾秒；自己送出成功會直接在本地更新
+LABEL_STUDIO_COUNTERS_TTL = 10
+# 同一個 deployment 服務的其他專案（掛在 /p/<project_id>/）；每個專案各自的 token、連線池、並行上限、
+# 斷路器與快取，沒寫的欄位沿用上面的全域設定，例如：
+# {15: {"total": 20}, 27: {"url": "https://ls.example.com", "token": "<PAT>", "concurrency_max": 8}}
+LABEL_STUDIO_PROJECTS = {}
+
+# index POST 把同一個 (rating, relation) 的 task 合成一個 /api/annotations/bulk/，不再一筆一個 POST；
+# 上游回 404 / 405 就自動退回一筆一個（LABEL_STUDIO_PROJECTS 可用 "bulk_writes" 逐專案覆寫）
+LABEL_STUDIO_BULK_WRITES = False
+
+# 已標過的 (query, item) 組合：off / prefill（index 預填，衝突的標出來）/ submit（完全相同且沒衝突的直接送出）
+LABEL_STUDIO_PROPAGATION = "off"
+# 裝了 NumPy 時，正規化文字的 trigram cosine 相似度到這個門檻也預填（0 表示只比完全相同）
+LABEL_STUDIO_PROPAGATION_SIMILARITY = 0.92
+
+# /api/stats/ 的計數最多每幾秒在背景跟本地鏡像對一次帳（先增量同步鏡像，不一樣就以鏡像為準重建）
+LABEL_STUDIO_STATS_RECONCILE = 300
@@ -1,10 +1,32 @@
+from django.conf import settings
 from django.contrib import admin
-from django.urls import path
-from main import views
+from django.urls import include, path
+from main import images, metrics, views
+
+# 用 ASGI（uvicorn / daphne）部署時打開 LABEL_STUDIO_ASYNC_VIEWS，改用 async 版本
+if getattr(settings, "LABEL_STUDIO_ASYNC_VIEWS", False):
+    from main import async_views as page_views
+else:
+    page_views = views
+
+# 專案範圍的頁面：掛在根目錄的是預設專案（PROJECT_ID），/p/<project_id>/ 底下是 LABEL_STUDIO_PROJECTS 裡的專案
+project_patterns = [
+    path('edit/', page_views.edit_task, name='edit_task'),
+    path('edit/bulk/', page_views.edit_bulk, name='edit_bulk'),
+    path("", page_views.index, name="index"),
+    path("table/", page_views.table, name="table"),
+    path("history/", page_views.history, name="history"),
+    path("api/batch/", page_views.batch_api, name="batch_api"),
+    path("api/history/", page_views.history_api, name="history_api"),
+    path("export/", views.export_labels, name="export_labels"),
+    path("api/stats/", views.stats_api, name="stats_api"),
+]
 
 urlpatterns = [
-    path('edit/', views.edit_task, name='edit_task'),
     path('admin/', admin.site.urls),
-    path("", views.index, name="index"),
-    path("table/", views.table, name="table"),
+    *project_patterns,
+    path("p/<int:project_id>/", include((project_patterns, "project"))),
+    path("outbox/", views.outbox_status, name="outbox_status"),
+    path("metrics", metrics.metrics_view, name="metrics"),
+    path("img/<str:size>/<str:token>/", images.serve, name="image_proxy"),
 ]
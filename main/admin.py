@@ -1,3 +1,20 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import Annotation, SyncState, Task
+
+
+@admin.register(Task)
+class TaskAdmin(admin.ModelAdmin):
+    list_display = ("task_id", "inner_id", "query", "rating", "relation", "updated_at")
+    list_filter = ("project_id", "rating", "relation")
+    search_fields = ("query", "it_name")
+
+
+@admin.register(Annotation)
+class AnnotationAdmin(admin.ModelAdmin):
+    list_display = ("annotation_id", "task_id", "rating", "relation", "updated_at")
+
+
+@admin.register(SyncState)
+class SyncStateAdmin(admin.ModelAdmin):
+    list_display = ("project_id", "max_inner_id", "last_updated_at", "last_synced")
@@ -0,0 +1,70 @@
+"""task_id → 最新 annotation_id 的本地索引
+
+edit_task 原本每次都要先打上游查 annotation id（最多兩個循序 GET）才能 PATCH。
+這裡把已知的對應存在 Annotation 表：自己寫入成功的回應、table 抓下來的 task
+資料都順手記一筆；edit 時先查索引直接 PATCH，查不到或上游回 404 才退回舊的查法。
+不同專案可能在不同的 Label Studio 上，task / annotation id 都要連同 project_id 一起比對。
+"""
+import logging
+
+from .models import Annotation
+
+logger = logging.getLogger(__name__)
+
+
+def lookup(project_id: int, task_id: int):
+    """最新（id 最大）的 annotation id；沒有就 None"""
+    return Annotation.objects.filter(project_id=project_id, task_id=int(task_id)) \
+        .order_by("-annotation_id").values_list("annotation_id", flat=True).first()
+
+
+def lookup_many(project_id: int, task_ids):
+    """{task_id: 最新 annotation id}；沒有索引的 task 不會出現在結果裡"""
+    out = {}
+    rows = Annotation.objects.filter(project_id=project_id, task_id__in=[int(t) for t in task_ids]) \
+        .order_by("task_id", "annotation_id").values_list("task_id", "annotation_id")
+    for task_id, annotation_id in rows:
+        out[task_id] = annotation_id
+    return out
+
+
+def remember(project_id: int, task_id: int, annotation_id, rating=None, relation=None, updated_at: str = ""):
+    if not annotation_id:
+        return
+    Annotation.objects.update_or_create(
+        project_id=project_id, annotation_id=int(annotation_id),
+        defaults={
+            "task_id": int(task_id),
+            "rating": None if rating is None else str(rating),
+            "relation": None if relation is None else str(relation).upper(),
+            "updated_at": updated_at or "",
+        },
+    )
+
+
+def forget(project_id: int, annotation_id):
+    """上游已經沒有這筆（404）：從索引拿掉"""
+    Annotation.objects.filter(project_id=project_id, annotation_id=int(annotation_id)).delete()
+
+
+def remember_tasks(project_id: int, tasks):
+    """table / 同步抓到的一頁 task（[TaskRow, ...]）：把各自最新的 annotation id 記下來"""
+    rows = [
+        Annotation(
+            project_id=project_id, annotation_id=task.annotation_id, task_id=task.task_id,
+            rating=task.rating, relation=task.relation, updated_at=task.updated_at,
+        )
+        for task in tasks if task.annotation_id
+    ]
+    if not rows:
+        return
+    try:
+        Annotation.objects.bulk_create(
+            rows,
+            update_conflicts=True,
+            unique_fields=["project_id", "annotation_id"],
+            update_fields=["task_id", "rating", "relation", "updated_at"],
+        )
+    except Exception:
+        # 只是加速用的索引，寫不進去不影響頁面
+        logger.exception("failed to index annotations for %d tasks", len(rows))
@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class MainConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'main'
+
+    def ready(self):
+        from . import outbox, views
+
+        # 開了 outbox 就在啟動時把 flusher 叫起來，重啟前沒送完的項目才會接著送
+        if views.OUTBOX:
+            outbox.flusher.autostart()
@@ -0,0 +1,539 @@
+"""ASGI 用的 async 版 index / table / edit_task
+
+邏輯與 views.py 相同（共用同一組驗證與組 payload 的函式），只是上游呼叫改走
+AsyncLabelStudioClient：一個 worker 可以同時服務很多標註者，batch 寫入也不再
+每個 request 開一個 thread pool。WSGI 部署繼續用 views.py 的同步版本。
+"""
+import asyncio
+import json
+
+import httpx
+from asgiref.sync import sync_to_async
+from django.http import HttpResponseBadRequest, JsonResponse
+from django.shortcuts import render
+from django.views.decorators.csrf import csrf_exempt
+
+from . import annotation_index, breaker, compact, counters, fanin, leases, metrics, outbox, projects, views
+from .rows import parse_tasks
+from .views import FETCH_NUM
+
+
+async def try_token(project):
+    """views.try_access_token 的 async 版"""
+    try:
+        return await project.async_client().token()
+    except Exception:
+        return None
+
+
+def error_response(e: Exception, project=None):
+    if isinstance(e, httpx.TransportError):
+        return views.upstream_unavailable_response(e, project)
+    return views.api_error_response(e, project)
+
+
+async def get_unlabeled_task(project, token: str, inner_id: int, page):
+    r = await project.async_client().get("tasks/", token,
+                                         params=views.build_task_query(project.project_id, inner_id, page))
+    r.raise_for_status()
+    return parse_tasks(r.content)
+
+
+async def get_next_task(project, access_token):
+    with metrics.phase("cursor"):
+        r = await project.async_client().post("dm/actions/", access_token,
+                                              params={"id": "next_task", "project": project.project_id},
+                                              json={"project": project.project_id})
+    r.raise_for_status()
+    return r.json()["inner_id"]
+
+
+async def get_project(project, access_token):
+    async def load():
+        with metrics.phase("counters"):
+            r = await project.async_client().get(f"projects/{project.project_id}", access_token)
+        r.raise_for_status()
+        return r.json()
+    return await counters.project_counters.aget(project.project_id, load)
+
+
+def cursor_steps(project, access_token):
+    """views.cursor_steps 的 async 版"""
+    return {
+        "next_task": ((), lambda: get_next_task(project, access_token)),
+        "counters": ((), lambda: get_project(project, access_token)),
+    }
+
+
+async def get_views_id(project, access_token):
+    out = await fanin.aresolve(cursor_steps(project, access_token), ("next_task", "counters"))
+    return out["next_task"], out["counters"]["num_tasks_with_annotations"]
+
+
+async def post_annotation(project, access, task_id, rating="0", relation="I"):
+    task_id, rating, relation, err = views.validate_annotation(task_id, rating, relation)
+    if err:
+        return False, err
+
+    payload = views.build_annotation_payload(rating, relation)
+    try:
+        r = await project.async_client().post(f"tasks/{task_id}/annotations/", access, json=payload)
+        if r.status_code not in (200, 201):
+            return False, f"annotation 失敗 {r.status_code} {r.text}"
+        return True, r.json()
+    except (httpx.HTTPError, breaker.CircuitOpenError) as e:
+        return False, f"HTTP 錯誤：{e}"
+
+
+async def iter_each(project, access, items):
+    """一筆一個 POST；每筆寫完就 yield (task_id, ok, annotation 或錯誤訊息)"""
+    async def _send_one(it):
+        try:
+            ok, detail = await post_annotation(project, access, it["task"], it["rating"], it["relation"])
+        except Exception as e:
+            return it["task"], False, str(e)
+        return it["task"], ok, detail
+
+    # 併發上限由 client 的 semaphore 控制
+    for fut in asyncio.as_completed([_send_one(it) for it in items]):
+        yield await fut
+
+
+async def iter_bulk(project, access, items):
+    """views.iter_bulk 的 async 版本"""
+    groups, failed = views.bulk_groups(items)
+    for r in failed:
+        yield r
+    client = project.async_client()
+
+    async def _send_group(key):
+        group = groups[key]
+        if not project.bulk_writes:
+            return key, None
+        try:
+            resp = await client.post("annotations/bulk/", access,
+                                     json=views.bulk_body(project, [it["task"] for it in group], *key))
+        except (httpx.HTTPError, breaker.CircuitOpenError) as e:
+            return key, [(it["task"], False, f"HTTP 錯誤：{e}") for it in group]
+        return key, views.bulk_outcome(project, resp, group)
+
+    fallback = []
+    for fut in asyncio.as_completed([_send_group(key) for key in groups]):
+        key, outcome = await fut
+        if outcome is None:
+            fallback.extend(groups[key])
+        else:
+            for r in outcome:
+                yield r
+    if fallback:
+        async for r in iter_each(project, access, fallback):
+            yield r
+
+
+async def iter_write_batch(project, access, items):
+    """views.iter_write_batch 的 async 版本"""
+    if project.bulk_writes and items:
+        results = iter_bulk(project, access, items)
+    else:
+        results = iter_each(project, access, items)
+    by_task = {it["task"]: it for it in items}
+    async for task_id, ok, detail in results:
+        if ok:
+            it = by_task.get(task_id) or by_task.get(str(task_id)) or {}
+            await sync_to_async(views.remember_write)(project, task_id, detail, it.get("rating"), it.get("relation"))
+        yield task_id, ok, detail
+
+
+async def stream_batch(project, access, items, received: int, lease=None, rejected=()):
+    """views.stream_batch 的 async 版本"""
+    position = {}
+    for k, it in enumerate(items):
+        position.setdefault(it["task"], k)
+        position.setdefault(str(it["task"]), k)
+    results = list(rejected)
+    try:
+        for r in rejected:
+            yield views.item_line(position, r)
+        async for r in iter_write_batch(project, access, items):
+            results.append(r)
+            yield views.item_line(position, r)
+    finally:
+        await sync_to_async(views.finish_batch)(project, results, items, lease)
+    yield views.progress_line({"type": "summary", **views.batch_summary(results, received)})
+
+
+async def _find_annotation_id(project, task_id: int, token: str):
+    client = project.async_client()
+    try:
+        r = await client.get("annotations/", token, params={"taskID": task_id, "project": project.project_id})
+        if r.is_success:
+            ann_id = views.annotation_id_from_list(r.json())
+            if ann_id:
+                return ann_id
+    except Exception:
+        pass
+
+    try:
+        r2 = await client.get(f"tasks/{task_id}/", token, params={"project": project.project_id})
+        if r2.is_success:
+            return views.annotation_id_from_task(r2.json())
+    except Exception:
+        pass
+
+    return None
+
+
+async def send_edit(project, token, fields, indexed_id=None):
+    """views.send_edit 的 async 版"""
+    client = project.async_client()
+    ann_id = indexed_id or await _find_annotation_id(project, fields["task_id"], token)
+    method, path, kwargs, action = views.edit_request(project, ann_id, fields)
+    resp = await client.request(method, path, token, **kwargs)
+    if indexed_id and resp.status_code == 404:
+        ann_id = await _find_annotation_id(project, fields["task_id"], token)
+        method, path, kwargs, action = views.edit_request(project, ann_id, fields)
+        resp = await client.request(method, path, token, **kwargs)
+    return resp, action, ann_id
+
+
+async def page_cursor(project, access):
+    if views.MIRROR:
+        # 讀本地鏡像是同步 ORM，丟到 thread
+        return await sync_to_async(views.page_cursor)(project, access)
+    return await get_views_id(project, access)
+
+
+async def page_tasks(project, access, inner_id: int, page):
+    if views.MIRROR:
+        return await sync_to_async(views.page_tasks)(project, access, inner_id, page)
+    with metrics.phase("fetch"):
+        return await get_unlabeled_task(project, access, inner_id, page)
+
+
+async def fetch_history(project, access, start_inner_id: int):
+    if views.MIRROR:
+        return await sync_to_async(views.fetch_history)(project, access, start_inner_id)
+    with metrics.phase("fetch"):
+        tasks = await get_unlabeled_task(project, access, start_inner_id - 1, FETCH_NUM)
+    await sync_to_async(annotation_index.remember_tasks)(project.project_id, tasks)
+    project.labels.learn_rows(tasks)
+    return tasks
+
+
+async def history_page(project, access, start_inner_id: int, direction: str = "back"):
+    """views.history_page 的 async 版；過期頁的背景重抓走同步版（event loop 可能隨 request 結束）"""
+    rows, stale = await project.history_cache.aserve(
+        project.project_id, start_inner_id,
+        lambda: fetch_history(project, access, start_inner_id),
+        background=lambda: views.fetch_history(project, None, start_inner_id),
+    )
+    if not stale:
+        # 下一頁在背景 thread 預抓，不佔這個 request
+        views.prefetch_history(project, start_inner_id, direction)
+    return rows, stale
+
+
+async def fresh_batch(project, access):
+    batch = await asyncio.to_thread(project.prefetcher.take) if project.prefetcher else None
+    if batch is not None:
+        return batch.inner_id, batch.num_tasks_with_annotations, batch.tasks
+    if views.MIRROR:
+        inner_id, num = await page_cursor(project, access)
+        return inner_id, num, await page_tasks(project, access, inner_id - 1, project.total)
+    steps = {
+        **cursor_steps(project, access),
+        "tasks": (("next_task",), lambda inner_id: page_tasks(project, access, inner_id - 1, project.total)),
+    }
+    out = await fanin.aresolve(steps, ("next_task", "counters", "tasks"))
+    return out["next_task"], out["counters"]["num_tasks_with_annotations"], out["tasks"]
+
+
+async def table_cursor(project, access):
+    if views.MIRROR:
+        return await page_cursor(project, access), False
+    return await project.cursor_cache.alookup(project.project_id, lambda: page_cursor(project, access),
+                                              background=lambda: views.page_cursor(project, None))
+
+
+def _current_lease(project, request):
+    return leases.current(project.project_id, leases.owner_key(request))
+
+
+async def serve_batch(project, request, access):
+    """views.serve_batch 的 async 版"""
+    stale = False
+    if views.LEASES:
+        first_inner_id, num = await page_cursor(project, access)
+        lease, num_tasks_with_annotations = \
+            await sync_to_async(views.lease_window)(project, request, first_inner_id, num)
+        inner_id = lease.start_inner_id
+        size = lease.end_inner_id - lease.start_inner_id + 1
+        tasks = await sync_to_async(views.lease_tasks)(lease, await page_tasks(project, access, inner_id - 1, size))
+    elif views.MIRROR:
+        inner_id, num_tasks_with_annotations, tasks = await fresh_batch(project, access)
+    else:
+        (inner_id, num_tasks_with_annotations, tasks), stale = \
+            await project.batch_cache.alookup(project.project_id, lambda: fresh_batch(project, access))
+    if stale:
+        inner_id, num_tasks_with_annotations, tasks = \
+            await sync_to_async(views.unsubmitted)(project, inner_id, num_tasks_with_annotations, tasks)
+        if not tasks:
+            raise breaker.CircuitOpenError(project.circuit.retry_after())
+    elif project.prefetcher:
+        project.prefetcher.on_served(inner_id, num_tasks_with_annotations, tasks)
+    elif views.LEASES:
+        views.warm_next_images(project, lease.end_inner_id)
+    elif tasks:
+        views.warm_next_images(project, tasks[-1].inner_id)
+
+    num_tasks_with_annotations, tasks, suggestions = await sync_to_async(views.propagate)(
+        project, request, access, num_tasks_with_annotations, tasks, stale)
+    if not views.LEASES:
+        project.task_ids = [task.task_id for task in tasks]
+    return num_tasks_with_annotations, tasks, stale, suggestions
+
+
+@csrf_exempt
+@projects.scoped
+async def index(request, project):
+    access = await try_token(project)
+    if request.method == 'GET':
+        if views.INDEX_SHELL:
+            with metrics.phase("render"):
+                return render(request, "index.html", {
+                    "shell": True, "project_id": project.project_id, "base_path": project.base_path})
+        try:
+            num_tasks_with_annotations, tasks, stale, suggestions = await serve_batch(project, request, access)
+        except Exception as e:
+            return error_response(e, project)
+
+        total_fetch = len(tasks)
+        with metrics.phase("render"):
+            return render(request, "index.html", {
+                "tasks": enumerate(tasks, start=int(num_tasks_with_annotations)+1),
+                "project_id": project.project_id,
+                "base_path": project.base_path,
+                "annotations": int(num_tasks_with_annotations)+1,
+                "total": total_fetch,
+                "t": total_fetch-1,
+                "stale": stale,
+                "suggestions": suggestions,
+            })
+    if request.method == 'POST':
+        try:
+            payload = json.loads(request.body.decode("utf-8"))
+        except json.JSONDecodeError:
+            return HttpResponseBadRequest("Invalid JSON")
+
+        lease, rejected = None, []
+        if "retry" in payload:
+            items, rejected = views.retry_items(project, payload["retry"])
+            batch = payload["retry"]
+        else:
+            if views.LEASES:
+                lease = await sync_to_async(_current_lease)(project, request)
+                if lease is None:
+                    return views.lease_expired_response()
+            batch, items = views.batch_items(payload.get("batch", []), lease.task_ids if lease else project.task_ids)
+
+        if views.queue_locally(project, access):
+            failed = await sync_to_async(outbox.enqueue)(project.project_id, items)
+            if lease:
+                await sync_to_async(leases.release)(lease)
+            return views.outbox_response(rejected + failed, len(batch), len(items) - len(failed))
+
+        if views.wants_stream(request):
+            return views.stream_response(stream_batch(project, access, items, len(batch), lease, rejected))
+
+        results = list(rejected)
+        async for r in iter_write_batch(project, access, items):
+            results.append(r)
+        await sync_to_async(views.finish_batch)(project, results, items, lease)
+        return views.batch_response(results, len(batch))
+    return JsonResponse({'error': 'Only GET/POST allowed'}, status=405)
+
+
+@projects.scoped
+async def history(request, project):
+    if request.method != 'GET':
+        return JsonResponse({'error': 'Only GET allowed'}, status=405)
+    try:
+        start_inner_id, start_ann_num, direction = views.read_history_query(request)
+    except (TypeError, ValueError):
+        return HttpResponseBadRequest("Invalid fields: current_annotation_num/current_inner_id/direction")
+
+    try:
+        page, stale = await history_page(project, None, start_inner_id, direction)
+    except Exception as e:
+        return error_response(e, project)
+    return views.history_response(views.number_rows(page, start_inner_id, start_ann_num),
+                                  start_inner_id, start_ann_num, stale)
+
+
+@projects.scoped
+async def batch_api(request, project):
+    if request.method != 'GET':
+        return JsonResponse({'error': 'Only GET allowed'}, status=405)
+    try:
+        num, tasks, stale, suggestions = await serve_batch(project, request, await try_token(project))
+    except Exception as e:
+        return error_response(e, project)
+    return compact.json_response(request, compact.batch_payload(num, tasks, stale, suggestions))
+
+
+@projects.scoped
+async def history_api(request, project):
+    if request.method != 'GET':
+        return JsonResponse({'error': 'Only GET allowed'}, status=405)
+    try:
+        start_inner_id, start_ann_num, direction = views.read_history_query(request)
+    except (TypeError, ValueError):
+        return HttpResponseBadRequest("Invalid fields: current_annotation_num/current_inner_id/direction")
+
+    try:
+        page, stale = await history_page(project, None, start_inner_id, direction)
+    except Exception as e:
+        return error_response(e, project)
+    return compact.json_response(request, compact.history_payload(page, start_inner_id, start_ann_num, stale))
+
+
+@csrf_exempt
+@projects.scoped
+async def table(request, project):
+    if request.method == 'GET':
+        access = await try_token(project)
+        try:
+            (base_inner_id, base_num_anns), stale_cursor = await table_cursor(project, access)
+            start_inner_id = base_inner_id - FETCH_NUM
+            start_ann_num = base_num_anns - FETCH_NUM
+
+            page, stale = await history_page(project, access, start_inner_id)
+        except Exception as e:
+            return error_response(e, project)
+
+        with metrics.phase("render"):
+            return render(request, 'table.html', {
+                "project_id": project.project_id,
+                "base_path": project.base_path,
+                "history_datas": views.number_rows(page, start_inner_id, start_ann_num),
+                "annotations": start_ann_num + 1,
+                "inner_id": start_inner_id + 1,
+                "t": FETCH_NUM-1,
+                "stale": stale or stale_cursor,
+            })
+    if request.method == 'POST':
+        try:
+            raw = (request.body or b'').decode('utf-8', errors='ignore').strip()
+            payload = json.loads(raw) if raw else {}
+        except json.JSONDecodeError:
+            return HttpResponseBadRequest("Invalid JSON")
+
+        try:
+            start_inner_id, start_ann_num = views.history_cursor(payload)
+        except (TypeError, ValueError, AttributeError):
+            return HttpResponseBadRequest("Invalid fields: current_annotation_num/current_inner_id")
+
+        try:
+            page, stale = await history_page(project, None, start_inner_id)
+        except Exception as e:
+            return error_response(e, project)
+
+        return views.history_response(views.number_rows(page, start_inner_id, start_ann_num),
+                                      start_inner_id, start_ann_num, stale)
+
+    return JsonResponse({'error': 'Only GET/POST allowed'}, status=405)
+
+
+async def queued_edits(project, rows):
+    """views.queued_edits 的 async 版：等正在送出的項目時用 asyncio.sleep，不佔住 sync_to_async 的 thread
+
+    跟 sync 版一樣，整批共用一個 LABEL_STUDIO_OUTBOX_AMEND_WAIT 的期限。
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + outbox.AMEND_WAIT
+    delay = outbox.AMEND_POLL
+    queued, waiting = {}, rows
+    while True:
+        queued.update(await sync_to_async(views.queued_edits)(project, waiting, wait=0))
+        waiting = [f for f in waiting if queued[f["task_id"]] is not None and queued[f["task_id"]][0] == 409]
+        left = deadline - loop.time()
+        if not waiting or left <= 0:
+            return queued
+        await asyncio.sleep(min(delay, left))
+        delay = min(delay * 2, outbox.AMEND_POLL_MAX)
+
+
+@csrf_exempt
+@projects.scoped
+async def edit_task(request, project):
+    payload, err = views.read_edit_body(request)
+    if err:
+        return err
+    fields, err = views.parse_edit(payload)
+    if err:
+        return err
+
+    queued = (await queued_edits(project, [fields]))[fields["task_id"]]
+    if queued is not None:
+        return JsonResponse(queued[1], status=queued[0])
+
+    client = project.async_client()
+    try:
+        token = await client.token()
+    except Exception as e:
+        return JsonResponse({'error': 'failed to get access token', 'detail': str(e)}, status=500)
+
+    indexed_id = await sync_to_async(annotation_index.lookup)(project.project_id, fields["task_id"])
+    try:
+        resp, action, ann_id = await send_edit(project, token, fields, indexed_id)
+    except (httpx.HTTPError, breaker.CircuitOpenError) as e:
+        return JsonResponse({'error': 'request to LS failed', 'detail': str(e)}, status=502)
+
+    status, body = await sync_to_async(views.finish_edit)(project, resp, action, ann_id, fields, indexed_id)
+    return JsonResponse(body, status=status)
+
+
+@csrf_exempt
+@projects.scoped
+async def edit_bulk(request, project):
+    payload, err = views.read_edit_body(request)
+    if err:
+        return err
+    rows, err = views.parse_bulk_edit(payload)
+    if err:
+        return err
+
+    client = project.async_client()
+    try:
+        token = await client.token()
+    except Exception as e:
+        return JsonResponse({'error': 'failed to get access token', 'detail': str(e)}, status=500)
+
+    queued = await queued_edits(project, rows)
+    indexed = await sync_to_async(annotation_index.lookup_many)(project.project_id, [f["task_id"] for f in rows])
+
+    async def _send(fields):
+        if queued[fields["task_id"]] is not None:
+            return None, None
+        try:
+            return await send_edit(project, token, fields, indexed.get(fields["task_id"])), None
+        except (httpx.HTTPError, breaker.CircuitOpenError) as e:
+            return None, str(e)
+
+    # 同時打上游的數量由 client 的 semaphore 控制
+    sent = await asyncio.gather(*(_send(f) for f in rows))
+
+    def _finish():
+        results = []
+        for fields, (out, error) in zip(rows, sent):
+            if queued[fields["task_id"]] is not None:
+                results.append(views.bulk_row(fields, *queued[fields["task_id"]]))
+                continue
+            if error is not None:
+                results.append(views.bulk_row(fields, 502, {'error': 'request to LS failed', 'detail': error}))
+                continue
+            status, body = views.finish_edit(project, *out, fields, indexed.get(fields["task_id"]))
+            results.append(views.bulk_row(fields, status, body))
+        return results
+
+    return views.bulk_response(await sync_to_async(_finish)())
@@ -0,0 +1 @@
+"""效能量測工具：本地的 Label Studio 替身（fake_ls）與 benchmark（harness）"""
@@ -0,0 +1,280 @@
+"""本地的 Label Studio 替身（只實作 main/views.py 會打的端點）
+
+    server = FakeLabelStudio(num_tasks=5000, latency=0.02, error_rate=0.01, rate_429=0.02)
+    server.start()
+    ... settings.LABEL_STUDIO_URL = server.url ...
+    server.stop()
+
+latency 是每個請求固定加的延遲（秒），jitter 是再隨機加的上限；error_rate / rate_429
+是回 500 / 429 的機率（token refresh 不受影響）。stats() 回傳各端點被打的次數。
+"""
+import base64
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+TASK_ID_BASE = 100000
+# 1x1 PNG，給縮圖代理暖機用
+PIXEL_PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg=="
+)
+
+
+def _now_iso():
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime()) + ".%06dZ" % (time.time() % 1 * 1e6)
+
+
+def _jwt(exp: float) -> str:
+    body = base64.urlsafe_b64encode(json.dumps({"exp": int(exp)}).encode()).decode().rstrip("=")
+    return f"fake.{body}.sig"
+
+
+class FakeLabelStudio:
+
+    def __init__(self, num_tasks: int = 5000, latency: float = 0.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, rate_429: float = 0.0, token_ttl: int = 300,
+                 host: str = "127.0.0.1", port: int = 0, seed: int = None):
+        self.num_tasks = num_tasks
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_429 = rate_429
+        self.token_ttl = token_ttl
+        self.host = host
+        self.port = port
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self.reset()
+
+    # ---- 狀態 ----
+
+    def reset(self):
+        with self._lock:
+            self.tasks = {}         # inner_id -> task
+            self.by_id = {}         # task_id -> task
+            self.annotations = {}   # annotation_id -> annotation
+            self._next_ann = 1
+            self.counts = Counter()
+            for inner_id in range(1, self.num_tasks + 1):
+                self._add_task(inner_id)
+
+    def _add_task(self, inner_id: int):
+        task = {
+            "id": TASK_ID_BASE + inner_id,
+            "inner_id": inner_id,
+            "data": {
+                "query": f"query {inner_id % 97}",
+                "IT_NAME": f"item {inner_id}",
+                "image_url": f"{self.url}/media/{inner_id}.png" if self._server else f"/media/{inner_id}.png",
+            },
+            "annotations_results": "",
+            "annotations_ids": "",
+            "total_annotations": 0,
+            "updated_at": _now_iso(),
+        }
+        self.tasks[inner_id] = task
+        self.by_id[task["id"]] = task
+
+    def _labeled(self) -> int:
+        return sum(1 for t in self.tasks.values() if t["total_annotations"])
+
+    def _store(self, task_id: int, result, ann_id: int = None):
+        task = self.by_id.get(task_id)
+        if task is None:
+            return None
+        with self._lock:
+            if ann_id is None:
+                ann_id = self._next_ann
+                self._next_ann += 1
+            ann = {"id": ann_id, "task": task_id, "result": result, "updated_at": _now_iso()}
+            self.annotations[ann_id] = ann
+            ids = sorted(a["id"] for a in self.annotations.values() if a["task"] == task_id)
+            task.update(
+                annotations_results=json.dumps([result]),
+                annotations_ids=", ".join(map(str, ids)),
+                total_annotations=len(ids),
+                updated_at=ann["updated_at"],
+            )
+        return ann
+
+    def stats(self) -> dict:
+        return dict(self.counts)
+
+    # ---- server ----
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def start(self):
+        fake = self
+
+        class Handler(_Handler):
+            server_ref = fake
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        # 圖片網址要帶 server 位址
+        for task in self.tasks.values():
+            task["data"]["image_url"] = f"{self.url}/media/{task['inner_id']}.png"
+        threading.Thread(target=self._server.serve_forever, name="fake-ls", daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    # ---- 路由 ----
+
+    def _fault(self, path: str):
+        """依設定的機率回 (status, body)；None 表示正常處理"""
+        if path == "/api/token/refresh/":
+            return None
+        roll = self._random.random()
+        if roll < self.rate_429:
+            return 429, {"detail": "Request was throttled."}
+        if roll < self.rate_429 + self.error_rate:
+            return 500, {"detail": "Internal server error"}
+        return None
+
+    def handle(self, method: str, path: str, query: dict, body):
+        """回傳 (status, JSON 物件或 bytes, 額外 header)"""
+        key = f"{method} " + re.sub(r"\d+", "N", path)
+        self.counts[key] += 1
+
+        delay = self.latency + (self._random.random() * self.jitter if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+
+        m = re.match(r"^/media/(\d+)\.png$", path)
+        if m and method == "GET":
+            return 200, PIXEL_PNG, {"Content-Type": "image/png"}
+
+        fault = self._fault(path)
+        if fault is not None:
+            return fault[0], fault[1], {"Retry-After": "0"} if fault[0] == 429 else {}
+
+        route = getattr(self, f"_{method.lower()}", None)
+        if route is None:
+            return 405, {"detail": "method not allowed"}, {}
+        return route(path, query, body)
+
+    def _post(self, path, query, body):
+        if path == "/api/token/refresh/":
+            return 200, {"access": _jwt(time.time() + self.token_ttl)}, {}
+        if path == "/api/dm/actions/":
+            with self._lock:
+                nxt = next((i for i in sorted(self.tasks) if not self.tasks[i]["total_annotations"]),
+                           self.num_tasks)
+            return 200, self.tasks[nxt], {}
+        m = re.match(r"^/api/tasks/(\d+)/annotations/$", path)
+        if m:
+            ann = self._store(int(m.group(1)), body.get("result"))
+            return (201, ann, {}) if ann else (404, {"detail": "Not found."}, {})
+        if path == "/api/annotations/":
+            ann = self._store(int(body.get("task") or 0), body.get("result"))
+            return (201, ann, {}) if ann else (400, {"task": ["invalid"]}, {})
+        if path == "/api/annotations/bulk/":
+            # 同一份 result 建到多個 task 上；有任何一個 task 不存在就整批拒收
+            ids = [int(i) for i in body.get("tasks") or []]
+            if not ids or any(i not in self.by_id for i in ids):
+                return 400, {"tasks": ["invalid"]}, {}
+            return 201, [{"id": self._store(i, body.get("result"))["id"]} for i in ids], {}
+        return 404, {"detail": "Not found."}, {}
+
+    def _patch(self, path, query, body):
+        m = re.match(r"^/api/annotations/(\d+)/$", path)
+        if m and int(m.group(1)) in self.annotations:
+            ann = self.annotations[int(m.group(1))]
+            return 200, self._store(ann["task"], body.get("result"), ann_id=ann["id"]), {}
+        return 404, {"detail": "Not found."}, {}
+
+    def _get(self, path, query, body):
+        if re.match(r"^/api/projects/\d+/?$", path):
+            return 200, {"id": 1, "num_tasks_with_annotations": self._labeled(),
+                         "task_number": self.num_tasks}, {}
+        if path == "/api/tasks/":
+            return 200, self._list_tasks(query), {}
+        m = re.match(r"^/api/tasks/(\d+)/$", path)
+        if m:
+            task = self.by_id.get(int(m.group(1)))
+            if task is None:
+                return 404, {"detail": "Not found."}, {}
+            anns = [a for a in self.annotations.values() if a["task"] == task["id"]]
+            return 200, {**task, "annotations": anns}, {}
+        if path == "/api/annotations/":
+            task_id = int((query.get("taskID") or ["0"])[0])
+            return 200, [a for a in self.annotations.values() if a["task"] == task_id], {}
+        return 404, {"detail": "Not found."}, {}
+
+    def _list_tasks(self, query):
+        q = json.loads((query.get("query") or ["{}"])[0])
+        # 跟 Label Studio 一樣，一頁最多 100 筆
+        page_size = min(int((query.get("page_size") or ["100"])[0]), 100)
+        items = (q.get("filters") or {}).get("items") or []
+        after, updated_after, unlabeled = 0, None, False
+        for it in items:
+            if it.get("filter") == "filter:tasks:inner_id":
+                after = int(it.get("value") or 0)
+            elif it.get("filter") == "filter:tasks:updated_at":
+                updated_after = it.get("value")
+            elif it.get("filter") == "filter:tasks:total_annotations":
+                unlabeled = True
+        # include=a,b,c：只回這些欄位（跟 Label Studio 一樣）
+        include = [f for f in (query.get("include") or [""])[0].split(",") if f]
+        out = []
+        with self._lock:
+            for inner_id in range(max(after, 0) + 1, self.num_tasks + 1):
+                task = self.tasks[inner_id]
+                if unlabeled and task["total_annotations"]:
+                    continue
+                if updated_after and task["updated_at"] <= updated_after:
+                    continue
+                out.append({f: task[f] for f in include if f in task} if include else dict(task))
+                if len(out) >= page_size:
+                    break
+        return {"tasks": out, "total": self.num_tasks}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_ref = None
+
+    def log_message(self, *args):
+        pass
+
+    def _dispatch(self, method):
+        u = urlparse(self.path)
+        n = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(n) if n else b""
+        try:
+            body = json.loads(raw) if raw else {}
+        except ValueError:
+            body = {}
+        status, payload, headers = self.server_ref.handle(method, u.path, parse_qs(u.query), body)
+        data = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", headers.pop("Content-Type", "application/json"))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_PATCH(self):
+        self._dispatch("PATCH")
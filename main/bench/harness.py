@@ -0,0 +1,317 @@
+"""index / table / edit 的 benchmark
+
+    python -m main.bench --annotators 1,4,16 --max-workers 4,8 --total 50 \
+        --latency-ms 20 --rate-429 0.02 --out bench.json --compare last.json
+
+每個參數組合開一個子 process（設定在 django.setup() 前覆寫，乾淨的暫存 DB），
+N 個模擬標註者各自用自己的 session 跑 index GET → index POST → table GET →
+edit PATCH。上游是同一個本地 FakeLabelStudio，每組之間 reset。結果寫成 JSON，
+--compare 拿上一次的結果比 p50 / p99。
+
+開了 outbox 時 index POST 只是寫進本地就回應：跑完之後會等 outbox 全部送完才結算，
+wall_s / throughput 算到送完為止，另外記每筆從排入到上游收下的延遲（outbox_commit）。
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+
+from .fake_ls import FakeLabelStudio
+
+BASE_DIR = Path(__file__).resolve().parents[2]
+VIEWS = ("index_get", "batch_api", "index_post", "table_get", "edit", "outbox_commit")
+
+
+def percentile(values, p: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))
+    return ordered[k]
+
+
+def summarize(samples):
+    """[(秒數, 狀態碼), ...] → 統計（毫秒）"""
+    ms = [s * 1000 for s, _ in samples]
+    return {
+        "n": len(samples),
+        "errors": sum(1 for _, status in samples if status >= 400),
+        "p50_ms": _round(percentile(ms, 50)),
+        "p90_ms": _round(percentile(ms, 90)),
+        "p99_ms": _round(percentile(ms, 99)),
+        "mean_ms": _round(sum(ms) / len(ms)) if ms else None,
+        "max_ms": _round(max(ms)) if ms else None,
+    }
+
+
+def _round(v):
+    return None if v is None else round(v, 2)
+
+
+# ---------------- 子 process ----------------
+
+def _setup_django(cfg):
+    import importlib
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "djangoProject.settings")
+    mod = importlib.import_module(os.environ["DJANGO_SETTINGS_MODULE"])
+    tmp = Path(tempfile.mkdtemp(prefix="ls-bench-"))
+    overrides = {
+        "LABEL_STUDIO_URL": cfg["ls_url"],
+        "LABEL_STUDIO_TOKEN": "bench-refresh-token",
+        "LABEL_STUDIO_TOKEN_CACHE": None,
+        "TOTAL": cfg["total"],
+        "LABEL_STUDIO_MAX_WORKERS": cfg["max_workers"],
+        "LABEL_STUDIO_FETCH_NUM": cfg["fetch_num"],
+        "LABEL_STUDIO_IMAGE_CACHE_DIR": tmp / "image_cache",
+        "ALLOWED_HOSTS": ["testserver", "localhost"],
+        "DATABASES": {"default": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": str(tmp / "bench.sqlite3"),
+            "OPTIONS": {"timeout": 30},
+        }},
+    }
+    overrides.update(cfg.get("settings") or {})
+    for key, value in overrides.items():
+        setattr(mod, key, value)
+
+    import django
+    django.setup()
+    from django.core.management import call_command
+    from django.test.utils import setup_test_environment
+
+    call_command("migrate", verbosity=0)
+    # 讓 response.context 可以用
+    setup_test_environment()
+
+
+def _annotator(cfg, samples, lock, barrier):
+    from django.test import Client
+
+    client = Client()
+    mine = defaultdict(list)
+
+    def timed(name, fn):
+        t0 = time.perf_counter()
+        resp = fn()
+        mine[name].append((time.perf_counter() - t0, resp.status_code))
+        return resp
+
+    barrier.wait()
+    for i in range(cfg["iterations"]):
+        r = timed("index_get", lambda: client.get("/"))
+        if r.status_code == 200 and r.context and r.context.get("shell"):
+            # 空殼模式：卡片另外打 /api/batch/
+            r = timed("batch_api", lambda: client.get("/api/batch/"))
+            n = len(json.loads(r.content)["rows"]) if r.status_code == 200 else 0
+        else:
+            n = int(r.context["total"]) if r.status_code == 200 and r.context else 0
+        batch = [{"num": (i + j) % 5, "aux": "ESCI"[j % 4], "combo": f"{(i + j) % 5}{'ESCI'[j % 4]}"}
+                 for j in range(n)]
+        timed("index_post", lambda: client.post("/", json.dumps({"batch": batch}),
+                                                 content_type="application/json"))
+
+        r = timed("table_get", lambda: client.get("/table/"))
+        rows = [row for row in (r.context["history_datas"] if r.status_code == 200 and r.context else [])
+                if row.get("rating") not in (None, "")]
+        if rows:
+            row = rows[i % len(rows)]
+            body = {"task_id": row["task_id"], "inner_id": row["inner_id"], "rating": 2, "relation": "S"}
+            timed("edit", lambda: client.patch("/edit/", json.dumps(body), content_type="application/json"))
+
+    with lock:
+        for name, values in mine.items():
+            samples[name].extend(values)
+
+
+def drain_outbox(timeout: float):
+    """等 outbox 送完（沒有 pending / sending）；回傳 (等了幾秒, 是否送完, 每筆的 [(排入到送達秒數, 200)])"""
+    from main import outbox, views
+    from main.models import OutboxItem
+
+    if not views.OUTBOX:
+        return 0.0, True, []
+    t0 = time.perf_counter()
+    drained = False
+    while time.perf_counter() - t0 < timeout:
+        if not OutboxItem.objects.filter(status__in=[OutboxItem.PENDING, OutboxItem.SENDING]).exists():
+            drained = True
+            break
+        outbox.flusher.wake()
+        time.sleep(0.05)
+    waited = time.perf_counter() - t0
+    done = OutboxItem.objects.filter(status=OutboxItem.DONE).values_list("created_at", "updated_at")
+    return waited, drained, [((updated - created).total_seconds(), 200) for created, updated in done]
+
+
+def run_worker(cfg) -> dict:
+    """在子 process 裡跑一組設定；回傳結果 dict"""
+    _setup_django(cfg)
+    from django.db import connections
+
+    if cfg.get("warmup", True):
+        # 第一次同步鏡像、拿 token 不算進量測
+        from django.test import Client
+        Client().get("/table/")
+
+    samples = defaultdict(list)
+    lock = threading.Lock()
+    barrier = threading.Barrier(cfg["annotators"])
+
+    def _run():
+        try:
+            _annotator(cfg, samples, lock, barrier)
+        finally:
+            connections.close_all()
+
+    threads = [threading.Thread(target=_run, name=f"annotator-{i}") for i in range(cfg["annotators"])]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    requests = sum(len(v) for v in samples.values())
+    # outbox 還沒送完的寫入也算進這一輪的時間，不然 index POST 看起來比實際快
+    drain_s, drained, commits = drain_outbox(cfg.get("drain_timeout", 300))
+    samples["outbox_commit"] = commits
+    wall = time.perf_counter() - t0
+
+    return {
+        "wall_s": round(wall, 3),
+        "outbox_drain_s": round(drain_s, 3),
+        "outbox_drained": drained,
+        "requests": requests,
+        "throughput_rps": round(requests / wall, 2) if wall else None,
+        "views": {name: summarize(samples.get(name, [])) for name in VIEWS},
+    }
+
+
+# ---------------- 主 process ----------------
+
+def _ints(text):
+    return [int(x) for x in str(text).split(",") if x.strip()]
+
+
+def _setting(text):
+    key, _, raw = text.partition("=")
+    try:
+        value = json.loads(raw)
+    except ValueError:
+        value = raw
+    return key.strip(), value
+
+
+def case_key(config) -> str:
+    keys = ("annotators", "max_workers", "total", "fetch_num", "warmup", "settings")
+    return json.dumps({k: config.get(k) for k in keys}, sort_keys=True)
+
+
+def compare(results, baseline_path, threshold: float):
+    """跟上一次的結果比；回傳變慢超過 threshold 的 (組合, view, 指標, 舊, 新)"""
+    with open(baseline_path, encoding="utf-8") as f:
+        old = {case_key(r["config"]): r for r in json.load(f).get("results", [])}
+    regressions = []
+    for r in results:
+        prev = old.get(case_key(r["config"]))
+        if prev is None:
+            continue
+        for view, stats in r["views"].items():
+            before = prev["views"].get(view) or {}
+            for metric in ("p50_ms", "p99_ms"):
+                a, b = before.get(metric), stats.get(metric)
+                if a and b and (b - a) / a > threshold:
+                    regressions.append((case_key(r["config"]), view, metric, a, b))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m main.bench", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--annotators", default="1,4", help="同時標註人數（逗號分隔多個值）")
+    parser.add_argument("--max-workers", default="8", help="LABEL_STUDIO_MAX_WORKERS（AIMD 起始並行數）")
+    parser.add_argument("--total", default="50", help="TOTAL（一批幾張卡片）")
+    parser.add_argument("--fetch-num", default="100", help="FETCH_NUM（table 一頁幾筆）")
+    parser.add_argument("--iterations", type=int, default=3, help="每位標註者跑幾輪")
+    parser.add_argument("--no-warmup", action="store_true", help="連冷啟動（第一次同步 / 拿 token）一起量")
+    parser.add_argument("--tasks", type=int, default=5000, help="假 project 的 task 數")
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--jitter-ms", type=float, default=10.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--drain-timeout", type=float, default=300.0,
+                        help="開 outbox 時最多等幾秒讓它送完才結算")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=JSON",
+                        help="額外覆寫的 setting，例如 --set LABEL_STUDIO_MIRROR=false")
+    parser.add_argument("--out", default="bench_results.json")
+    parser.add_argument("--compare", help="上一次的結果檔")
+    parser.add_argument("--threshold", type=float, default=0.10, help="變慢多少算退步（比例）")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        print(json.dumps(run_worker(json.loads(args.worker))))
+        return 0
+
+    server = FakeLabelStudio(
+        num_tasks=args.tasks, latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000,
+        error_rate=args.error_rate, rate_429=args.rate_429, seed=0,
+    ).start()
+    extra = dict(_setting(s) for s in args.set)
+    grid = itertools.product(_ints(args.annotators), _ints(args.max_workers), _ints(args.total), _ints(args.fetch_num))
+
+    results = []
+    try:
+        for annotators, max_workers, total, fetch_num in grid:
+            config = {
+                "annotators": annotators, "max_workers": max_workers, "total": total, "fetch_num": fetch_num,
+                "iterations": args.iterations, "warmup": not args.no_warmup, "settings": extra,
+                "drain_timeout": args.drain_timeout,
+            }
+            server.reset()
+            proc = subprocess.run(
+                [sys.executable, "-m", "main.bench", "--worker", json.dumps({**config, "ls_url": server.url})],
+                cwd=BASE_DIR, capture_output=True, text=True,
+            )
+            if proc.returncode != 0:
+                sys.stderr.write(proc.stderr)
+                raise SystemExit(f"benchmark worker failed for {config}")
+            result = {"config": config, **json.loads(proc.stdout.strip().splitlines()[-1]),
+                      "upstream": server.stats()}
+            results.append(result)
+            views = "  ".join(f"{v} p50={s['p50_ms']} p99={s['p99_ms']}" for v, s in result["views"].items()
+                              if s["n"])
+            print(f"annotators={annotators} max_workers={max_workers} total={total} fetch_num={fetch_num}: "
+                  f"{result['throughput_rps']} req/s  {views}")
+            if not result["outbox_drained"]:
+                print(f"  WARNING: outbox still had unsent items after {args.drain_timeout}s")
+    finally:
+        server.stop()
+
+    report = {
+        "meta": {
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "upstream": {"tasks": args.tasks, "latency_ms": args.latency_ms, "jitter_ms": args.jitter_ms,
+                         "error_rate": args.error_rate, "rate_429": args.rate_429},
+        },
+        "results": results,
+    }
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"wrote {args.out}")
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        for key, view, metric, a, b in regressions:
+            print(f"REGRESSION {view} {metric}: {a} → {b} ms  {key}")
+        return 1 if regressions else 0
+    return 0
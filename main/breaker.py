@@ -0,0 +1,116 @@
+"""Label Studio 的斷路器
+
+連續 BREAKER_FAILURES 次連線錯誤 / 5xx 就「斷開」：接下來 BREAKER_COOLDOWN 秒內
+所有上游呼叫直接丟 CircuitOpenError，不再每個 request 都等滿 timeout。冷卻時間到了
+放一個探測請求過去（half-open），成功就恢復，失敗再斷開一輪。429 代表上游還活著，
+交給 throttle 處理，不算失敗。
+
+CircuitOpenError 是 requests.ConnectionError 的子類，原本接 RequestException 的地方
+（post_annotation、outbox、edit）不用改就會當成一般的連線失敗。
+
+每個專案各有一個斷路器（見 main.projects）；這裡的 circuit 是預設專案的。
+"""
+import threading
+import time
+
+import requests
+from django.conf import settings
+
+from . import metrics
+
+BREAKER_FAILURES = int(getattr(settings, "LABEL_STUDIO_BREAKER_FAILURES", 5))
+BREAKER_COOLDOWN = float(getattr(settings, "LABEL_STUDIO_BREAKER_COOLDOWN", 30))
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+
+
+class CircuitOpenError(requests.ConnectionError):
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Label Studio 暫時無法連線（斷路器開啟，{retry_after:.0f} 秒後重試）")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+
+    def __init__(self, failures: int = BREAKER_FAILURES, cooldown: float = BREAKER_COOLDOWN):
+        self.threshold = max(failures, 1)
+        self.cooldown = cooldown
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current()
+
+    def _current(self) -> str:
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+            self._transition(HALF_OPEN)
+        return self._state
+
+    def _transition(self, state: str):
+        self._state = state
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+        TRANSITIONS.inc(state)
+
+    def retry_after(self) -> float:
+        with self._lock:
+            if self._current() != OPEN:
+                return 0.0
+            return max(0.0, self.cooldown - (time.monotonic() - self._opened_at))
+
+    def is_open(self) -> bool:
+        """冷卻中（連探測都不放）"""
+        return self.state == OPEN
+
+    def before_request(self):
+        with self._lock:
+            state = self._current()
+            if state == CLOSED:
+                return
+            if state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+            retry_after = max(0.0, self.cooldown - (time.monotonic() - self._opened_at))
+        SHORT_CIRCUITED.inc()
+        raise CircuitOpenError(retry_after)
+
+    def record(self, status):
+        """一次上游呼叫的結果；status 是狀態碼或例外名稱，None 表示被取消（不算數）"""
+        with self._lock:
+            if status is None:
+                self._probing = False
+                return
+            if not isinstance(status, int) or status >= 500:
+                self._failures += 1
+                if self._probing or self._failures >= self.threshold:
+                    if self._state != OPEN:
+                        self._transition(OPEN)
+                    self._opened_at = time.monotonic()
+                self._probing = False
+                return
+            self._failures = 0
+            if self._state != CLOSED:
+                self._transition(CLOSED)
+            self._probing = False
+
+
+TRANSITIONS = metrics.counter(
+    "ls_upstream_circuit_transitions_total", "Circuit breaker state changes, by new state", ("state",))
+SHORT_CIRCUITED = metrics.counter(
+    "ls_upstream_short_circuited_total", "Upstream calls rejected locally because the circuit was open")
+
+circuit = CircuitBreaker()
+
+CIRCUIT_STATE = metrics.gauge(
+    "ls_upstream_circuit_state", "Circuit breaker state (0 = closed, 1 = half-open, 2 = open)", labels=("project",))
+
+
+def expose(project_id, circuit: CircuitBreaker):
+    """把一個專案的斷路器狀態掛到 /metrics（label project）"""
+    CIRCUIT_STATE.bind(lambda: (CLOSED, HALF_OPEN, OPEN).index(circuit.state), project_id)
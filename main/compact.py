@@ -0,0 +1,148 @@
+"""給前端的精簡 JSON：/api/batch/ 與 /api/history/
+
+- 只帶模板用得到的欄位，用 fields + rows（每列一個 array）表示，不重複 key
+- 弱 ETag：內容沒變時瀏覽器帶 If-None-Match 回來就給 304，不送 body
+- 依 Accept-Encoding 壓縮（有裝 brotli 就優先 br，否則 gzip）；太小的不壓
+- 壓好的 body 以 ETag 記住一小段時間，重複載入同一份不用再壓一次
+"""
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+
+from . import images
+from .rows import dumps
+
+try:
+    import brotli
+except ImportError:  # 選用：沒裝就只有 gzip
+    brotli = None
+
+# 小於這個大小（bytes）不壓縮
+COMPRESS_MIN_BYTES = int(getattr(settings, "LABEL_STUDIO_COMPRESS_MIN_BYTES", 1024))
+# 記住幾份壓好的 body
+_ENCODED_CACHE_SIZE = 32
+
+# index 卡片與 table 列各自用到的欄位（順序就是 rows 裡的順序）
+BATCH_FIELDS = ("task_id", "inner_id", "query", "IT_NAME", "card_url", "suggested", "conflict", "near")
+HISTORY_FIELDS = ("task_id", "inner_id", "num_tasks_with_annotations", "rating", "relation",
+                  "query", "IT_NAME", "image_url", "thumb_url", "card_url")
+
+_encoded = OrderedDict()   # (etag, coding) -> 壓好的 body
+_encoded_lock = threading.Lock()
+
+
+def _suggestion_cells(s):
+    """suggested / conflict / near 三欄（見 main.propagation）"""
+    if s is None:
+        return [None, False, False]
+    return [s.combo, s.conflict, not s.exact]
+
+
+def batch_payload(num_tasks_with_annotations: int, tasks, stale: bool = False, suggestions=None) -> dict:
+    suggestions = suggestions or {}
+    rows = [[t.task_id, t.inner_id, t.query, t.it_name, images.proxy_url(t.image_url, "card"),
+             *_suggestion_cells(suggestions.get(t.task_id))] for t in tasks]
+    return {
+        "annotations": int(num_tasks_with_annotations) + 1,
+        "stale": stale,
+        "fields": BATCH_FIELDS,
+        "rows": rows,
+    }
+
+
+def history_payload(rows, start_inner_id: int, start_ann_num: int, stale: bool = False) -> dict:
+    """rows 是 [TaskRow, ...]；inner_id / 編號跟 views.number_rows 一樣依起點依序編"""
+    return {
+        "annotations": start_ann_num + 1,
+        "inner_id": start_inner_id + 1,
+        "stale": stale,
+        "fields": HISTORY_FIELDS,
+        "rows": [
+            [r.task_id, start_inner_id + i, start_ann_num + 1 + i, r.rating, r.relation, r.query, r.it_name,
+             r.image_url, images.proxy_url(r.image_url, "thumb"), images.proxy_url(r.image_url, "card")]
+            for i, r in enumerate(rows)
+        ],
+    }
+
+
+def etag(body: bytes) -> str:
+    return 'W/"%s"' % hashlib.blake2b(body, digest_size=12).hexdigest()
+
+
+def _matches(request, tag: str) -> bool:
+    header = request.headers.get("If-None-Match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    # 弱比較：W/ 前綴不算
+    opaque = tag.removeprefix("W/")
+    return any(t.strip().removeprefix("W/") == opaque for t in header.split(","))
+
+
+def negotiate(request):
+    """回傳要用的 Content-Encoding（br / gzip），都不接受就 None"""
+    accepted = {}
+    for part in request.headers.get("Accept-Encoding", "").split(","):
+        coding, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if coding:
+            accepted[coding.lower()] = q
+    for coding in (("br", "gzip") if brotli is not None else ("gzip",)):
+        if accepted.get(coding, accepted.get("*", 0)) > 0:
+            return coding
+    return None
+
+
+def _compress(body: bytes, coding: str) -> bytes:
+    if coding == "br":
+        return brotli.compress(body, quality=5)
+    # mtime=0：同樣的內容壓出同樣的 bytes
+    return gzip.compress(body, compresslevel=6, mtime=0)
+
+
+def _encoded_body(body: bytes, tag: str, coding: str) -> bytes:
+    key = (tag, coding)
+    with _encoded_lock:
+        hit = _encoded.get(key)
+        if hit is not None:
+            _encoded.move_to_end(key)
+            return hit
+    out = _compress(body, coding)
+    with _encoded_lock:
+        _encoded[key] = out
+        while len(_encoded) > _ENCODED_CACHE_SIZE:
+            _encoded.popitem(last=False)
+    return out
+
+
+def _cache_headers(resp, tag: str):
+    resp["ETag"] = tag
+    resp["Vary"] = "Accept-Encoding"
+    # 每次都要回來問（可能有人剛標完），但沒變就只拿 304
+    resp["Cache-Control"] = "private, no-cache"
+    return resp
+
+
+def json_response(request, payload):
+    body = dumps(payload)
+    tag = etag(body)
+    if _matches(request, tag):
+        return _cache_headers(HttpResponseNotModified(), tag)
+    coding = negotiate(request) if len(body) >= COMPRESS_MIN_BYTES else None
+    if coding:
+        body = _encoded_body(body, tag, coding)
+    resp = HttpResponse(body, content_type="application/json")
+    if coding:
+        resp["Content-Encoding"] = coding
+    return _cache_headers(resp, tag)
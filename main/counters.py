@@ -0,0 +1,84 @@
+"""專案計數（num_tasks_with_annotations 等）的短期快取
+
+每個 index / table 頁面都要 GET /api/projects/<id> 拿已標註數，但這個數字只有在有人
+送出標註時才會變。快取 COUNTERS_TTL 秒；自己送出成功就直接在本地加上去，
+別人（其他 worker / 直接在 Label Studio 上標的人）的進度最晚 TTL 秒後跟上。
+"""
+import threading
+import time
+
+from django.conf import settings
+
+from . import metrics
+
+COUNTERS_TTL = float(getattr(settings, "LABEL_STUDIO_COUNTERS_TTL", 10))
+
+LOOKUPS = metrics.counter(
+    "ls_project_counters_lookups_total", "Project counter lookups, by result (hit / miss)", ("result",))
+
+
+class ProjectCounters:
+
+    def __init__(self, ttl: float = COUNTERS_TTL):
+        self.ttl = ttl
+        self._entries = {}   # project_id -> (抓到的時間, dict)
+        # 每次本地加減就 +1；抓的途中有人送出，抓回來的數字可能沒算到，存進去但標成過期
+        self._generation = {}
+        self._lock = threading.Lock()
+
+    def cached(self, project_id):
+        with self._lock:
+            hit = self._entries.get(project_id)
+            if hit is None or time.monotonic() - hit[0] > self.ttl:
+                return None
+            return dict(hit[1])
+
+    def _begin(self, project_id):
+        with self._lock:
+            return self._generation.get(project_id, 0)
+
+    def _store(self, project_id, value: dict, generation: int):
+        with self._lock:
+            fetched_at = time.monotonic() if self._generation.get(project_id, 0) == generation else 0.0
+            self._entries[project_id] = (fetched_at, dict(value))
+
+    def get(self, project_id, load):
+        """load() 回傳專案 JSON（dict）；快取還新鮮就不打上游"""
+        value = self.cached(project_id)
+        if value is not None:
+            LOOKUPS.inc("hit")
+            return value
+        LOOKUPS.inc("miss")
+        generation = self._begin(project_id)
+        value = load()
+        self._store(project_id, value, generation)
+        return dict(value)
+
+    async def aget(self, project_id, load):
+        """get 的 async 版；load 是 coroutine function"""
+        value = self.cached(project_id)
+        if value is not None:
+            LOOKUPS.inc("hit")
+            return value
+        LOOKUPS.inc("miss")
+        generation = self._begin(project_id)
+        value = await load()
+        self._store(project_id, value, generation)
+        return dict(value)
+
+    def add(self, project_id, n: int, field: str = "num_tasks_with_annotations"):
+        """自己送出成功 n 筆：直接更新快取裡的數字"""
+        if not n:
+            return
+        with self._lock:
+            self._generation[project_id] = self._generation.get(project_id, 0) + 1
+            hit = self._entries.get(project_id)
+            if hit is not None:
+                hit[1][field] = int(hit[1].get(field) or 0) + n
+
+    def invalidate(self, project_id):
+        with self._lock:
+            self._entries.pop(project_id, None)
+
+
+project_counters = ProjectCounters()
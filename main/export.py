@@ -0,0 +1,122 @@
+"""標註結果的串流匯出（NDJSON / CSV）
+
+沿著 inner_id 游標一頁一頁往後走（get_unlabeled_task），寫出目前這頁的同時
+在背景抓下一頁；任何時候記憶體裡最多兩頁，跟 project 大小無關。每一列都帶
+inner_id，中斷後用最後一列的 inner_id 當 after 就能接著匯出。
+"""
+import csv
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from . import projects
+from .rows import dumps
+
+FIELDS = ("task_id", "inner_id", "query", "IT_NAME", "image_url", "rating", "relation")
+# Label Studio 一頁最多回 100 筆，要再多也還是 100
+MAX_PAGE = 100
+EXPORT_PAGE = min(int(getattr(settings, "LABEL_STUDIO_EXPORT_PAGE", MAX_PAGE)), MAX_PAGE)
+FORMATS = ("ndjson", "csv")
+
+
+def iter_task_pages(project_id: int, after: int = 0, page: int = EXPORT_PAGE):
+    """inner_id 大於 after 的 task，一次 yield 一頁；下一頁在背景先抓
+
+    上游可能回比 page 少的筆數（每頁上限），所以只有拿到空頁才算走完。
+    """
+    from .views import get_access_token, get_unlabeled_task
+
+    project = projects.get(project_id)
+
+    def fetch(cursor):
+        # 匯出可能跑很久，每頁重新拿 token（快取內不會真的去 refresh）
+        return get_unlabeled_task(project, get_access_token(project), cursor, page)
+
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="export") as executor:
+        pending = executor.submit(fetch, after)
+        while pending is not None:
+            tasks = pending.result()
+            if not tasks:
+                return
+            pending = executor.submit(fetch, tasks[-1].inner_id)
+            yield tasks
+
+
+def iter_rows(project_id: int, after: int = 0, labeled_only: bool = True, page: int = EXPORT_PAGE):
+    """[TaskRow, ...] 一列一列 yield"""
+    for tasks in iter_task_pages(project_id, after, page):
+        for task in tasks:
+            if labeled_only and task.rating is None:
+                continue
+            yield task
+
+
+def row_values(row):
+    """TaskRow → 依 FIELDS 順序的值"""
+    return (row.task_id, row.inner_id, row.query, row.it_name, row.image_url, row.rating, row.relation)
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield dumps(dict(zip(FIELDS, row_values(row)))).decode("utf-8") + "\n"
+
+
+class _Echo:
+    """csv.writer 的假檔案：write 直接回傳那一行"""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows, header: bool = True):
+    writer = csv.writer(_Echo())
+    if header:
+        yield writer.writerow(FIELDS)
+    for row in rows:
+        yield writer.writerow(["" if v is None else v for v in row_values(row)])
+
+
+def encode(rows, fmt: str, header: bool = True):
+    return csv_lines(rows, header) if fmt == "csv" else ndjson_lines(rows)
+
+
+def trim_partial(path):
+    """上次中斷時可能寫到一半：把最後一個換行之後的殘行砍掉"""
+    try:
+        with open(path, "rb+") as f:
+            f.seek(0, 2)
+            size = f.tell()
+            if size == 0:
+                return
+            f.seek(max(0, size - 64 * 1024))
+            tail = f.read()
+            if tail.endswith(b"\n"):
+                return
+            cut = tail.rfind(b"\n")
+            f.truncate(size - len(tail) + cut + 1 if cut >= 0 else max(0, size - len(tail)))
+    except FileNotFoundError:
+        return
+
+
+def last_inner_id(path, fmt: str):
+    """已匯出檔案最後一列的 inner_id（續傳用）；檔案不存在或是空的回傳 None"""
+    try:
+        with open(path, "rb") as f:
+            f.seek(0, 2)
+            size = f.tell()
+            # 只讀檔尾，大檔案也不用整個載入
+            f.seek(max(0, size - 64 * 1024))
+            tail = f.read().decode("utf-8", errors="ignore")
+    except FileNotFoundError:
+        return None
+    lines = [ln for ln in tail.splitlines() if ln.strip()]
+    if not lines:
+        return None
+    last = lines[-1]
+    if fmt == "csv":
+        values = next(csv.reader([last]))
+        if values == list(FIELDS):
+            return None
+        return int(values[FIELDS.index("inner_id")])
+    return int(json.loads(last)["inner_id"])
@@ -0,0 +1,89 @@
+"""組頁面用的小型相依圖
+
+每一步宣告自己依賴哪幾步：依賴都好了就送出，彼此沒有相依的同時跑，
+沒被要到（也不是別人依賴）的步驟直接不跑。index 的「下一個 task 游標」和
+「專案計數」互不相依，一起送；task 查詢只等游標，不等計數。頁面延遲因此接近
+最慢那條相依鏈，而不是所有上游呼叫的總和。
+
+    steps = {
+        "cursor": ((), lambda: ...),
+        "counters": ((), lambda: ...),
+        "tasks": (("cursor",), lambda cursor: ...),
+    }
+    out = resolve(steps, ("tasks", "counters"))
+"""
+import asyncio
+import contextvars
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .throttle import POOL_SIZE
+
+# 上游並行數由 throttle 控制，這裡的 thread 只是等 I/O
+_executor = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix="fanin")
+
+
+def needed(steps, want):
+    """want 與它們遞移依賴到的步驟，依相依順序排好"""
+    order, seen = [], set()
+
+    def visit(name, path=()):
+        if name in seen:
+            return
+        if name in path:
+            raise ValueError(f"dependency cycle: {' -> '.join(path + (name,))}")
+        for dep in steps[name][0]:
+            visit(dep, path + (name,))
+        seen.add(name)
+        order.append(name)
+
+    for name in want:
+        visit(name)
+    return order
+
+
+def resolve(steps, want, executor=None):
+    """同步版：回傳 {步驟名稱: 結果}（只含 want）；任何一步失敗就丟出它的例外
+
+    executor 沒給就用共用的；每個專案有自己的一個，慢的專案不會把別人的步驟卡在排隊
+    """
+    executor = executor or _executor
+    waiting = needed(steps, want)
+    done, running = {}, {}
+    while waiting or running:
+        ready = [n for n in waiting if all(d in done for d in steps[n][0])]
+        for name in ready:
+            waiting.remove(name)
+        if len(ready) == 1 and not running:
+            # 只剩一條鏈就在目前的 thread 跑，省一次換手
+            name = ready[0]
+            deps, fn = steps[name]
+            done[name] = fn(*(done[d] for d in deps))
+            continue
+        for name in ready:
+            deps, fn = steps[name]
+            # 帶著呼叫端的 contextvars，各步驟的時間也算進這個 request 的 Server-Timing
+            ctx = contextvars.copy_context()
+            running[executor.submit(ctx.run, fn, *(done[d] for d in deps))] = name
+        finished, _ = wait(running, return_when=FIRST_COMPLETED)
+        for fut in finished:
+            done[running.pop(fut)] = fut.result()
+    return {name: done[name] for name in want}
+
+
+async def aresolve(steps, want):
+    """async 版：每一步的 fn 是 coroutine function"""
+    tasks = {}
+
+    async def run(name):
+        deps, fn = steps[name]
+        return await fn(*[await tasks[d] for d in deps])
+
+    for name in needed(steps, want):
+        tasks[name] = asyncio.ensure_future(run(name))
+    try:
+        results = await asyncio.gather(*(tasks[name] for name in want))
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        raise
+    return dict(zip(want, results))
@@ -0,0 +1,63 @@
+"""table 歷史紀錄的分頁快取
+
+頁以起點 inner_id 為 key（keyset），存在 LRU 裡並有 TTL；edit_task / 批次寫入改到
+某個 task 時，把含有它的頁丟掉。使用者往某個方向翻時，順便在背景把下一頁抓好。
+過了 TTL 的頁在上游慢或掛掉時仍可以先拿來顯示（stale-while-revalidate）。
+快取在每個 process 內各自一份，跨 worker 的一致性靠 TTL 兜底。
+"""
+from django.conf import settings
+
+from .stale import StaleCache
+
+HISTORY_CACHE_PAGES = int(getattr(settings, "LABEL_STUDIO_HISTORY_CACHE_PAGES", 64))
+HISTORY_CACHE_TTL = float(getattr(settings, "LABEL_STUDIO_HISTORY_CACHE_TTL", 300))
+
+
+class HistoryPageCache(StaleCache):
+
+    def __init__(self, executor, max_pages: int = HISTORY_CACHE_PAGES, ttl: float = HISTORY_CACHE_TTL):
+        # 過了 TTL 的頁不馬上丟：上游慢或掛掉時還能先拿來顯示（見 main.stale）
+        super().__init__("history", executor, fresh=ttl, max_entries=max_pages)
+        self._by_task = {}            # task_id -> {(project_id, start_inner_id), ...}
+
+    def get(self, project_id: int, start_inner_id: int):
+        return super().get((project_id, start_inner_id))
+
+    def put(self, project_id: int, start_inner_id: int, rows):
+        super().put((project_id, start_inner_id), rows)
+
+    def serve(self, project_id: int, start_inner_id: int, load):
+        """(rows, 是不是舊資料)；load() 回傳該頁 rows"""
+        return self.lookup((project_id, start_inner_id), load)
+
+    async def aserve(self, project_id: int, start_inner_id: int, load, background=None):
+        return await self.alookup((project_id, start_inner_id), load, background)
+
+    def _stored(self, key, rows):
+        for row in rows:
+            self._by_task.setdefault(row.task_id, set()).add(key)
+
+    def _dropped(self, key, rows):
+        for row in rows:
+            keys = self._by_task.get(row.task_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_task[row.task_id]
+
+    def invalidate_task(self, task_id):
+        """改過的 task 所在的頁整頁丟掉（連舊資料都不留，免得退回時顯示改之前的標註）"""
+        try:
+            task_id = int(task_id)
+        except (TypeError, ValueError):
+            return
+        with self._lock:
+            for key in list(self._by_task.get(task_id, ())):
+                if key in self._entries:
+                    self._drop(key)
+
+    def prefetch(self, project_id: int, start_inner_id: int, load):
+        """背景把 start_inner_id 那一頁放進快取；load() 回傳該頁 rows"""
+        if self.get(project_id, start_inner_id) is not None:
+            return
+        self.refresh((project_id, start_inner_id), load)
@@ -0,0 +1,283 @@
+"""商品圖的縮圖代理與磁碟快取
+
+每個 image_url 只從遠端抓一次，原圖以內容的 sha256 存檔（content-addressed），
+再依需要產生 thumb / card 兩種尺寸。回應帶固定的 ETag 與一年的 Cache-Control，
+瀏覽器之後連 304 都很少需要。快取總大小超過上限時，依最後存取時間淘汰。
+
+縮圖需要 Pillow；沒裝時照樣快取並回傳原圖。
+"""
+import hashlib
+from io import BytesIO
+import logging
+import os
+import threading
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+from django.conf import settings
+from django.core import signing
+from django.db import close_old_connections
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseNotModified
+from django.urls import reverse
+
+try:
+    from PIL import Image
+except ImportError:  # 沒有 Pillow 就不縮圖
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = Path(getattr(settings, "LABEL_STUDIO_IMAGE_CACHE_DIR", Path(settings.BASE_DIR) / "image_cache"))
+CACHE_MAX_BYTES = int(getattr(settings, "LABEL_STUDIO_IMAGE_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+FETCH_TIMEOUT = (5, 20)
+MAX_SOURCE_BYTES = 20 * 1024 * 1024
+# 名稱 → 最長邊像素
+SIZES = {"thumb": 120, "card": 480}
+SIGN_SALT = "main.images"
+
+_session = requests.Session()
+_warm_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="image-warm")
+# 快取檔的查詢與改名用的 lock；lock striping，數量固定不會越長越多。遠端抓圖不在 lock 裡
+_LOCK_STRIPES = 64
+_locks = [threading.Lock() for _ in range(_LOCK_STRIPES)]
+# 正在從遠端抓的 url → Future：同一個 url 同時只抓一次，其他人等同一個結果
+_fetching = {}
+_fetching_lock = threading.Lock()
+_evict_lock = threading.Lock()
+_written_since_evict = 0
+
+
+def _lock_for(key: str) -> threading.Lock:
+    return _locks[zlib.crc32(key.encode("utf-8")) % _LOCK_STRIPES]
+
+
+_signer = signing.Signer(salt=SIGN_SALT)
+
+
+def sign(url: str) -> str:
+    # 不帶時間戳：同一張圖永遠是同一個網址，瀏覽器快取與 /api/ 的 ETag 才穩定
+    return _signer.sign_object(url, compress=True)
+
+
+def unsign(token: str) -> str:
+    return _signer.unsign_object(token)
+
+
+def proxy_url(url: str, size: str = "thumb") -> str:
+    """模板與 JSON 用：原圖網址 → 代理網址；不是 http(s) 就原樣返回"""
+    if not url or not str(url).startswith(("http://", "https://")):
+        return url or ""
+    return reverse("image_proxy", args=[size, sign(str(url))])
+
+
+def _url_key(url: str) -> str:
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+
+def _paths(digest: str):
+    d = CACHE_DIR / digest[:2]
+    return d, d / digest
+
+
+def _touch(path: Path):
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def _write(path: Path, data: bytes):
+    global _written_since_evict
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + f".{threading.get_ident()}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+    with _evict_lock:
+        _written_since_evict += len(data)
+        due = _written_since_evict > CACHE_MAX_BYTES // 20
+        if due:
+            _written_since_evict = 0
+    if due:
+        evict(keep=path)
+
+
+def _cached_digest(url_ref: Path):
+    """url 索引指到的原圖還在就回傳它的 sha256，否則 None"""
+    try:
+        digest = url_ref.read_text().strip()
+    except OSError:
+        return None
+    return digest if digest and _paths(digest)[1].exists() else None
+
+
+def _fetch(url: str, url_ref: Path) -> str:
+    # stream=True 的回應要關掉，連線才會回到連線池
+    with _session.get(url, timeout=FETCH_TIMEOUT, stream=True) as r:
+        r.raise_for_status()
+        data = r.raw.read(MAX_SOURCE_BYTES + 1, decode_content=True)
+    if len(data) > MAX_SOURCE_BYTES:
+        raise ValueError("image too large")
+    digest = hashlib.sha256(data).hexdigest()
+    _, blob = _paths(digest)
+    if not blob.exists():
+        _write(blob, data)
+    url_ref.parent.mkdir(parents=True, exist_ok=True)
+    tmp = url_ref.with_name(url_ref.name + f".{threading.get_ident()}.tmp")
+    tmp.write_text(digest)
+    with _lock_for(url):
+        os.replace(tmp, url_ref)
+    return digest
+
+
+def source_digest(url: str) -> str:
+    """確保原圖在快取裡；回傳內容 sha256"""
+    url_ref = CACHE_DIR / "urls" / _url_key(url)
+    with _lock_for(url):
+        digest = _cached_digest(url_ref)
+    if digest is not None:
+        return digest
+
+    with _fetching_lock:
+        fut = _fetching.get(url)
+        fetching = fut is None
+        if fetching:
+            fut = _fetching[url] = Future()
+    if not fetching:
+        # 別人正在抓同一張：等它的結果（抓失敗就一起拿到同一個例外）
+        return fut.result()
+    try:
+        digest = _cached_digest(url_ref) or _fetch(url, url_ref)
+        fut.set_result(digest)
+        return digest
+    except BaseException as e:
+        fut.set_exception(e)
+        raise
+    finally:
+        with _fetching_lock:
+            _fetching.pop(url, None)
+
+
+def variant(digest: str, size: str):
+    """回傳 (檔案路徑, content-type)；沒有 Pillow 或縮圖失敗就回原圖"""
+    _, blob = _paths(digest)
+    if Image is None:
+        return blob, None
+    out = blob.with_name(f"{digest}_{size}.jpg")
+    if out.exists():
+        return out, "image/jpeg"
+    with _lock_for(str(out)):
+        if not out.exists():
+            try:
+                with Image.open(blob) as im:
+                    im = im.convert("RGB")
+                    im.thumbnail((SIZES[size], SIZES[size]))
+                    buf = BytesIO()
+                    im.save(buf, "JPEG", quality=82, optimize=True, progressive=True)
+                _write(out, buf.getvalue())
+            except Exception as e:
+                logger.warning("thumbnail %s/%s failed: %s", digest, size, e)
+                return blob, None
+    return out, "image/jpeg"
+
+
+def _sniff(body: bytes) -> str:
+    head = body[:12]
+    if head.startswith(b"\xff\xd8"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG"):
+        return "image/png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head.startswith(b"GIF8"):
+        return "image/gif"
+    return "application/octet-stream"
+
+
+def evict(keep: Path = None):
+    """總大小超過上限就從最久沒用的檔案開始刪（對應的 url 索引下次會自動重抓）"""
+    files = []
+    total = 0
+    for p in CACHE_DIR.glob("[0-9a-f][0-9a-f]/*"):
+        try:
+            st = p.stat()
+        except OSError:
+            continue
+        files.append((st.st_mtime, st.st_size, p))
+        total += st.st_size
+    if total <= CACHE_MAX_BYTES:
+        return
+    files.sort()
+    target = CACHE_MAX_BYTES * 0.9
+    for _, size, p in files:
+        if p == keep:
+            continue
+        try:
+            p.unlink()
+        except OSError:
+            continue
+        total -= size
+        if total <= target:
+            break
+
+
+def warm(load, sizes=("card", "thumb")):
+    """背景先把一批圖抓好、縮好（預抓下一批時用）；load() 回傳原圖網址"""
+    _warm_executor.submit(_warm_all, load, sizes)
+
+
+def _warm_all(load, sizes):
+    try:
+        # load() 可能讀鏡像，這條 thread 的 DB 連線要自己顧
+        close_old_connections()
+        urls = list(dict.fromkeys(u for u in load() if u and str(u).startswith(("http://", "https://"))))
+    except Exception as e:
+        logger.warning("image warm-up failed: %s", e)
+        return
+    for url in urls:
+        try:
+            digest = source_digest(str(url))
+            for size in sizes:
+                variant(digest, size)
+        except Exception as e:
+            logger.debug("warm %s failed: %s", url, e)
+
+
+def _read_variant(digest: str, size: str):
+    path, ctype = variant(digest, size)
+    _touch(path)
+    body = path.read_bytes()
+    return body, ctype or _sniff(body)
+
+
+def serve(request, size: str, token: str):
+    if size not in SIZES:
+        raise Http404("unknown size")
+    try:
+        url = unsign(token)
+    except (signing.BadSignature, ValueError):
+        return HttpResponseBadRequest("bad image token")
+
+    try:
+        digest = source_digest(url)
+    except (requests.RequestException, ValueError) as e:
+        return HttpResponse(f"image fetch failed: {e}", status=502)
+
+    etag = f'"{digest[:32]}-{size}"'
+    if etag in (request.headers.get("If-None-Match") or ""):
+        resp = HttpResponseNotModified()
+    else:
+        try:
+            body, ctype = _read_variant(digest, size)
+        except FileNotFoundError:
+            # 剛好被 evict 掉：重抓一次
+            try:
+                body, ctype = _read_variant(source_digest(url), size)
+            except (requests.RequestException, ValueError, OSError) as e:
+                return HttpResponse(f"image fetch failed: {e}", status=502)
+        resp = HttpResponse(body, content_type=ctype)
+    # 內容以 sha256 定址，網址不變內容就不會變
+    resp["ETag"] = etag
+    resp["Cache-Control"] = "public, max-age=31536000, immutable"
+    return resp
@@ -0,0 +1,274 @@
+"""離線標註檔的串流匯入（manage.py import_labels）
+
+CSV（要有表頭）或 NDJSON，一列一筆：task_id 或 inner_id，加上 rating、relation
+（也認 num / aux；export 匯出的檔案可以直接匯回來）。檔案一列一列讀，記憶體裡最多
+幾個 chunk，跟檔案大小無關。
+
+- 驗證跟 index POST 一樣（views.validate_annotation：relation 可寫全名）
+- 寫入跟 edit_bulk 一樣（views.apply_edits）：task 已有 annotation 就 PATCH，沒有就新建，
+  還在 outbox 裡的就改 outbox 那一筆
+- chunk 平行送，最多 parallel 個 chunk 同時在跑；上游的並行數另外受專案的 AIMD 上限管。
+  同一個 task 出現在好幾列時以檔案裡最後一列為準（同 chunk 只送最後一列，跨 chunk 就等前面的寫完；
+  比對的是解析成 task_id 之後的結果，一列寫 task_id、另一列寫 inner_id 也認得是同一個 task）
+- 每做完一段連續的 chunk 就把「前幾列已處理」寫進 checkpoint 檔，中斷後從那裡接著跑
+"""
+import csv
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.db import close_old_connections, connection
+
+from .models import Task
+from .rows import dumps
+
+FORMATS = ("csv", "ndjson")
+CHUNK_SIZE = 200
+# inner_id 換 task_id 時一次向上游要幾筆
+RESOLVE_PAGE = 500
+
+_ALIASES = {"num": "rating", "aux": "relation", "id": "task_id"}
+
+
+def detect_format(path: str) -> str:
+    return "csv" if path.lower().endswith(".csv") else "ndjson"
+
+
+def _parse_line(line: str):
+    try:
+        return json.loads(line)
+    except ValueError:
+        return line.strip()     # 留給 prepare_chunk 記成那一列的錯誤
+
+
+def iter_records(path: str, fmt: str, skip: int = 0):
+    """(第幾列, dict)，第幾列從 1 起算、不含表頭；前 skip 列直接跳過，NDJSON 的空行不算錯"""
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        if fmt == "csv":
+            rows = csv.DictReader(f)
+        else:
+            rows = (_parse_line(line) if line.strip() else None for line in f)
+        for n, row in enumerate(rows, start=1):
+            if n <= skip or row is None:
+                continue
+            yield n, row
+
+
+def normalize_record(row):
+    """一列 → {"task_id", "inner_id", "rating", "relation"}（值還沒驗證）"""
+    if not isinstance(row, dict):
+        return {}
+    out = {}
+    for key, value in row.items():
+        key = _ALIASES.get(str(key).strip(), str(key).strip())
+        if key in ("task_id", "inner_id", "rating", "relation") and value not in (None, ""):
+            out.setdefault(key, value)
+    return out
+
+
+def resolve_inner_ids(project, token, inner_ids) -> dict:
+    """{inner_id: task_id}；鏡像模式查本地，否則沿 inner_id 向上游翻頁"""
+    from . import mirror
+    from .views import MIRROR, get_unlabeled_task
+
+    wanted = sorted(set(inner_ids))
+    if not wanted:
+        return {}
+    if MIRROR:
+        mirror.ensure_fresh(project.project_id)
+        return dict(Task.objects.filter(project_id=project.project_id, inner_id__in=wanted)
+                    .values_list("inner_id", "task_id"))
+    out = {}
+    cursor, last = wanted[0] - 1, wanted[-1]
+    pending = set(wanted)
+    while pending and cursor < last:
+        tasks = get_unlabeled_task(project, token, cursor, min(RESOLVE_PAGE, last - cursor))
+        if not tasks:
+            break
+        for t in tasks:
+            if t.inner_id in pending:
+                out[t.inner_id] = t.task_id
+                pending.discard(t.inner_id)
+        cursor = max(cursor + 1, max(t.inner_id or cursor for t in tasks))
+        # 跳過中間沒有要的那一大段
+        nxt = min(pending, default=None)
+        if nxt is not None and nxt - 1 > cursor:
+            cursor = nxt - 1
+    return out
+
+
+def prepare_chunk(project, token, records):
+    """[(第幾列, dict)] → (edit_bulk 格式的 rows, 每個 task_id 對應的列號, 不合法的 [(列號, 原因)])"""
+    from .views import validate_annotation
+
+    parsed, errors, inner_ids = [], [], []
+    for n, row in records:
+        if isinstance(row, str):
+            errors.append((n, "不是合法的 JSON"))
+            continue
+        rec = normalize_record(row)
+        ref = rec.get("task_id") or rec.get("inner_id")
+        if ref is None:
+            errors.append((n, "缺 task_id / inner_id"))
+            continue
+        # task_id 先用 1 佔位，只借 validate_annotation 驗 rating / relation
+        _, rating, relation, err = validate_annotation(1, rec.get("rating"), rec.get("relation"))
+        if err:
+            errors.append((n, err))
+            continue
+        try:
+            task_id = int(rec["task_id"]) if rec.get("task_id") is not None else None
+            inner_id = int(rec["inner_id"]) if rec.get("inner_id") is not None else None
+        except (TypeError, ValueError):
+            errors.append((n, f"task_id / inner_id 非整數：{ref!r}"))
+            continue
+        if task_id is None:
+            inner_ids.append(inner_id)
+        parsed.append((n, task_id, inner_id, rating, relation))
+
+    by_inner = resolve_inner_ids(project, token, inner_ids) if inner_ids else {}
+    rows, lines = {}, {}
+    for n, task_id, inner_id, rating, relation in parsed:
+        if task_id is None:
+            task_id = by_inner.get(inner_id)
+            if task_id is None:
+                errors.append((n, f"找不到 inner_id {inner_id}"))
+                continue
+        if task_id <= 0:
+            errors.append((n, f"task_id 不可為 0 或負數：{task_id}"))
+            continue
+        if task_id in rows:
+            # 同一個 chunk 裡同一個 task 出現兩次：後面那列為準
+            errors.append((lines[task_id], f"被第 {n} 列覆蓋"))
+        rows[task_id] = {"task_id": task_id, "inner_id": inner_id or 0, "rating": int(rating),
+                         "relation": relation, "lead_time": 0.0}
+        lines[task_id] = n
+    return list(rows.values()), lines, errors
+
+
+def import_chunk(project, prepared) -> dict:
+    """寫一個 prepare_chunk 過的 chunk；回傳 {"ok": n, "failed": [(列號, 原因), ...]}"""
+    from .views import apply_edits, get_access_token
+
+    rows, lines, failed = prepared
+    failed = list(failed)
+    close_old_connections()
+    try:
+        token = get_access_token(project)
+        ok = 0
+        for row in apply_edits(project, token, rows) if rows else []:
+            if row["ok"]:
+                ok += 1
+            else:
+                failed.append((lines[row["task_id"]], f'{row["status"]} {row.get("error") or ""} '
+                                                      f'{row.get("detail") or ""}'.strip()))
+        return {"ok": ok, "failed": sorted(failed)}
+    finally:
+        connection.close()
+
+
+class Checkpoint:
+    """{"done": 已處理到第幾列, "ok": 成功數, "failed": 失敗數}；每次寫入都先寫暫存檔再換名"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.done = self.ok = self.failed = 0
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        self.done = int(data.get("done") or 0)
+        self.ok = int(data.get("ok") or 0)
+        self.failed = int(data.get("failed") or 0)
+
+    def save(self):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"done": self.done, "ok": self.ok, "failed": self.failed}, f)
+        os.replace(tmp, self.path)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def _chunks(records, size: int):
+    chunk = []
+    for rec in records:
+        chunk.append(rec)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def run(project, path: str, fmt: str, checkpoint: Checkpoint, errors_out=None,
+        chunk_size: int = CHUNK_SIZE, parallel: int = 2, progress=None):
+    """從 checkpoint.done 之後接著匯入；每做完一段連續的 chunk 就更新 checkpoint
+
+    errors_out 是開好的文字檔，失敗的列以 NDJSON 寫進去（{"line", "error"}）；
+    progress(checkpoint) 在每次更新 checkpoint 後呼叫。
+    驗證與 inner_id → task_id 在這個 thread 依序做（前面的 chunk 同時在背景寫），
+    寫入才丟給 thread pool：送出前就知道每個 chunk 實際會寫哪些 task。
+    """
+    from .views import get_access_token
+
+    chunks = _chunks(iter_records(path, fmt, skip=checkpoint.done), chunk_size)
+    in_flight = {}      # future -> (chunk 編號, 最後一列的列號, 會寫到的 task_id)
+    finished = {}       # chunk 編號 -> (最後一列, 結果)；等前面的都做完才能推進 checkpoint
+    next_seq = 0        # 下一個要推進 checkpoint 的 chunk 編號
+
+    def advance():
+        nonlocal next_seq
+        moved = False
+        while next_seq in finished:
+            last, result = finished.pop(next_seq)
+            checkpoint.done = last
+            checkpoint.ok += result["ok"]
+            checkpoint.failed += len(result["failed"])
+            if errors_out is not None:
+                for n, error in result["failed"]:
+                    errors_out.write(dumps({"line": n, "error": error}).decode("utf-8") + "\n")
+            next_seq += 1
+            moved = True
+        if moved:
+            if errors_out is not None:
+                errors_out.flush()
+            checkpoint.save()
+            if progress is not None:
+                progress(checkpoint)
+
+    def collect(done):
+        for fut in done:
+            seq_, last, _ = in_flight.pop(fut)
+            finished[seq_] = (last, fut.result())
+        advance()
+
+    with ThreadPoolExecutor(max_workers=max(1, parallel), thread_name_prefix="import") as executor:
+        seq = 0
+        try:
+            for chunk in chunks:
+                prepared = prepare_chunk(project, get_access_token(project), chunk)
+                refs = {row["task_id"] for row in prepared[0]}
+                while len(in_flight) >= max(1, parallel):
+                    collect(wait(in_flight, return_when=FIRST_COMPLETED).done)
+                # 前面還在跑的 chunk 也寫同一個 task：等它寫完，檔案後面的列才會蓋過前面的
+                busy = [fut for fut, (_, _, other) in in_flight.items() if refs & other]
+                if busy:
+                    collect(wait(busy).done)
+                in_flight[executor.submit(import_chunk, project, prepared)] = (seq, chunk[-1][0], refs)
+                seq += 1
+        finally:
+            # 中斷（Ctrl-C）時也把已經在跑的做完並記下來，下次不會重送
+            for fut, (seq_, last, _) in sorted(in_flight.items(), key=lambda kv: kv[1][0]):
+                try:
+                    finished[seq_] = (last, fut.result())
+                except Exception:
+                    break
+            in_flight.clear()
+            advance()
+    return checkpoint
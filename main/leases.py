@@ -0,0 +1,95 @@
+"""每位標註者各自的 task 租約
+
+取代原本 process 全域的 task_ids：每個 session 拿到一段互不重疊的 inner_id 區間，
+TTL 內別人不會拿到同一段；POST 時用自己租約裡的 task id 對齊 batch。
+多個 gunicorn worker 共用同一張表，所以配置用「先寫入、再檢查重疊、id 小的贏」
+的樂觀做法，不依賴資料庫的 row lock。
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Lease
+
+LEASE_TTL = timedelta(seconds=int(getattr(settings, "LABEL_STUDIO_LEASE_TTL", 1800)))
+MAX_ATTEMPTS = 5
+
+
+def owner_key(request) -> str:
+    user = getattr(request, "user", None)
+    if user is not None and user.is_authenticated:
+        return f"user:{user.pk}"
+    if not request.session.session_key:
+        request.session.save()
+    return request.session.session_key
+
+
+def active(project_id: int):
+    return Lease.objects.filter(project_id=project_id, expires_at__gt=timezone.now())
+
+
+def current(project_id: int, owner: str):
+    return active(project_id).filter(owner=owner).order_by("-id").first()
+
+
+def _free_range(taken, first: int, size: int, next_unlabeled=None):
+    """從 first 開始找第一段沒被占用的區間，最長 size
+
+    next_unlabeled(x) 回傳 >= x 的第一個未標註 inner_id；跳過別人租約後，
+    後面那段可能早就被標完了，要靠它往前推。
+    """
+    start = first
+    while True:
+        if next_unlabeled is not None:
+            nxt = next_unlabeled(start)
+            start = start if nxt is None else max(start, nxt)
+        holder = next((l for l in taken if l.start_inner_id <= start <= l.end_inner_id), None)
+        if holder is None:
+            break
+        start = holder.end_inner_id + 1
+
+    end = start + size - 1
+    for lease in taken:
+        if start < lease.start_inner_id <= end:
+            # 下一段租約在 start 之後：中間的空檔夠用多少算多少
+            end = lease.start_inner_id - 1
+            break
+    return start, end
+
+
+def acquire(project_id: int, owner: str, first_inner_id: int, size: int, next_unlabeled=None) -> Lease:
+    """續用自己的租約，或配一段新的。first_inner_id 是目前第一個未標註的 inner_id"""
+    now = timezone.now()
+    mine = current(project_id, owner)
+    if mine is not None and mine.end_inner_id >= first_inner_id:
+        mine.expires_at = now + LEASE_TTL
+        mine.save(update_fields=["expires_at"])
+        return mine
+
+    # 順手回收過期的
+    Lease.objects.filter(project_id=project_id, expires_at__lte=now).delete()
+    Lease.objects.filter(project_id=project_id, owner=owner).delete()
+
+    for _ in range(MAX_ATTEMPTS):
+        taken = list(active(project_id).exclude(owner=owner).order_by("start_inner_id"))
+        start, end = _free_range(taken, first_inner_id, size, next_unlabeled)
+        lease = Lease.objects.create(project_id=project_id, owner=owner, start_inner_id=start,
+                                     end_inner_id=end, expires_at=now + LEASE_TTL)
+        clash = active(project_id).filter(
+            id__lt=lease.id, start_inner_id__lte=end, end_inner_id__gte=start,
+        ).exclude(owner=owner).exists()
+        if not clash:
+            return lease
+        # 別的 worker 同時搶到重疊的區間，先建立的那個贏，這邊重選
+        lease.delete()
+    raise RuntimeError("could not reserve a task range; too many concurrent annotators")
+
+
+def attach(lease: Lease, task_ids):
+    lease.task_ids = [int(t) for t in task_ids]
+    lease.save(update_fields=["task_ids"])
+
+
+def release(lease: Lease):
+    lease.delete()
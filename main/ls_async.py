@@ -0,0 +1,141 @@
+import asyncio
+import time
+import weakref
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from . import breaker, metrics, throttle
+from .ls_client import (DEFAULT_TIMEOUT, IDEMPOTENT, MAX_RETRIES, backoff_delay, build_url, retry_after_seconds,
+                        should_retry)
+
+try:
+    import httpx
+except ImportError:  # 只有開 async views 才需要
+    httpx = None
+
+# 單一 event loop 上同時打上游的最大數量（batch 寫入 fan-out 也受此限制）
+ASYNC_CONCURRENCY = int(getattr(settings, "LABEL_STUDIO_ASYNC_CONCURRENCY", 32))
+
+
+class AsyncLabelStudioClient:
+    """asyncio 版的 LabelStudioClient：同樣的重試與 401 換 token 規則，改用 httpx
+
+    httpx.AsyncClient 綁定在建立它的 event loop 上；WSGI 底下每個 async view
+    會各自開一個 loop，所以 client 與 semaphore 都以 loop 為 key 保存。
+    """
+
+    def __init__(self, base_url: str, tokens, concurrency: int = ASYNC_CONCURRENCY,
+                 timeout=DEFAULT_TIMEOUT, max_retries: int = MAX_RETRIES, limits=None, circuit=None):
+        if httpx is None:
+            raise ImproperlyConfigured("async views 需要安裝 httpx：pip install httpx")
+        self.base_url = base_url.rstrip("/")
+        self.tokens = tokens
+        self.concurrency = max(int(concurrency), 1)
+        connect, read = timeout
+        self.timeout = httpx.Timeout(read, connect=connect)
+        self.max_retries = max_retries
+        self.limits = limits or throttle.default
+        self.circuit = circuit or breaker.circuit
+        self._per_loop = weakref.WeakKeyDictionary()
+
+    def _state(self):
+        loop = asyncio.get_running_loop()
+        state = self._per_loop.get(loop)
+        if state is None:
+            client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.concurrency,
+                                    max_keepalive_connections=self.concurrency),
+                headers={"Content-Type": "application/json"},
+            )
+            state = (client, asyncio.Semaphore(self.concurrency))
+            self._per_loop[loop] = state
+        return state
+
+    async def token(self) -> str:
+        # 新鮮的 token 直接拿；要 refresh 才丟到 thread，不卡住 event loop
+        with metrics.phase("token"):
+            return self.tokens.cached() or await asyncio.to_thread(self.tokens.get)
+
+    async def _throttle(self):
+        """跟同一專案的 sync client 共用同一個 bucket / limiter；名額滿了就讓出 event loop 等"""
+        t0 = time.perf_counter()
+        wait = self.limits.bucket.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        while not self.limits.limiter.try_acquire():
+            await asyncio.sleep(throttle.POLL_INTERVAL)
+        throttle.THROTTLE_WAIT.observe(time.perf_counter() - t0)
+
+    async def request(self, method: str, path: str, token: str = None, **kwargs):
+        method = method.upper()
+        url = build_url(self.base_url, path)
+        extra = kwargs.pop("headers", None) or {}
+        client, sem = self._state()
+
+        token = token or await self.token()
+        refreshed = False
+        attempt = 0
+        while True:
+            headers = {"Authorization": f"Bearer {token}", **extra}
+            self.circuit.before_request()
+            try:
+                async with sem:
+                    await self._throttle()
+                    t0 = time.perf_counter()
+                    try:
+                        r = await client.request(method, url, headers=headers, **kwargs)
+                    except httpx.TransportError as e:
+                        # 連線、逾時、對方中途斷線、協定錯誤都算：跟 sync client 的 requests.ConnectionError 一樣記帳
+                        self.limits.after_request(type(e).__name__, time.perf_counter() - t0)
+                        self.circuit.record(type(e).__name__)
+                        raise
+                    except BaseException:
+                        # 被取消之類：只還名額，不算上游的帳
+                        self.limits.limiter.release()
+                        raise
+            except httpx.TransportError as e:
+                metrics.record_upstream(method, url, type(e).__name__, time.perf_counter() - t0)
+                if method not in IDEMPOTENT or attempt >= self.max_retries:
+                    raise
+                metrics.record_retry(method, url, "connection")
+                await asyncio.sleep(backoff_delay(attempt))
+                attempt += 1
+                continue
+            except BaseException:
+                # 排隊或送出時被取消：探測名額還回去
+                self.circuit.record(None)
+                raise
+            elapsed = time.perf_counter() - t0
+            self.limits.after_request(r.status_code, elapsed, retry_after_seconds(r))
+            self.circuit.record(r.status_code)
+            metrics.record_upstream(method, url, r.status_code, elapsed,
+                                    metrics.body_size(r.request.content), len(r.content))
+
+            if r.status_code == 401 and not refreshed:
+                metrics.record_retry(method, url, 401)
+                await asyncio.to_thread(self.tokens.invalidate, token)
+                token = await self.token()
+                refreshed = True
+                continue
+            if should_retry(method, r.status_code) and attempt < self.max_retries:
+                metrics.record_retry(method, url, r.status_code)
+                await asyncio.sleep(backoff_delay(attempt, r))
+                attempt += 1
+                continue
+            return r
+
+    async def get(self, path, token=None, **kwargs):
+        return await self.request("GET", path, token, **kwargs)
+
+    async def post(self, path, token=None, **kwargs):
+        return await self.request("POST", path, token, **kwargs)
+
+    async def patch(self, path, token=None, **kwargs):
+        return await self.request("PATCH", path, token, **kwargs)
+
+    async def aclose(self):
+        state = self._per_loop.pop(asyncio.get_running_loop(), None)
+        if state is not None:
+            await state[0].aclose()
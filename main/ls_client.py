@@ -0,0 +1,147 @@
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from . import breaker, metrics, throttle
+
+# (connect, read) 秒
+DEFAULT_TIMEOUT = tuple(getattr(settings, "LABEL_STUDIO_TIMEOUT", (5, 30)))
+MAX_RETRIES = int(getattr(settings, "LABEL_STUDIO_MAX_RETRIES", 3))
+BACKOFF_BASE = float(getattr(settings, "LABEL_STUDIO_BACKOFF_BASE", 0.5))
+BACKOFF_CAP = float(getattr(settings, "LABEL_STUDIO_BACKOFF_CAP", 10.0))
+
+IDEMPOTENT = {"GET", "HEAD", "OPTIONS", "PUT", "PATCH", "DELETE"}
+# 這兩個狀態代表上游根本沒處理，POST 也可以安全重送
+REJECTED = {429, 503}
+
+
+def retry_after_seconds(resp):
+    value = (resp.headers.get("Retry-After") or "").strip()
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def build_url(base_url: str, path: str) -> str:
+    path = str(path or "")
+    # 已是完整 URL：原樣返回
+    if path.startswith("http://") or path.startswith("https://"):
+        return path
+    p = path.lstrip("/")
+    # 沒帶 api/ 就自動補
+    if not p.startswith("api/"):
+        p = "api/" + p
+    return f"{base_url.rstrip('/')}/{p}"
+
+
+def should_retry(method: str, status: int) -> bool:
+    if status in REJECTED:
+        return True
+    return status >= 500 and method in IDEMPOTENT
+
+
+def backoff_delay(attempt: int, resp=None) -> float:
+    delay = retry_after_seconds(resp) if resp is not None else None
+    if delay is None:
+        # full jitter
+        delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * (2 ** attempt)))
+    return min(delay, BACKOFF_CAP)
+
+
+class LabelStudioClient:
+    """每個專案一個 keep-alive session，該專案的所有 view 與 worker thread 都走這裡
+
+    limits（throttle.Throttle）與 circuit（breaker.CircuitBreaker）沒給就用預設專案那一組。
+    """
+
+    def __init__(self, base_url: str, tokens, pool_size: int = 8, timeout=DEFAULT_TIMEOUT,
+                 max_retries: int = MAX_RETRIES, limits=None, circuit=None):
+        self.base_url = base_url.rstrip("/")
+        self.tokens = tokens
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.limits = limits or throttle.default
+        self.circuit = circuit or breaker.circuit
+
+        self.session = requests.Session()
+        # pool 至少要跟 limiter 的並行上限一樣大，否則多出來的連線用完就被丟掉
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(pool_size, 1), pool_block=False)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Content-Type": "application/json"})
+
+    def url(self, path: str) -> str:
+        return build_url(self.base_url, path)
+
+    def request(self, method: str, path: str, token: str = None, **kwargs):
+        method = method.upper()
+        url = self.url(path)
+        extra = kwargs.pop("headers", None) or {}
+        kwargs.setdefault("timeout", self.timeout)
+
+        token = token or self.tokens.get()
+        refreshed = False
+        attempt = 0
+        while True:
+            headers = {"Authorization": f"Bearer {token}", **extra}
+            # 斷路器開著就直接失敗；再來是這個專案共用的 rate limit 與 AIMD 並行上限（重試的 backoff 不佔名額）
+            self.circuit.before_request()
+            self.limits.before_request()
+            t0 = time.perf_counter()
+            try:
+                r = self.session.request(method, url, headers=headers, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                elapsed = time.perf_counter() - t0
+                self.limits.after_request(type(e).__name__, elapsed)
+                self.circuit.record(type(e).__name__)
+                metrics.record_upstream(method, url, type(e).__name__, elapsed)
+                # 連線層錯誤：只有冪等方法才重送
+                if method not in IDEMPOTENT or attempt >= self.max_retries:
+                    raise
+                metrics.record_retry(method, url, "connection")
+                time.sleep(backoff_delay(attempt))
+                attempt += 1
+                continue
+            except BaseException:
+                # 其他錯誤（參數錯、被中斷）：只還名額，不算上游的帳
+                self.limits.limiter.release()
+                self.circuit.record(None)
+                raise
+            elapsed = time.perf_counter() - t0
+            self.limits.after_request(r.status_code, elapsed, retry_after_seconds(r))
+            self.circuit.record(r.status_code)
+            metrics.record_upstream(method, url, r.status_code, elapsed,
+                                    metrics.body_size(r.request.body), len(r.content))
+
+            if r.status_code == 401 and not refreshed:
+                metrics.record_retry(method, url, 401)
+                self.tokens.invalidate(token)
+                token = self.tokens.get()
+                refreshed = True
+                continue
+            if should_retry(method, r.status_code) and attempt < self.max_retries:
+                metrics.record_retry(method, url, r.status_code)
+                time.sleep(backoff_delay(attempt, r))
+                attempt += 1
+                continue
+            return r
+
+    def get(self, path, token=None, **kwargs):
+        return self.request("GET", path, token, **kwargs)
+
+    def post(self, path, token=None, **kwargs):
+        return self.request("POST", path, token, **kwargs)
+
+    def patch(self, path, token=None, **kwargs):
+        return self.request("PATCH", path, token, **kwargs)
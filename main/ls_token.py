@@ -0,0 +1,124 @@
+import base64
+import hashlib
+import json
+import threading
+import time
+
+import requests
+from django.conf import settings
+from django.core.cache import caches
+
+from . import breaker, metrics
+
+# access token 到期前幾秒就先換新的，避免剛好在請求途中過期
+REFRESH_MARGIN = int(getattr(settings, "LABEL_STUDIO_TOKEN_REFRESH_MARGIN", 60))
+# 解不出 exp 時的保守存活時間（秒）
+FALLBACK_TTL = int(getattr(settings, "LABEL_STUDIO_TOKEN_FALLBACK_TTL", 240))
+# 設成 Django cache alias（例如 "default"）就讓所有 worker 共用同一顆 token；None 只用行程內快取
+CACHE_ALIAS = getattr(settings, "LABEL_STUDIO_TOKEN_CACHE", None)
+
+
+def decode_exp(access_token: str):
+    """從 JWT payload 讀出 exp（epoch 秒），讀不到回傳 None"""
+    try:
+        payload = access_token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload.encode("ascii"))).get("exp")
+        return float(exp) if exp is not None else None
+    except (IndexError, ValueError, TypeError, AttributeError):
+        return None
+
+
+class AccessTokenManager:
+
+    def __init__(self, ls_url: str, refresh_token: str, cache_alias=CACHE_ALIAS, timeout=15, session=None,
+                 circuit=None):
+        self.refresh_url = f"{ls_url.rstrip('/')}/api/token/refresh/"
+        self.refresh_token = refresh_token
+        self.cache_alias = cache_alias
+        self.cache_key = "ls-access:" + hashlib.sha1(f"{ls_url}|{refresh_token}".encode()).hexdigest()[:16]
+        self.timeout = timeout
+        self.http = session or requests
+        self.circuit = circuit or breaker.circuit
+
+        self._access = None
+        self._expires_at = 0.0
+        # 同一時間只允許一個 refresh，其他請求在 lock 上等結果
+        self._lock = threading.Lock()
+
+    def _fresh(self, expires_at) -> bool:
+        return expires_at - REFRESH_MARGIN > time.time()
+
+    def _cache(self):
+        return caches[self.cache_alias] if self.cache_alias else None
+
+    def _from_shared_cache(self):
+        cache = self._cache()
+        if cache is None:
+            return False
+        hit = cache.get(self.cache_key)
+        if not hit:
+            return False
+        access, expires_at = hit
+        if not self._fresh(expires_at):
+            return False
+        self._access, self._expires_at = access, expires_at
+        return True
+
+    def _refresh(self):
+        # 上游掛了就別每次都等滿 timeout
+        self.circuit.before_request()
+        t0 = time.perf_counter()
+        try:
+            r = self.http.post(self.refresh_url, json={"refresh": self.refresh_token}, timeout=self.timeout)
+        except requests.RequestException as e:
+            self.circuit.record(type(e).__name__)
+            metrics.record_upstream("POST", self.refresh_url, type(e).__name__, time.perf_counter() - t0)
+            raise
+        self.circuit.record(r.status_code)
+        metrics.record_upstream("POST", self.refresh_url, r.status_code, time.perf_counter() - t0,
+                                metrics.body_size(r.request.body), len(r.content))
+        r.raise_for_status()
+        access = r.json()["access"]
+
+        exp = decode_exp(access)
+        expires_at = exp if exp else time.time() + FALLBACK_TTL
+        self._access, self._expires_at = access, expires_at
+
+        cache = self._cache()
+        if cache is not None:
+            cache.set(self.cache_key, (access, expires_at), timeout=max(1, int(expires_at - time.time())))
+        return access
+
+    def cached(self):
+        """不打網路：手上的 token 還新鮮就回傳，否則 None"""
+        access, expires_at = self._access, self._expires_at
+        if access and self._fresh(expires_at):
+            return access
+        return None
+
+    def get(self) -> str:
+        # 快速路徑：不拿 lock
+        access = self.cached()
+        if access:
+            return access
+
+        with self._lock:
+            # 等 lock 的期間可能已經有人換好了
+            if self._access and self._fresh(self._expires_at):
+                return self._access
+            if self._from_shared_cache():
+                return self._access
+            return self._refresh()
+
+    def invalidate(self, access: str = None):
+        """上游回 401 時呼叫；只作廢同一顆 token，避免把別人剛換好的也丟掉"""
+        with self._lock:
+            if access is not None and access != self._access:
+                return
+            self._access, self._expires_at = None, 0.0
+            cache = self._cache()
+            if cache is not None:
+                hit = cache.get(self.cache_key)
+                if hit and (access is None or hit[0] == access):
+                    cache.delete(self.cache_key)
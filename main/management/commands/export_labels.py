@@ -0,0 +1,49 @@
+import os
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main import export, projects
+
+
+class Command(BaseCommand):
+    help = "把標註結果串流匯出成 NDJSON / CSV（--resume 從輸出檔最後一列接著跑）"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--project", type=int, default=projects.DEFAULT_PROJECT_ID,
+                            choices=[p.project_id for p in projects.registered()])
+        parser.add_argument("--format", choices=export.FORMATS, default="ndjson")
+        parser.add_argument("--output", "-o", help="輸出檔；不給就寫到 stdout")
+        parser.add_argument("--after", type=int, default=0, help="只匯出 inner_id 大於這個值的 task")
+        parser.add_argument("--resume", action="store_true", help="從 --output 既有內容的最後一列接著匯出")
+        parser.add_argument("--all", action="store_true", help="連未標註的 task 也匯出")
+
+    def handle(self, *args, **opts):
+        fmt = opts["format"]
+        after = opts["after"]
+        header = True
+        mode = "w"
+        if opts["resume"]:
+            if not opts["output"]:
+                raise CommandError("--resume 需要 --output")
+            export.trim_partial(opts["output"])
+            last = export.last_inner_id(opts["output"], fmt)
+            if last is not None:
+                after = max(after, last)
+                header = False
+            if os.path.exists(opts["output"]):
+                mode = "a"
+
+        out = open(opts["output"], mode, encoding="utf-8", newline="") if opts["output"] else sys.stdout
+        n = 0
+        try:
+            rows = export.iter_rows(opts["project"], after, labeled_only=not opts["all"])
+            for line in export.encode(rows, fmt, header):
+                out.write(line)
+                n += 1
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        if header and fmt == "csv":
+            n -= 1
+        self.stderr.write(f"exported {max(n, 0)} rows after inner_id {after}")
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from main import outbox
+
+
+class Command(BaseCommand):
+    help = "把 outbox 裡待送的 annotation 送到 Label Studio（可用 --every 持續執行）"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--every", type=float, default=0, help="每隔幾秒再跑一輪；0 表示送完就結束")
+
+    def handle(self, *args, **opts):
+        while True:
+            sent = 0
+            while True:
+                n = outbox.flush()
+                if not n:
+                    break
+                sent += n
+            counts = outbox.summary(limit=0)["counts"]
+            self.stdout.write(f"processed {sent}; pending {counts['pending']}, failed {counts['failed']}")
+            if not opts["every"]:
+                return
+            time.sleep(opts["every"])
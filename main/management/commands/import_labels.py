@@ -0,0 +1,50 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main import importer, projects
+
+
+class Command(BaseCommand):
+    help = "把離線標註檔（CSV / NDJSON：task_id 或 inner_id, rating, relation）匯入 Label Studio；中斷後重跑會從 checkpoint 接著做"
+
+    def add_arguments(self, parser):
+        parser.add_argument("input", help="CSV（要有表頭）或 NDJSON 檔")
+        parser.add_argument("--project", type=int, default=projects.DEFAULT_PROJECT_ID,
+                            choices=[p.project_id for p in projects.registered()])
+        parser.add_argument("--format", choices=importer.FORMATS, help="不給就看副檔名（.csv 以外都當 NDJSON）")
+        parser.add_argument("--checkpoint", help="進度檔；預設是 <input>.checkpoint.json")
+        parser.add_argument("--errors", help="失敗的列寫到這裡（NDJSON，附加）；預設是 <input>.errors.ndjson")
+        parser.add_argument("--chunk-size", type=int, default=importer.CHUNK_SIZE, help="一個 chunk 幾列")
+        parser.add_argument("--parallel", type=int, default=2, help="同時在送的 chunk 數")
+        parser.add_argument("--restart", action="store_true", help="忽略既有的 checkpoint，從頭匯入")
+
+    def handle(self, *args, **opts):
+        path = opts["input"]
+        if opts["chunk_size"] < 1 or opts["parallel"] < 1:
+            raise CommandError("--chunk-size 與 --parallel 至少要 1")
+        try:
+            open(path, "rb").close()
+        except OSError as e:
+            raise CommandError(str(e))
+        fmt = opts["format"] or importer.detect_format(path)
+        checkpoint = importer.Checkpoint(opts["checkpoint"] or f"{path}.checkpoint.json")
+        if opts["restart"]:
+            checkpoint.clear()
+            checkpoint = importer.Checkpoint(checkpoint.path)
+        if checkpoint.done:
+            self.stderr.write(f"resuming after line {checkpoint.done} (ok {checkpoint.ok}, failed {checkpoint.failed})")
+
+        def progress(cp):
+            self.stderr.write(f"line {cp.done}: ok {cp.ok}, failed {cp.failed}")
+
+        errors_path = opts["errors"] or f"{path}.errors.ndjson"
+        with open(errors_path, "a", encoding="utf-8") as errors_out:
+            try:
+                importer.run(projects.get(opts["project"]), path, fmt, checkpoint, errors_out,
+                             chunk_size=opts["chunk_size"], parallel=opts["parallel"], progress=progress)
+            except KeyboardInterrupt:
+                self.stderr.write(f"interrupted; rerun to resume after line {checkpoint.done}")
+                sys.exit(130)
+        self.stderr.write(f"imported {checkpoint.ok} rows, {checkpoint.failed} failed "
+                          f"(see {errors_path}); checkpoint {checkpoint.path}")
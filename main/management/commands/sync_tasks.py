@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from main import mirror, projects
+
+
+class Command(BaseCommand):
+    help = "把 Label Studio 的 task 增量同步到本地鏡像（可用 --every 持續執行）"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--project", type=int, default=projects.DEFAULT_PROJECT_ID,
+                            choices=[p.project_id for p in projects.registered()])
+        parser.add_argument("--every", type=int, default=0, help="每隔幾秒再同步一次；0 表示只跑一次")
+
+    def handle(self, *args, **opts):
+        while True:
+            stats = mirror.sync_project(opts["project"])
+            self.stdout.write(f"project {opts['project']}: {stats['new']} new, {stats['changed']} changed")
+            if not opts["every"]:
+                return
+            time.sleep(opts["every"])
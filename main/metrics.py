@@ -0,0 +1,286 @@
+"""上游呼叫與 view 的量測，輸出成 Prometheus 文字格式（GET /metrics）
+
+- 每個上游呼叫：依 endpoint 樣板 / method / status 記延遲直方圖、重試次數、請求與回應大小
+- 每個 view：總延遲，以及 token / cursor / fetch / render 各階段的延遲
+- 每個回應帶 Server-Timing header，瀏覽器 devtools 就看得到這次慢在哪一段
+
+數字存在 process 記憶體裡，多個 worker 各自一份（Prometheus 端照 instance 加總）。
+"""
+import contextvars
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse
+
+ENABLED = bool(getattr(settings, "LABEL_STUDIO_METRICS", True))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+_lock = threading.Lock()
+# 目前這個 request 的 Server-Timing（view 名稱 + 各階段累計）；背景 thread 裡是 None
+_current = contextvars.ContextVar("ls_request_timing", default=None)
+
+
+class _Histogram:
+
+    def __init__(self, name: str, help_text: str, labels, buckets):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}   # label values -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, *label_values):
+        with _lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with _lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        for values, series in items:
+            base = _labels(self.labels, values)
+            for bound, n in zip(self.buckets, series):
+                yield f'{self.name}_bucket{{{base}{"," if base else ""}le="{bound:g}"}} {n}'
+            yield f'{self.name}_bucket{{{base}{"," if base else ""}le="+Inf"}} {series[-1]}'
+            yield f"{self.name}_sum{{{base}}} {series[-2]:.6f}"
+            yield f"{self.name}_count{{{base}}} {series[-1]}"
+
+
+class _Counter:
+
+    def __init__(self, name: str, help_text: str, labels):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._series = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        with _lock:
+            self._series[label_values] = self._series.get(label_values, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with _lock:
+            items = sorted(self._series.items())
+        for values, n in items:
+            yield f"{self.name}{{{_labels(self.labels, values)}}} {n:g}"
+
+
+class _Gauge:
+    """目前值；輸出時才呼叫 fn 取值（limiter 的 limit、in-flight 之類）
+
+    有 label 的 gauge 每組 label 值各 bind 一個 fn（例如每個專案一個 limiter）。
+    """
+
+    def __init__(self, name: str, help_text: str, fn=None, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._fns = {} if fn is None else {(): fn}
+
+    def bind(self, fn, *label_values):
+        with _lock:
+            self._fns[tuple(str(v) for v in label_values)] = fn
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        with _lock:
+            items = sorted(self._fns.items())
+        for values, fn in items:
+            labels = f"{{{_labels(self.labels, values)}}}" if values else ""
+            yield f"{self.name}{labels} {float(fn()):g}"
+
+
+def _labels(names, values) -> str:
+    return ",".join(f'{k}="{_escape(v)}"' for k, v in zip(names, values))
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+UPSTREAM_SECONDS = _Histogram(
+    "ls_upstream_request_duration_seconds", "Label Studio API call latency (per attempt)",
+    ("endpoint", "method", "status"), LATENCY_BUCKETS)
+UPSTREAM_RETRIES = _Counter(
+    "ls_upstream_retries_total", "Label Studio API calls retried, by reason",
+    ("endpoint", "method", "reason"))
+UPSTREAM_REQUEST_BYTES = _Histogram(
+    "ls_upstream_request_bytes", "Label Studio API request body size",
+    ("endpoint", "method"), SIZE_BUCKETS)
+UPSTREAM_RESPONSE_BYTES = _Histogram(
+    "ls_upstream_response_bytes", "Label Studio API response body size",
+    ("endpoint", "method"), SIZE_BUCKETS)
+VIEW_SECONDS = _Histogram(
+    "ls_view_duration_seconds", "Django view latency",
+    ("view", "method", "status"), LATENCY_BUCKETS)
+PHASE_SECONDS = _Histogram(
+    "ls_view_phase_seconds", "Time spent per phase inside a view (token / cursor / fetch / render)",
+    ("view", "phase"), LATENCY_BUCKETS)
+
+REGISTRY = [UPSTREAM_SECONDS, UPSTREAM_RETRIES, UPSTREAM_REQUEST_BYTES, UPSTREAM_RESPONSE_BYTES,
+            VIEW_SECONDS, PHASE_SECONDS]
+
+_ID = re.compile(r"/\d+(?=/|$)")
+
+
+def endpoint_template(url: str) -> str:
+    """https://host/api/tasks/123/annotations/?x=1 → /api/tasks/{id}/annotations/"""
+    path = re.sub(r"^[a-z]+://[^/]+", "", str(url)).split("?", 1)[0]
+    return _ID.sub("/{id}", path) or "/"
+
+
+def register(metric):
+    """其他模組自己的指標也掛到 /metrics"""
+    if metric not in REGISTRY:
+        REGISTRY.append(metric)
+    return metric
+
+
+def counter(name: str, help_text: str, labels=()):
+    return register(_Counter(name, help_text, labels))
+
+
+def histogram(name: str, help_text: str, labels=(), buckets=LATENCY_BUCKETS):
+    return register(_Histogram(name, help_text, labels, buckets))
+
+
+def gauge(name: str, help_text: str, fn=None, labels=()):
+    return register(_Gauge(name, help_text, fn, labels))
+
+
+class _Timing:
+    __slots__ = ("view", "phases", "upstream", "calls")
+
+    def __init__(self):
+        self.view = "unknown"
+        self.phases = {}
+        self.upstream = 0.0
+        self.calls = 0
+
+
+@contextmanager
+def phase(name: str):
+    """量一段時間：進直方圖，也進這個 request 的 Server-Timing"""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - t0
+        timing = _current.get()
+        view = timing.view if timing is not None else "background"
+        PHASE_SECONDS.observe(elapsed, view, name)
+        if timing is not None:
+            # fan-out 的 worker thread 帶著同一個 timing，加總要拿 lock
+            with _lock:
+                timing.phases[name] = timing.phases.get(name, 0.0) + elapsed
+
+
+def record_upstream(method: str, url: str, status, elapsed: float, request_bytes: int = 0,
+                    response_bytes: int = 0):
+    endpoint = endpoint_template(url)
+    UPSTREAM_SECONDS.observe(elapsed, endpoint, method, str(status))
+    UPSTREAM_REQUEST_BYTES.observe(request_bytes, endpoint, method)
+    UPSTREAM_RESPONSE_BYTES.observe(response_bytes, endpoint, method)
+    timing = _current.get()
+    if timing is not None:
+        with _lock:
+            timing.upstream += elapsed
+            timing.calls += 1
+
+
+def record_retry(method: str, url: str, reason):
+    UPSTREAM_RETRIES.inc(endpoint_template(url), method, str(reason))
+
+
+def body_size(body) -> int:
+    if body is None:
+        return 0
+    return len(body.encode("utf-8") if isinstance(body, str) else body)
+
+
+def render_text() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def metrics_view(request):
+    return HttpResponse(render_text(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def _server_timing(timing: _Timing, total: float) -> str:
+    parts = [f"{name};dur={secs * 1000:.1f}" for name, secs in timing.phases.items()]
+    if timing.calls:
+        parts.append(f'upstream;dur={timing.upstream * 1000:.1f};desc="{timing.calls} calls"')
+    parts.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(parts)
+
+
+class MetricsMiddleware:
+    """記每個 view 的延遲並加上 Server-Timing；sync / async view 都能掛"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        if not ENABLED:
+            return self.get_response(request)
+        timing, token, t0 = self._start()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self._finish(request, response, timing, t0)
+
+    async def __acall__(self, request):
+        if not ENABLED:
+            return await self.get_response(request)
+        timing, token, t0 = self._start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self._finish(request, response, timing, t0)
+
+    def _start(self):
+        timing = _Timing()
+        return timing, _current.set(timing), time.perf_counter()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        timing = _current.get()
+        if timing is not None:
+            match = request.resolver_match
+            timing.view = (match.url_name if match and match.url_name else view_func.__name__)
+
+    def _finish(self, request, response, timing, t0):
+        total = time.perf_counter() - t0
+        if timing.view != "unknown":
+            # 404 之類沒對到 view 的不記，避免 label 爆掉
+            VIEW_SECONDS.observe(total, timing.view, request.method, str(response.status_code))
+        if not response.has_header("Server-Timing"):
+            response["Server-Timing"] = _server_timing(timing, total)
+        return response
@@ -0,0 +1,56 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Annotation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('project_id', models.IntegerField()),
+                ('annotation_id', models.BigIntegerField(unique=True)),
+                ('task_id', models.BigIntegerField(db_index=True)),
+                ('rating', models.CharField(blank=True, max_length=1, null=True)),
+                ('relation', models.CharField(blank=True, max_length=1, null=True)),
+                ('updated_at', models.CharField(blank=True, default='', max_length=40)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SyncState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('project_id', models.IntegerField(unique=True)),
+                ('max_inner_id', models.BigIntegerField(default=0)),
+                ('last_updated_at', models.CharField(blank=True, default='', max_length=40)),
+                ('last_synced', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Task',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('project_id', models.IntegerField()),
+                ('task_id', models.BigIntegerField(unique=True)),
+                ('inner_id', models.BigIntegerField()),
+                ('query', models.TextField(blank=True, default='')),
+                ('it_name', models.TextField(blank=True, default='')),
+                ('image_url', models.TextField(blank=True, default='')),
+                ('rating', models.CharField(blank=True, max_length=1, null=True)),
+                ('relation', models.CharField(blank=True, max_length=1, null=True)),
+                ('updated_at', models.CharField(blank=True, default='', max_length=40)),
+                ('synced_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['project_id', 'rating', 'inner_id'], name='task_project_unlabeled')],
+                'constraints': [models.UniqueConstraint(fields=('project_id', 'inner_id'), name='task_project_inner_id')],
+            },
+        ),
+    ]
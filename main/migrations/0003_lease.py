@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0002_outboxitem'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Lease',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('project_id', models.IntegerField()),
+                ('owner', models.CharField(max_length=64)),
+                ('start_inner_id', models.BigIntegerField()),
+                ('end_inner_id', models.BigIntegerField()),
+                ('task_ids', models.JSONField(default=list)),
+                ('expires_at', models.DateTimeField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['project_id', 'expires_at'], name='lease_active'), models.Index(fields=['project_id', 'owner'], name='lease_owner')],
+            },
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0003_lease'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='annotation',
+            name='annotation_id',
+            field=models.BigIntegerField(),
+        ),
+        migrations.AlterField(
+            model_name='annotation',
+            name='task_id',
+            field=models.BigIntegerField(),
+        ),
+        migrations.AlterField(
+            model_name='task',
+            name='task_id',
+            field=models.BigIntegerField(),
+        ),
+        migrations.AddIndex(
+            model_name='annotation',
+            index=models.Index(fields=['project_id', 'task_id'], name='annotation_project_task'),
+        ),
+        migrations.AddIndex(
+            model_name='outboxitem',
+            index=models.Index(fields=['project_id', 'task_id'], name='outbox_project_task'),
+        ),
+        migrations.AddConstraint(
+            model_name='annotation',
+            constraint=models.UniqueConstraint(fields=('project_id', 'annotation_id'), name='annotation_project_id'),
+        ),
+        migrations.AddConstraint(
+            model_name='task',
+            constraint=models.UniqueConstraint(fields=('project_id', 'task_id'), name='task_project_task_id'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0004_scope_ids_by_project'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='syncstate',
+            name='stats_reconciled_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='CountedLabel',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('project_id', models.IntegerField()),
+                ('task_id', models.BigIntegerField()),
+                ('rating', models.CharField(max_length=1)),
+                ('relation', models.CharField(max_length=1)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('project_id', 'task_id'), name='counted_label_task')],
+            },
+        ),
+        migrations.CreateModel(
+            name='LabelCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('project_id', models.IntegerField()),
+                ('rating', models.CharField(max_length=1)),
+                ('relation', models.CharField(max_length=1)),
+                ('n', models.IntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('project_id', 'rating', 'relation'), name='label_count_cell')],
+            },
+        ),
+    ]
@@ -0,0 +1,187 @@
+"""本地 task 鏡像：增量同步與讀取
+
+index / table 的 GET 直接讀本地 DB，上游只拿來寫入與背景同步。
+同步分兩段：
+1. inner_id 比 SyncState.max_inner_id 大的新 task
+2. updated_at 比 SyncState.last_updated_at 新的舊 task（別人改過標註）
+"""
+import logging
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.utils import timezone
+
+from . import annotation_index, projects
+from .models import SyncState, Task
+
+logger = logging.getLogger(__name__)
+
+SYNC_PAGE = 100
+# 鏡像多久沒同步就在背景補一次（秒）
+SYNC_INTERVAL = int(getattr(settings, "LABEL_STUDIO_SYNC_INTERVAL", 30))
+
+_sync_lock = threading.Lock()
+_sync_running = set()
+# 每個專案第一次同步的 lock：同時進來的 request 只有一個去抓整個專案，其他的等它做完
+_first_sync_locks = {}
+
+
+def _task_fields(project_id: int, row):
+    return Task(
+        project_id=project_id,
+        task_id=row.task_id,
+        inner_id=int(row.inner_id),
+        query=row.query or "",
+        it_name=row.it_name or "",
+        image_url=row.image_url or "",
+        rating=row.rating,
+        relation=row.relation,
+        updated_at=row.updated_at,
+    )
+
+
+def upsert_tasks(project_id: int, tasks):
+    """寫入一頁上游 task（[TaskRow, ...]）；回傳 (最大 inner_id, 最大 updated_at)"""
+    rows = [_task_fields(project_id, t) for t in tasks if t.inner_id is not None]
+    if not rows:
+        return None, ""
+    Task.objects.bulk_create(
+        rows,
+        update_conflicts=True,
+        unique_fields=["project_id", "task_id"],
+        update_fields=["inner_id", "query", "it_name", "image_url", "rating", "relation", "updated_at", "synced_at"],
+    )
+    annotation_index.remember_tasks(project_id, tasks)
+    projects.get(project_id).labels.learn_rows(tasks)
+    return max(r.inner_id for r in rows), max(r.updated_at for r in rows)
+
+
+def sync_project(project_id: int, token: str = None, page: int = SYNC_PAGE) -> dict:
+    from .views import get_access_token, get_unlabeled_task
+
+    project = projects.get(project_id)
+    token = token or get_access_token(project)
+    state, _ = SyncState.objects.get_or_create(project_id=project_id)
+    since = state.last_updated_at
+    newest = since
+    stats = {"new": 0, "changed": 0}
+
+    # 1) 新 task：inner_id 游標往後走，每頁存一次游標，中斷後可以接著跑
+    cursor = state.max_inner_id
+    while True:
+        tasks = get_unlabeled_task(project, token, cursor, page)
+        if not tasks:
+            break
+        with transaction.atomic():
+            max_inner, max_updated = upsert_tasks(project_id, tasks)
+            if max_inner is None:
+                break
+            cursor = max(cursor, max_inner)
+            state.max_inner_id = cursor
+            state.save(update_fields=["max_inner_id"])
+        newest = max(newest, max_updated)
+        stats["new"] += len(tasks)
+        if len(tasks) < page:
+            break
+
+    # 2) 舊 task 的標註異動
+    if since:
+        cursor = 0
+        while True:
+            tasks = get_unlabeled_task(project, token, cursor, page, updated_after=since)
+            if not tasks:
+                break
+            max_inner, max_updated = upsert_tasks(project_id, tasks)
+            if max_inner is None:
+                break
+            cursor = max_inner
+            newest = max(newest, max_updated)
+            stats["changed"] += len(tasks)
+            if len(tasks) < page:
+                break
+
+    state.last_updated_at = newest
+    state.last_synced = timezone.now()
+    state.save(update_fields=["last_updated_at", "last_synced"])
+    return stats
+
+
+def _background_sync(project_id: int):
+    try:
+        close_old_connections()
+        sync_project(project_id)
+    except Exception:
+        logger.exception("background sync of project %s failed", project_id)
+    finally:
+        with _sync_lock:
+            _sync_running.discard(project_id)
+        connection.close()
+
+
+def _synced_once(project_id: int):
+    """同步過就回傳 SyncState，還沒就 None"""
+    state = SyncState.objects.filter(project_id=project_id).first()
+    return state if state is not None and state.last_synced is not None else None
+
+
+def ensure_fresh(project_id: int):
+    """第一次用就同步跑完（同一個專案同時只有一個在跑）；之後過期只在背景補，不擋住頁面"""
+    state = _synced_once(project_id)
+    if state is None:
+        with _sync_lock:
+            lock = _first_sync_locks.setdefault(project_id, threading.Lock())
+        with lock:
+            # 等 lock 的期間可能已經有人同步完了
+            if _synced_once(project_id) is None:
+                sync_project(project_id)
+        return
+    if (timezone.now() - state.last_synced).total_seconds() < SYNC_INTERVAL:
+        return
+    with _sync_lock:
+        if project_id in _sync_running:
+            return
+        _sync_running.add(project_id)
+    threading.Thread(target=_background_sync, args=(project_id,), daemon=True).start()
+
+
+def sync(project_id: int):
+    """在目前的 thread 同步到最新：第一次走 ensure_fresh（同一個專案只有一個在抓），之後做一次增量同步"""
+    if _synced_once(project_id) is None:
+        ensure_fresh(project_id)
+    else:
+        sync_project(project_id)
+
+
+def record_annotation(project_id: int, task_id: int, annotation_id, rating, relation, updated_at: str = ""):
+    """自己寫成功的標註直接反映到鏡像，不必等下一次同步"""
+    rating = None if rating is None else str(rating)
+    relation = None if relation is None else str(relation).upper()
+    annotation_index.remember(project_id, task_id, annotation_id, rating, relation, updated_at)
+    Task.objects.filter(project_id=project_id, task_id=int(task_id)).update(rating=rating, relation=relation)
+
+
+def labeled_tasks(project_id: int):
+    """鏡像裡已標註的 task（只帶組合與標註欄位）"""
+    return Task.objects.filter(project_id=project_id, rating__isnull=False) \
+        .only("task_id", "inner_id", "query", "it_name", "rating", "relation").iterator()
+
+
+def cursor(project_id: int):
+    """本地版 get_views_id：(下一個未標註的 inner_id, 已標註數)"""
+    qs = Task.objects.filter(project_id=project_id)
+    first_unlabeled = qs.filter(rating__isnull=True).order_by("inner_id").values_list("inner_id", flat=True).first()
+    if first_unlabeled is None:
+        first_unlabeled = (qs.order_by("-inner_id").values_list("inner_id", flat=True).first() or 0) + 1
+    return first_unlabeled, qs.filter(rating__isnull=False).count()
+
+
+def next_unlabeled(project_id: int, inner_id: int):
+    return Task.objects.filter(project_id=project_id, inner_id__gte=inner_id, rating__isnull=True) \
+        .order_by("inner_id").values_list("inner_id", flat=True).first()
+
+
+def tasks_from(project_id: int, inner_id: int, page: int):
+    """本地版 get_unlabeled_task：inner_id 大於給定值的前 page 筆"""
+    qs = Task.objects.filter(project_id=project_id, inner_id__gt=inner_id).order_by("inner_id")[:page]
+    return list(qs)
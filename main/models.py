@@ -1,3 +1,161 @@
 from django.db import models
 
-# Create your models here.
+
+class Task(models.Model):
+    """Label Studio task 的本地鏡像；rating / relation 是該 task 最新一筆 annotation 的標註
+
+    不同專案可能在不同的 Label Studio 上，task_id 只在同一個專案裡唯一
+    """
+    project_id = models.IntegerField()
+    task_id = models.BigIntegerField()
+    inner_id = models.BigIntegerField()
+
+    query = models.TextField(blank=True, default="")
+    it_name = models.TextField(blank=True, default="")
+    image_url = models.TextField(blank=True, default="")
+
+    rating = models.CharField(max_length=1, null=True, blank=True)
+    relation = models.CharField(max_length=1, null=True, blank=True)
+
+    # 上游的 updated_at 原字串，增量同步時直接拿來比較
+    updated_at = models.CharField(max_length=40, blank=True, default="")
+    synced_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["project_id", "inner_id"], name="task_project_inner_id"),
+            models.UniqueConstraint(fields=["project_id", "task_id"], name="task_project_task_id"),
+        ]
+        indexes = [
+            models.Index(fields=["project_id", "rating", "inner_id"], name="task_project_unlabeled"),
+        ]
+
+    def __str__(self):
+        return f"#{self.task_id} ({self.inner_id})"
+
+
+class Annotation(models.Model):
+    """Label Studio annotation 的本地鏡像（task_id 不設 FK，task 還沒同步進來也能先記）；id 跟 Task 一樣只在專案內唯一"""
+    project_id = models.IntegerField()
+    annotation_id = models.BigIntegerField()
+    task_id = models.BigIntegerField()
+
+    rating = models.CharField(max_length=1, null=True, blank=True)
+    relation = models.CharField(max_length=1, null=True, blank=True)
+
+    updated_at = models.CharField(max_length=40, blank=True, default="")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["project_id", "annotation_id"], name="annotation_project_id"),
+        ]
+        indexes = [
+            models.Index(fields=["project_id", "task_id"], name="annotation_project_task"),
+        ]
+
+    def __str__(self):
+        return f"annotation {self.annotation_id} → task {self.task_id}"
+
+
+class SyncState(models.Model):
+    """每個 project 的增量同步游標"""
+    project_id = models.IntegerField(unique=True)
+    # 已同步的最大 inner_id（新 task 只抓比它大的）
+    max_inner_id = models.BigIntegerField(default=0)
+    # 已同步到的最大 updated_at（標註異動只抓比它新的）
+    last_updated_at = models.CharField(max_length=40, blank=True, default="")
+    last_synced = models.DateTimeField(null=True, blank=True)
+    # /api/stats/ 的計數上一次跟鏡像對完帳的時間
+    stats_reconciled_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"project {self.project_id} @ {self.max_inner_id}"
+
+
+class LabelCount(models.Model):
+    """/api/stats/ 的 rating × relation 一格：上游確認過的標註有幾個 task 是這個組合"""
+    project_id = models.IntegerField()
+    rating = models.CharField(max_length=1)
+    relation = models.CharField(max_length=1)
+    n = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["project_id", "rating", "relation"], name="label_count_cell"),
+        ]
+
+    def __str__(self):
+        return f"project {self.project_id} {self.rating}{self.relation}: {self.n}"
+
+
+class CountedLabel(models.Model):
+    """每個 task 目前算在 LabelCount 的哪一格；修改時靠它把舊的那格減一，重複寫同一個答案也不會重算"""
+    project_id = models.IntegerField()
+    task_id = models.BigIntegerField()
+    rating = models.CharField(max_length=1)
+    relation = models.CharField(max_length=1)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["project_id", "task_id"], name="counted_label_task"),
+        ]
+
+    def __str__(self):
+        return f"task {self.task_id} → {self.rating}{self.relation}"
+
+
+class OutboxItem(models.Model):
+    """index POST 先寫進這裡就回應，背景 flusher 再慢慢送到 Label Studio"""
+    PENDING = "pending"
+    SENDING = "sending"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = [(s, s) for s in (PENDING, SENDING, DONE, FAILED)]
+
+    project_id = models.IntegerField()
+    task_id = models.BigIntegerField()
+    rating = models.CharField(max_length=1)
+    relation = models.CharField(max_length=1)
+
+    # 寫進 annotation result 的 region id；重送前用它確認上游是不是已經收過
+    idempotency_key = models.CharField(max_length=32, unique=True)
+    status = models.CharField(max_length=8, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, default="")
+    annotation_id = models.BigIntegerField(null=True, blank=True)
+
+    next_attempt_at = models.DateTimeField()
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "next_attempt_at"], name="outbox_due"),
+            models.Index(fields=["project_id", "task_id"], name="outbox_project_task"),
+        ]
+
+    def __str__(self):
+        return f"task {self.task_id} {self.rating}{self.relation} [{self.status}]"
+
+
+class Lease(models.Model):
+    """某位標註者目前保留的 inner_id 區間；過期就可以被別人拿走"""
+    project_id = models.IntegerField()
+    # session key（或登入使用者的 "user:<id>"）
+    owner = models.CharField(max_length=64)
+    start_inner_id = models.BigIntegerField()
+    end_inner_id = models.BigIntegerField()
+    # 實際發給前端的 task id，POST 時照這個順序對回去
+    task_ids = models.JSONField(default=list)
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["project_id", "expires_at"], name="lease_active"),
+            models.Index(fields=["project_id", "owner"], name="lease_owner"),
+        ]
+
+    def __str__(self):
+        return f"{self.owner} [{self.start_inner_id}, {self.end_inner_id}]"
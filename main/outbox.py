@@ -0,0 +1,314 @@
+"""annotation 寫入的 write-behind outbox
+
+index POST 只把 {task, rating, relation} 寫進 OutboxItem 就回應；背景 flusher
+再把它們送到 Label Studio，失敗的以指數退避重試。每筆都帶一個固定的 region id
+（idempotency key），重送前先查上游是否已經有這筆，避免重複的 annotation。
+"""
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+import requests
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Count, F, Q
+from django.http import Http404
+from django.utils import timezone
+
+from . import counters, projects
+from .models import OutboxItem, Task
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = int(getattr(settings, "LABEL_STUDIO_OUTBOX_MAX_ATTEMPTS", 8))
+RETRY_BASE = float(getattr(settings, "LABEL_STUDIO_OUTBOX_RETRY_BASE", 2.0))
+RETRY_CAP = float(getattr(settings, "LABEL_STUDIO_OUTBOX_RETRY_CAP", 300.0))
+# 被認領（sending）超過這麼久還沒結果，視為那個 worker 掛了，可以重新認領
+CLAIM_TIMEOUT = timedelta(seconds=int(getattr(settings, "LABEL_STUDIO_OUTBOX_CLAIM_TIMEOUT", 120)))
+POLL_INTERVAL = float(getattr(settings, "LABEL_STUDIO_OUTBOX_POLL", 5.0))
+# 修改碰到正在送出的那一筆時，最多等它送完幾秒（之後照一般修改 PATCH 上游）
+AMEND_WAIT = float(getattr(settings, "LABEL_STUDIO_OUTBOX_AMEND_WAIT", 30.0))
+# 等的時候查 DB 的間隔：從 AMEND_POLL 起倍增到 AMEND_POLL_MAX
+AMEND_POLL = 0.05
+AMEND_POLL_MAX = 0.5
+
+# 上游明確拒收（不是暫時性錯誤）就不再重試
+RETRYABLE_STATUS = {408, 409, 425, 429}
+
+
+def enqueue(project_id: int, items):
+    """寫入 outbox；回傳驗證失敗的 [(task, False, 原因)]"""
+    from . import views
+
+    project = projects.get(project_id)
+    rows, failed = [], []
+    now = timezone.now()
+    for it in items:
+        task_id, rating, relation, err = views.validate_annotation(it["task"], it["rating"], it["relation"])
+        if err:
+            failed.append((it["task"], False, err))
+            continue
+        rows.append(OutboxItem(
+            project_id=project_id, task_id=task_id, rating=rating, relation=relation,
+            idempotency_key=uuid.uuid4().hex[:12], next_attempt_at=now,
+        ))
+
+    with transaction.atomic():
+        OutboxItem.objects.bulk_create(rows)
+        # 先在鏡像裡標成已標註，下一批才不會又拿到同一批
+        for row in rows:
+            views.remember_write(project, row.task_id, None, row.rating, row.relation, confirmed=False)
+
+    flusher.wake()
+    return failed
+
+
+def _region_ids(annotation):
+    for block in annotation.get("result") or []:
+        if isinstance(block, dict) and block.get("id"):
+            yield block["id"]
+
+
+def find_existing(project, item: OutboxItem, token: str):
+    """上游是否已經有帶這個 idempotency key 的 annotation；有就回傳它"""
+    r = project.ls.get("annotations/", token, params={"taskID": item.task_id, "project": project.project_id})
+    if not r.ok:
+        return None
+    obj = r.json()
+    arr = obj if isinstance(obj, list) else (obj.get("results") or obj.get("data") or [])
+    marker = f"{item.idempotency_key}r"
+    for ann in arr:
+        if isinstance(ann, dict) and marker in _region_ids(ann):
+            return ann
+    return None
+
+
+def send(item: OutboxItem):
+    """送一筆；回傳 (狀態, annotation 或錯誤訊息)。只打網路，不碰 DB
+
+    attempts 在 claim 時就加一，所以 attempts > 1 代表之前被認領過：那一次可能已經寫進去
+    （包括 worker 在 POST 之後、寫回結果之前掛掉的情況），先查上游有沒有這筆。
+    """
+    from .views import build_annotation_payload, get_access_token
+
+    try:
+        project = projects.get(item.project_id)
+    except Http404:
+        # 專案已經從設定拿掉了，送不出去
+        return OutboxItem.FAILED, f"unknown project {item.project_id}"
+    try:
+        token = get_access_token(project)
+        if item.attempts > 1:
+            # 上一次可能已經寫進去只是沒收到回應
+            existing = find_existing(project, item, token)
+            if existing is not None:
+                return OutboxItem.DONE, existing
+
+        payload = build_annotation_payload(item.rating, item.relation, region_key=item.idempotency_key)
+        r = project.ls.post(f"tasks/{item.task_id}/annotations/", token, json=payload)
+        if r.status_code in (200, 201):
+            try:
+                return OutboxItem.DONE, r.json()
+            except ValueError:
+                return OutboxItem.FAILED, f"annotation 回應不是 JSON {r.status_code} {r.text[:500]}"
+    except requests.RequestException as e:
+        return OutboxItem.PENDING, f"HTTP 錯誤：{e}"
+
+    error = f"annotation 失敗 {r.status_code} {r.text[:500]}"
+    if r.status_code >= 500 or r.status_code in RETRYABLE_STATUS:
+        return OutboxItem.PENDING, error
+    return OutboxItem.FAILED, error
+
+
+def claim(limit: int, skip_projects=()):
+    now = timezone.now()
+    due = Q(status=OutboxItem.PENDING, next_attempt_at__lte=now) | \
+        Q(status=OutboxItem.SENDING, claimed_at__lt=now - CLAIM_TIMEOUT)
+    claimed = []
+    for pk in OutboxItem.objects.filter(due).exclude(project_id__in=skip_projects).order_by("id").values_list("id", flat=True)[:limit]:
+        # 條件式 update：多個 process 同時跑也只有一個認領得到。認領就算一次嘗試，
+        # 之後不管有沒有寫回結果，再被認領時 send 都會先查上游
+        if OutboxItem.objects.filter(due, pk=pk).update(status=OutboxItem.SENDING, claimed_at=now,
+                                                        attempts=F("attempts") + 1):
+            claimed.append(pk)
+    return list(OutboxItem.objects.filter(pk__in=claimed).order_by("id"))
+
+
+def _apply(item: OutboxItem, status: str, detail):
+    from . import views
+
+    item.claimed_at = None
+    if status == OutboxItem.DONE:
+        item.status = OutboxItem.DONE
+        item.annotation_id = detail.get("id") if isinstance(detail, dict) else None
+        item.last_error = ""
+        views.remember_write(projects.get(item.project_id), item.task_id, detail, item.rating, item.relation)
+        counters.project_counters.add(item.project_id, 1)
+    elif status == OutboxItem.PENDING and item.attempts < MAX_ATTEMPTS:
+        item.status = OutboxItem.PENDING
+        item.last_error = str(detail)
+        delay = min(RETRY_CAP, RETRY_BASE * (2 ** (item.attempts - 1)))
+        item.next_attempt_at = timezone.now() + timedelta(seconds=delay)
+    else:
+        item.status = OutboxItem.FAILED
+        item.last_error = str(detail)
+        # 寫不進去：鏡像退回未標註，讓它回到待標清單
+        Task.objects.filter(project_id=item.project_id, task_id=item.task_id, rating=item.rating,
+                            relation=item.relation) \
+            .update(rating=None, relation=None)
+    item.save()
+
+
+def flush(limit: int = 200) -> int:
+    """送出一輪到期的項目；回傳處理筆數"""
+    # 斷路器冷卻中的專案先不送：送了也是直接失敗，別白白消耗重試次數
+    items = claim(limit, [p.project_id for p in projects.registered() if p.circuit.is_open()])
+    if not items:
+        return 0
+    # 網路在各專案自己的 thread pool 裡平行送（並行數跟著專案的設定與 AIMD 上限），
+    # DB 寫回集中在這個 thread（SQLite 比較不會 lock）
+    futures = []
+    for item in items:
+        try:
+            executor = projects.get(item.project_id).executor
+        except Http404:
+            executor = None     # 專案已經從設定拿掉了：send 會直接回 FAILED
+        futures.append(executor.submit(send, item) if executor is not None else None)
+    for item, fut in zip(items, futures):
+        # 一筆出錯只記在那一筆上，其他認領到的照樣寫回（不然要等 CLAIM_TIMEOUT 才會被重新認領）
+        try:
+            status, detail = fut.result() if fut is not None else send(item)
+        except Exception as e:
+            logger.exception("outbox send of item %s failed", item.pk)
+            status, detail = OutboxItem.PENDING, f"送出時發生錯誤：{e!r}"
+        try:
+            _apply(item, status, detail)
+        except Exception:
+            logger.exception("failed to record outbox item %s", item.pk)
+    return len(items)
+
+
+def queued_task_ids(project_id: int, task_ids) -> set:
+    """這個專案的這些 task 裡已經排進 outbox（還沒送、送出中或已送達）的"""
+    return set(OutboxItem.objects.filter(
+        project_id=project_id, task_id__in=[int(t) for t in task_ids],
+        status__in=[OutboxItem.PENDING, OutboxItem.SENDING, OutboxItem.DONE],
+    ).values_list("task_id", flat=True))
+
+
+def amend_once(project_id: int, edits: dict) -> dict:
+    """{task_id: (rating, relation)} 各自改最新一筆還沒送出的項目；回傳 {task_id: "amended" / "sending" / None}"""
+    latest = {}
+    for item in OutboxItem.objects.filter(project_id=project_id, task_id__in=list(edits),
+                                          status__in=[OutboxItem.PENDING, OutboxItem.SENDING]).order_by("id"):
+        latest[item.task_id] = item
+    states = {}
+    for task_id, (rating, relation) in edits.items():
+        item = latest.get(task_id)
+        if item is None:
+            states[task_id] = None
+        # 條件式 update：flusher 剛好認領走的話就改不到
+        elif OutboxItem.objects.filter(pk=item.pk, status=OutboxItem.PENDING).update(rating=rating, relation=relation):
+            states[task_id] = "amended"
+        else:
+            states[task_id] = "sending"
+    return states
+
+
+def amend(project_id: int, edits: dict, wait: float = 0) -> dict:
+    """這個專案的這些 task 還沒送出的項目直接改內容；回傳 {task_id: "amended" / "sending" / None（沒有未送出的）}
+
+    正在送的那幾筆一起等，共用同一個 wait 秒的期限：送達或失敗就是 None，呼叫端照一般修改走
+    （PATCH 剛建立的 annotation，或重新建立）；送失敗退回 pending 就直接改它。過了期限還在送才回 "sending"。
+    """
+    deadline = time.monotonic() + wait
+    delay = AMEND_POLL
+    states, waiting = {}, dict(edits)
+    while True:
+        states.update(amend_once(project_id, waiting))
+        waiting = {t: edit for t, edit in waiting.items() if states[t] == "sending"}
+        left = deadline - time.monotonic()
+        if not waiting or left <= 0:
+            return states
+        time.sleep(min(delay, left))
+        delay = min(delay * 2, AMEND_POLL_MAX)
+
+
+def retry_failed(ids=None) -> int:
+    qs = OutboxItem.objects.filter(status=OutboxItem.FAILED)
+    if ids:
+        qs = qs.filter(pk__in=ids)
+    n = qs.update(status=OutboxItem.PENDING, next_attempt_at=timezone.now())
+    if n:
+        flusher.wake()
+    return n
+
+
+def summary(limit: int = 100) -> dict:
+    counts = dict(OutboxItem.objects.values_list("status").annotate(n=Count("id")).order_by())
+    fields = ("id", "task_id", "rating", "relation", "status", "attempts", "last_error", "next_attempt_at")
+    return {
+        "counts": {s: counts.get(s, 0) for s, _ in OutboxItem.STATUS_CHOICES},
+        "pending": list(OutboxItem.objects.filter(status__in=[OutboxItem.PENDING, OutboxItem.SENDING])
+                        .order_by("id").values(*fields)[:limit]),
+        "failed": list(OutboxItem.objects.filter(status=OutboxItem.FAILED)
+                       .order_by("-id").values(*fields)[:limit]),
+    }
+
+
+class OutboxFlusher:
+    """每個 process 一條背景 thread；有新項目就被叫醒，沒有就定期輪詢重試"""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def autostart(self):
+        """app 啟動時就開：重啟前還沒送完、或在退避中的項目不用等下一次寫入才送
+
+        manage.py 的指令（migrate、test、import_labels…）與測試不開；runserver 只在
+        真正處理 request 的那個 process 開（autoreloader 的外層不開）。
+        """
+        if _serves_requests():
+            self.ensure_started()
+
+    def ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="outbox-flusher", daemon=True)
+                self._thread.start()
+
+    def wake(self):
+        self.ensure_started()
+        self._event.set()
+
+    def _run(self):
+        while True:
+            self._event.wait(POLL_INTERVAL)
+            self._event.clear()
+            try:
+                close_old_connections()
+                while flush():
+                    pass
+            except Exception:
+                logger.exception("outbox flush failed")
+
+
+def _serves_requests() -> bool:
+    if "pytest" in sys.modules:
+        return False
+    argv = sys.argv or [""]
+    script = os.path.basename(argv[0])
+    if script not in ("manage.py", "django-admin") and not argv[0].endswith(os.path.join("django", "__main__.py")):
+        return True     # gunicorn / uvicorn / daphne
+    if argv[1:2] != ["runserver"]:
+        return False
+    return os.environ.get("RUN_MAIN") == "true" or "--noreload" in argv
+
+
+flusher = OutboxFlusher()
@@ -0,0 +1,126 @@
+"""下一批 task 的背景預抓
+
+標註者在標這一批的時候，先在背景把下一批（inner_id 窗口、task 內容、project
+計數）準備好；送出 batch 之後再跟上游確認游標，沒動就直接沿用，動了才重抓。
+下一次 index GET 直接從 buffer 拿，不用再等三個上游呼叫。
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# buffer 最多用多久（秒）；太舊可能已經被別人標走
+PREFETCH_TTL = float(getattr(settings, "LABEL_STUDIO_PREFETCH_TTL", 120))
+# GET 進來時如果預抓還在跑，最多等它幾秒
+PREFETCH_WAIT = float(getattr(settings, "LABEL_STUDIO_PREFETCH_WAIT", 10))
+
+
+@dataclass
+class Batch:
+    generation: int
+    inner_id: int
+    num_tasks_with_annotations: int
+    tasks: list
+    verified: bool
+    built_at: float = field(default_factory=time.monotonic)
+
+
+class BatchPrefetcher:
+
+    def __init__(self, fetch_cursor, fetch_tasks, page: int, on_ready=None):
+        # fetch_cursor() -> (inner_id, num_tasks_with_annotations)
+        # fetch_tasks(inner_id, page) -> [task, ...]（inner_id 大於給定值）
+        # on_ready(tasks)：新抓的一批放進 buffer 後呼叫（例如先把商品圖縮好）
+        self.fetch_cursor = fetch_cursor
+        self.fetch_tasks = fetch_tasks
+        self.page = page
+        self.on_ready = on_ready
+
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._buffer = None
+        self._pending = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+
+    def _build(self, generation: int, inner_id=None, num=None):
+        verified = inner_id is None
+        if verified:
+            inner_id, num = self.fetch_cursor()
+            # 游標沒動：之前投機抓的那批直接升格
+            with self._lock:
+                buf = self._buffer
+            if buf is not None and buf.inner_id == inner_id and buf.num_tasks_with_annotations == num:
+                batch = Batch(generation, inner_id, num, buf.tasks, True)
+                self._store(batch)
+                return batch
+        tasks = self.fetch_tasks(inner_id - 1, self.page)
+        batch = Batch(generation, inner_id, num, tasks, verified)
+        self._store(batch)
+        if self.on_ready is not None:
+            self.on_ready(tasks)
+        return batch
+
+    def _store(self, batch: Batch):
+        with self._lock:
+            if batch.generation >= self._generation:
+                self._buffer = batch
+
+    def _submit(self, *args):
+        with self._lock:
+            generation = self._generation
+            fut = self._executor.submit(self._build, generation, *args)
+            self._pending = (generation, fut)
+        fut.add_done_callback(_log_failure)
+
+    def on_served(self, inner_id: int, num: int, tasks):
+        """一批剛送出給前端：假設它會被標完，先抓接在後面的窗口"""
+        n = len(tasks)
+        if n:
+            self._submit(int(inner_id) + n, int(num) + n)
+
+    def on_submitted(self):
+        """batch POST 寫完：舊的預抓作廢，跟上游確認游標後重建"""
+        with self._lock:
+            self._generation += 1
+        self._submit()
+
+    def take(self):
+        """拿目前可用的 batch；沒有就回傳 None 讓呼叫端自己抓"""
+        with self._lock:
+            generation = self._generation
+            pending = self._pending
+            buf = self._buffer
+
+        if pending and pending[0] == generation and not pending[1].done():
+            try:
+                pending[1].result(timeout=PREFETCH_WAIT)
+            except Exception:
+                return None
+            with self._lock:
+                buf = self._buffer
+
+        if buf is None or buf.generation != generation or not buf.verified:
+            return None
+        if time.monotonic() - buf.built_at > PREFETCH_TTL:
+            return None
+        with self._lock:
+            # 一個 buffer 只服務一次
+            if self._buffer is buf:
+                self._buffer = None
+        return buf
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._buffer = None
+
+
+def _log_failure(fut):
+    exc = fut.exception()
+    if exc is not None:
+        logger.warning("prefetch failed: %s", exc)
@@ -0,0 +1,160 @@
+"""一個 deployment 服務多個 Label Studio 專案
+
+PROJECT_ID（搭配 LABEL_STUDIO_URL / LABEL_STUDIO_TOKEN / TOTAL 與全域的流量設定）是預設專案，
+掛在原本的網址；LABEL_STUDIO_PROJECTS 再加其他專案，掛在 /p/<project_id>/ 底下：
+
+    LABEL_STUDIO_PROJECTS = {
+        15: {"total": 20},
+        27: {"url": "https://ls.example.com", "token": "<PAT>", "total": 30,
+             "rate_limit": 10, "concurrency_max": 8},
+    }
+
+沒寫的欄位沿用全域設定。每個專案有自己的 access token 快取、keep-alive 連線池、
+rate limit / AIMD 並行上限、斷路器、fan-in 用的 thread pool 與頁面快取（上一批、游標、
+歷史頁，背景重抓也在專案自己的 pool 上）；一個專案的上游變慢或掛掉，只會用完它自己的名額、打開它自己的斷路器。
+"""
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.http import Http404
+
+from . import breaker, propagation, throttle
+from .history import HistoryPageCache
+from .ls_async import ASYNC_CONCURRENCY, AsyncLabelStudioClient
+from .ls_client import LabelStudioClient
+from .ls_token import AccessTokenManager
+from .stale import StaleCache
+
+DEFAULT_PROJECT_ID = int(getattr(settings, "PROJECT_ID"))
+# 每個專案頁面快取背景重抓的 thread 數
+REFRESH_WORKERS = 4
+
+# LABEL_STUDIO_PROJECTS 每個專案可以覆寫的欄位與預設值
+DEFAULTS = {
+    "url": getattr(settings, "LABEL_STUDIO_URL"),
+    "token": getattr(settings, "LABEL_STUDIO_TOKEN"),
+    "total": int(getattr(settings, "TOTAL")),
+    "rate_limit": throttle.RATE_LIMIT,
+    "rate_burst": throttle.RATE_BURST,
+    "concurrency_min": throttle.CONCURRENCY_MIN,
+    "concurrency_max": throttle.CONCURRENCY_MAX,
+    "max_workers": throttle.CONCURRENCY_INITIAL,
+    "async_concurrency": ASYNC_CONCURRENCY,
+    # index POST 用 /api/annotations/bulk/ 一次寫一整組（見 main.views.iter_bulk）
+    "bulk_writes": bool(getattr(settings, "LABEL_STUDIO_BULK_WRITES", False)),
+}
+
+
+class Project:
+
+    def __init__(self, project_id: int, url: str, token: str, total: int, rate_limit: float = 0,
+                 rate_burst: int = 100, concurrency_min: int = 2, concurrency_max: int = 32, max_workers: int = 8,
+                 async_concurrency: int = 32, bulk_writes: bool = False, default: bool = False):
+        self.project_id = int(project_id)
+        self.url = url
+        self.total = int(total)
+        self.is_default = default
+        self.async_concurrency = async_concurrency
+        # 上游沒有 bulk 端點（404 / 405）時會被關掉，之後都走一筆一個 POST
+        self.bulk_writes = bulk_writes
+        if default:
+            # 預設專案沿用 module 層級那一組
+            self.limits, self.circuit = throttle.default, breaker.circuit
+        else:
+            self.limits = throttle.Throttle(rate_limit, rate_burst, max_workers, concurrency_min, concurrency_max)
+            self.circuit = breaker.CircuitBreaker()
+        # /metrics 的 limiter / 斷路器 gauge 依 project label 分開
+        throttle.expose(self.project_id, self.limits)
+        breaker.expose(self.project_id, self.circuit)
+        # 批次送出 / 修改的 thread pool 與連線池都開到這個專案的並行上限
+        self.pool_size = self.limits.limiter.max_limit
+
+        self.token_manager = AccessTokenManager(url, token, circuit=self.circuit)
+        self.ls = LabelStudioClient(url, self.token_manager, pool_size=self.pool_size,
+                                    limits=self.limits, circuit=self.circuit)
+        self.token_manager.http = self.ls.session
+        self.executor = ThreadPoolExecutor(max_workers=self.pool_size,
+                                           thread_name_prefix=f"project-{self.project_id}")
+        # 頁面快取的背景重抓 / 預抓；跟 executor 分開，重抓裡的 fan-in 才不會等到自己的 pool
+        self.refresh_executor = ThreadPoolExecutor(max_workers=REFRESH_WORKERS,
+                                                   thread_name_prefix=f"project-{self.project_id}-refresh")
+        self._async_client = None
+
+        # 頁面快取：歷史頁、index 的上一批與 table 的游標（後兩者見 main.views 的說明）
+        self.history_cache = HistoryPageCache(self.refresh_executor)
+        self.batch_cache = StaleCache("batch", self.refresh_executor, fresh=0, window=0, max_entries=1)
+        self.cursor_cache = StaleCache("cursor", self.refresh_executor, fresh=0, window=0, max_entries=1)
+        # 不用租約時，目前這一批的 task id（index POST 依序對上前端送來的 batch）
+        self.task_ids = []
+        # 最近寫失敗的 task id（dict 當有序 set），index POST 的 retry 只收這些
+        self.retryable = {}
+        # 不用鏡像時的下一批預抓；由 main.views 建
+        self.prefetcher = None
+        # 已標過的 (query, item) 組合，index 用來預填 / 自動送出
+        self.labels = propagation.LabelIndex()
+
+    @property
+    def base_path(self) -> str:
+        """頁面與前端 fetch 用的網址前綴"""
+        return "/" if self.is_default else f"/p/{self.project_id}/"
+
+    def async_client(self) -> AsyncLabelStudioClient:
+        if self._async_client is None:
+            self._async_client = AsyncLabelStudioClient(self.url, self.token_manager, self.async_concurrency,
+                                                        limits=self.limits, circuit=self.circuit)
+        return self._async_client
+
+    def __repr__(self):
+        return f"<Project {self.project_id}>"
+
+
+def _load() -> dict:
+    extra = getattr(settings, "LABEL_STUDIO_PROJECTS", None) or {}
+    if DEFAULT_PROJECT_ID in {int(pid) for pid in extra}:
+        raise ImproperlyConfigured(
+            f"LABEL_STUDIO_PROJECTS 不要放預設專案 {DEFAULT_PROJECT_ID}；它用 PROJECT_ID / TOTAL / LABEL_STUDIO_* 設定")
+    out = {DEFAULT_PROJECT_ID: Project(DEFAULT_PROJECT_ID, default=True, **DEFAULTS)}
+    for pid, conf in extra.items():
+        conf = conf or {}
+        unknown = set(conf) - set(DEFAULTS)
+        if unknown:
+            raise ImproperlyConfigured(f"LABEL_STUDIO_PROJECTS[{pid}] 有不認得的欄位：{sorted(unknown)}")
+        out[int(pid)] = Project(pid, **{**DEFAULTS, **conf})
+    return out
+
+
+_projects = _load()
+
+
+def get(project_id=None) -> Project:
+    """project_id 對應的專案；None 是預設專案，不在設定裡就 404"""
+    if project_id is None:
+        project_id = DEFAULT_PROJECT_ID
+    try:
+        return _projects[int(project_id)]
+    except (KeyError, TypeError, ValueError):
+        raise Http404(f"unknown project {project_id}")
+
+
+def default() -> Project:
+    return _projects[DEFAULT_PROJECT_ID]
+
+
+def registered():
+    return list(_projects.values())
+
+
+def scoped(view):
+    """view(request, project, ...)：網址帶 project_id 就換成那個專案，沒帶就是預設專案"""
+    if iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def wrapper(request, project_id=None, **kwargs):
+            return await view(request, get(project_id), **kwargs)
+    else:
+        @functools.wraps(view)
+        def wrapper(request, project_id=None, **kwargs):
+            return view(request, get(project_id), **kwargs)
+    return wrapper
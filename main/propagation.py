@@ -0,0 +1,187 @@
+"""已標過的 (query, item) 組合 → 標註：index 遇到同一組合時預填或直接送出
+
+ESCI 專案裡同一個 query / IT_NAME 常出現很多次，標註者每次都要重標。這裡把看過的
+已標註列（歷史頁、鏡像同步、自己寫成功的）依正規化後的 query + item 記下來：
+
+- 完全相同的組合：預填（LABEL_STUDIO_PROPAGATION = "prefill"），或直接送出（"submit"）
+- 同一組合之前標過不同答案：標成衝突，只預填票數最多的那個，不自動送出
+- 有裝 NumPy 時再找近似重複：字元 trigram 雜湊成向量，cosine 相似度
+  >= LABEL_STUDIO_PROPAGATION_SIMILARITY 就預填（不自動送出）；沒裝就只比完全相同
+"""
+import re
+import threading
+import unicodedata
+import zlib
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+
+try:
+    import numpy as np
+except ImportError:  # 選用：沒裝就不找近似重複
+    np = None
+
+# off / prefill / submit
+MODE = str(getattr(settings, "LABEL_STUDIO_PROPAGATION", "off")).lower()
+# 近似重複的 cosine 相似度門檻；0 表示不找
+SIMILARITY = float(getattr(settings, "LABEL_STUDIO_PROPAGATION_SIMILARITY", 0.92))
+
+# trigram 雜湊的向量維度
+_DIM = 1024
+# 記住最近發出去的多少個 task 的組合（寫入成功時靠它對回是哪個組合）
+_SERVED_KEYS = 5000
+
+_RATINGS = frozenset("01234")
+_RELATIONS = frozenset("ESCI")
+_SEPARATORS = re.compile(r"[\W_]+")
+
+
+def normalize(text) -> str:
+    """NFKC、不分大小寫，標點與連續空白都當成一個空白"""
+    text = unicodedata.normalize("NFKC", str(text or "")).casefold()
+    return " ".join(_SEPARATORS.sub(" ", text).split())
+
+
+def pair_key(query, item) -> str:
+    return f"{normalize(query)}\x1f{normalize(item)}"
+
+
+def _label(rating, relation):
+    """(rating, relation)；不是合法標註就 None"""
+    rating = None if rating is None else str(rating).strip()
+    relation = None if relation is None else str(relation).strip().upper()
+    if rating in _RATINGS and relation in _RELATIONS:
+        return rating, relation
+    return None
+
+
+def _vector(key: str):
+    grams = f"  {key} "
+    v = np.zeros(_DIM, dtype=np.float32)
+    for i in range(len(grams) - 2):
+        v[zlib.crc32(grams[i:i + 3].encode("utf-8")) % _DIM] += 1.0
+    norm = np.linalg.norm(v)
+    return v / norm if norm else v
+
+
+class Suggestion:
+    __slots__ = ("rating", "relation", "votes", "conflict", "exact")
+
+    def __init__(self, rating: str, relation: str, votes: int, conflict: bool, exact: bool):
+        self.rating = rating
+        self.relation = relation
+        self.votes = votes              # 同一組合之前標成這個答案的 task 數
+        self.conflict = conflict        # 同一組合之前有不同答案
+        self.exact = exact              # False 是近似重複
+
+    @property
+    def combo(self) -> str:
+        """前端卡片上顯示的樣子，例如 3e"""
+        return f"{self.rating}{self.relation.lower()}"
+
+    @property
+    def auto_submit(self) -> bool:
+        return self.exact and not self.conflict
+
+    def __repr__(self):
+        return f"<Suggestion {self.combo}{' conflict' if self.conflict else ''}{'' if self.exact else ' near'}>"
+
+
+class LabelIndex:
+    """一個專案的組合 → 標註票數；thread-safe，只放在記憶體"""
+
+    def __init__(self, similarity: float = SIMILARITY):
+        self.similarity = similarity if np is not None else 0
+        self.seeded = False
+        self._lock = threading.Lock()
+        self._labels = {}                   # key -> Counter({(rating, relation): 票數})
+        self._task_labels = {}              # task_id -> (key, (rating, relation))
+        self._served = OrderedDict()        # 最近發出去的 task_id -> key
+        # 近似比對用：_keys[i] 對應 _matrix 第 i 列；新組合先放 _pending，要用時才併進矩陣
+        self._keys = []
+        self._matrix = None
+        self._pending = []
+
+    def __len__(self):
+        return len(self._labels)
+
+    def _learn(self, task_id: int, key: str, label):
+        old = self._task_labels.get(task_id)
+        if old == (key, label):
+            return
+        if old is not None:
+            votes = self._labels.get(old[0])
+            if votes is not None:
+                votes[old[1]] -= 1
+                if votes[old[1]] <= 0:
+                    del votes[old[1]]
+        if key not in self._labels:
+            self._labels[key] = Counter()
+            if self.similarity:
+                self._pending.append(key)
+        self._labels[key][label] += 1
+        self._task_labels[task_id] = (key, label)
+
+    def learn_rows(self, rows):
+        """已標註的列（TaskRow 或鏡像的 Task）；沒標的略過"""
+        with self._lock:
+            for row in rows:
+                label = _label(row.rating, row.relation)
+                if label is not None:
+                    self._learn(int(row.task_id), pair_key(row.query, row.it_name), label)
+
+    def learn_write(self, task_id, rating, relation):
+        """寫入 / 修改成功的標註；只認得這裡發出去過或看過的 task"""
+        label = _label(rating, relation)
+        if label is None:
+            return
+        task_id = int(task_id)
+        with self._lock:
+            key = self._served.get(task_id)
+            if key is None:
+                key = (self._task_labels.get(task_id) or (None,))[0]
+            if key is not None:
+                self._learn(task_id, key, label)
+
+    def _best(self, key: str, exact: bool):
+        votes = self._labels.get(key)
+        if not votes:
+            return None
+        (rating, relation), n = votes.most_common(1)[0]
+        return Suggestion(rating, relation, n, len(votes) > 1, exact)
+
+    def _near(self, keys):
+        """[key, ...] → [最像的已知 key 或 None, ...]"""
+        if self._pending:
+            new = np.stack([_vector(k) for k in self._pending])
+            self._matrix = new if self._matrix is None else np.vstack([self._matrix, new])
+            self._keys.extend(self._pending)
+            self._pending = []
+        if self._matrix is None or not keys:
+            return [None] * len(keys)
+        sims = np.stack([_vector(k) for k in keys]) @ self._matrix.T
+        best = sims.argmax(axis=1)
+        return [self._keys[j] if sims[i, j] >= self.similarity else None for i, j in enumerate(best)]
+
+    def suggest(self, rows) -> dict:
+        """這批還沒標的列 → {task_id: Suggestion}；沒有建議的 task 不會出現"""
+        out = {}
+        with self._lock:
+            missing = []
+            for row in rows:
+                key = pair_key(row.query, row.it_name)
+                self._served[row.task_id] = key
+                self._served.move_to_end(row.task_id)
+                s = self._best(key, exact=True)
+                if s is not None:
+                    out[row.task_id] = s
+                elif self.similarity:
+                    missing.append((row.task_id, key))
+            while len(self._served) > _SERVED_KEYS:
+                self._served.popitem(last=False)
+            if missing:
+                for (task_id, _), near in zip(missing, self._near([k for _, k in missing])):
+                    s = self._best(near, exact=False) if near is not None else None
+                    if s is not None:
+                        out[task_id] = s
+        return out
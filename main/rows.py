@@ -0,0 +1,125 @@
+"""上游 task 的精簡表示
+
+/api/tasks/ 只要我們用得到的欄位（include=UPSTREAM_FIELDS），回應用 orjson 解（沒裝就用
+標準庫 json），每個 task 馬上轉成 TaskRow：__slots__ 物件，只留 data 裡用得到的 key，
+annotations_results 也在這裡解一次就好。index、table、匯出、鏡像同步與 annotation 索引
+都吃 TaskRow，不再到處傳整包 dict、各自重新 json.loads。
+"""
+import json
+
+try:
+    import orjson
+except ImportError:  # 選用：沒裝就用標準庫
+    orjson = None
+
+# 向上游要的 task 欄位（/api/tasks/ 的 include 參數）
+UPSTREAM_FIELDS = ("id", "inner_id", "data", "annotations_results", "annotations_ids", "updated_at")
+
+
+def loads(body):
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+def dumps(obj) -> bytes:
+    """緊湊的 UTF-8 JSON"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def rating_relation(ann_raw):
+    """annotations_results（JSON 字串或已解開的 list）→ (rating, relation)"""
+    if isinstance(ann_raw, (str, bytes)):
+        if not ann_raw:
+            return None, None
+        try:
+            ann_list = loads(ann_raw)
+        except ValueError:
+            return None, None
+    elif isinstance(ann_raw, list):
+        ann_list = ann_raw
+    else:
+        return None, None
+
+    rating = None
+    relation = None
+    # 原始資料是 [ [ {...}, {...} ] ] 結構，先拿第一組
+    if ann_list and isinstance(ann_list[0], list):
+        for ann in ann_list[0]:
+            if not isinstance(ann, dict):
+                continue
+            name = ann.get("from_name")
+            if name != "rating" and name != "relation":
+                continue
+            # 允許沒有 choices 或空陣列
+            choices = (ann.get("value") or {}).get("choices") or []
+            if name == "rating":
+                rating = choices[0] if choices else None
+            else:
+                relation = choices[0] if choices else None
+    return rating, relation
+
+
+def annotation_ids(task: dict):
+    """上游 task 裡帶的 annotation id（annotations 物件或 annotations_ids 清單 / 逗號字串）"""
+    anns = task.get("annotations")
+    if isinstance(anns, list) and anns:
+        return [a["id"] for a in anns if isinstance(a, dict) and a.get("id")]
+    ids = task.get("annotations_ids") or task.get("annotation_ids") or []
+    if isinstance(ids, str):
+        ids = ids.split(",")
+    out = []
+    for i in ids:
+        try:
+            out.append(int(i))
+        except (TypeError, ValueError):
+            continue
+    return out
+
+
+class TaskRow:
+    """一個 task 在本站用得到的欄位"""
+    __slots__ = ("task_id", "inner_id", "query", "it_name", "image_url", "rating", "relation",
+                 "annotation_id", "updated_at")
+
+    def __init__(self, task_id: int, inner_id: int, query: str = "", it_name: str = "", image_url: str = "",
+                 rating=None, relation=None, annotation_id: int = None, updated_at: str = ""):
+        self.task_id = task_id
+        self.inner_id = inner_id
+        self.query = query
+        self.it_name = it_name
+        self.image_url = image_url
+        self.rating = rating
+        self.relation = relation
+        self.annotation_id = annotation_id      # 最新一筆 annotation 的 id（有的話）
+        self.updated_at = updated_at
+
+    @classmethod
+    def from_task(cls, task: dict) -> "TaskRow":
+        """上游 /api/tasks/ 的一筆"""
+        data = task.get("data") or {}
+        rating, relation = rating_relation(task.get("annotations_results"))
+        ids = annotation_ids(task)
+        return cls(
+            int(task["id"]), task.get("inner_id"),
+            data.get("query"), data.get("IT_NAME"), data.get("image_url"),
+            rating, relation, max(ids) if ids else None, task.get("updated_at") or "",
+        )
+
+    @classmethod
+    def from_model(cls, task) -> "TaskRow":
+        """本地鏡像的 main.models.Task"""
+        return cls(task.task_id, task.inner_id, task.query, task.it_name, task.image_url,
+                   task.rating, task.relation, None, task.updated_at)
+
+    def __repr__(self):
+        return f"<TaskRow {self.task_id} inner_id={self.inner_id}>"
+
+
+def parse_tasks(body) -> list:
+    """/api/tasks/ 的回應 body → [TaskRow, ...]"""
+    data = loads(body)
+    tasks = data.get("tasks", data) if isinstance(data, dict) else (data or [])
+    return [TaskRow.from_task(t) for t in tasks]
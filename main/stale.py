@@ -0,0 +1,167 @@
+"""上游慢或掛掉時退回「最後一份好資料」的快取（stale-while-revalidate）
+
+每筆資料記下抓到的時間：
+- fresh 秒內：直接用
+- 再過 window 秒內：先回舊的（標成 stale），背景重抓
+- 更舊或沒有：當場抓；手上有舊的就最多等 STALE_WAIT 秒，上游太慢、失敗或斷路器開著
+  就回舊的，慢的那次抓完還是會存起來給下一個 request
+
+index 的上一批、table 的游標與歷史頁都走這裡。快取在每個 process 內各自一份；
+背景重抓跑在擁有它的專案自己的 refresh pool 上，一個專案的上游卡住不會擋到別的專案。
+"""
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# 手上有舊資料時，最多等上游幾秒
+STALE_WAIT = float(getattr(settings, "LABEL_STUDIO_STALE_WAIT", 3))
+# 過了 fresh 之後還能「先回舊的、背景重抓」的秒數
+STALE_WINDOW = float(getattr(settings, "LABEL_STUDIO_STALE_WINDOW", 300))
+
+STALE_SERVED = metrics.counter(
+    "ls_stale_served_total", "Responses served from a stale cache entry, by cache and reason", ("cache", "reason"))
+
+class StaleCache:
+
+    def __init__(self, name: str, executor, fresh: float, window: float = STALE_WINDOW, wait: float = STALE_WAIT,
+                 max_entries: int = 64):
+        self.name = name
+        self.executor = executor
+        self.fresh = fresh
+        self.window = window
+        self.wait = wait
+        self.max_entries = max_entries
+        self._entries = OrderedDict()   # key -> (抓到的時間, value)
+        self._inflight = {}             # key -> Future
+        self._lock = threading.Lock()
+
+    # ---- 存取 ----
+
+    def peek(self, key):
+        """(value, 幾秒前抓的)；沒有就 None"""
+        with self._lock:
+            hit = self._entries.get(key)
+            if hit is None:
+                return None
+            self._entries.move_to_end(key)
+            return hit[1], time.monotonic() - hit[0]
+
+    def get(self, key):
+        """還新鮮的值；沒有或過期都回 None"""
+        hit = self.peek(key)
+        if hit is None or hit[1] > self.fresh:
+            return None
+        return hit[0]
+
+    def put(self, key, value):
+        self._put(key, value)
+
+    def _put(self, key, value):
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.monotonic(), value)
+            self._stored(key, value)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+
+    def _drop(self, key):
+        _, value = self._entries.pop(key)
+        self._dropped(key, value)
+
+    def _stored(self, key, value):
+        """子類別維護自己的索引用（已持有 lock）"""
+
+    def _dropped(self, key, value):
+        """同上"""
+
+    def discard(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._drop(key)
+
+    # ---- 載入 ----
+
+    def refresh(self, key, load):
+        """背景抓一次並存起來；同一個 key 同時只會有一個在跑"""
+        with self._lock:
+            fut = self._inflight.get(key)
+            if fut is not None:
+                return fut
+            # 帶著呼叫端的 contextvars，背景抓的時間也算進這個 request 的 Server-Timing
+            ctx = contextvars.copy_context()
+            fut = self._inflight[key] = self.executor.submit(ctx.run, self._load, key, load)
+        return fut
+
+    def _load(self, key, load):
+        try:
+            close_old_connections()
+            value = load()
+            self._put(key, value)
+            return value
+        except Exception as e:
+            logger.warning("%s refresh of %s failed: %s", self.name, key, e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def lookup(self, key, load):
+        """回傳 (value, 是不是舊資料)；完全沒有快取又抓不到時照常丟例外"""
+        hit = self.peek(key)
+        if hit is not None:
+            value, age = hit
+            if age <= self.fresh:
+                return value, False
+            if age <= self.fresh + self.window:
+                self.refresh(key, load)
+                STALE_SERVED.inc(self.name, "revalidate")
+                return value, True
+        if hit is None:
+            value = load()
+            self._put(key, value)
+            return value, False
+        try:
+            return self.refresh(key, load).result(timeout=self.wait), False
+        except Exception as e:
+            STALE_SERVED.inc(self.name, "timeout" if isinstance(e, TimeoutError) else "error")
+            return hit[0], True
+
+    async def alookup(self, key, load, background=None):
+        """lookup 的 async 版；load 是 coroutine function，background 是背景重抓用的同步版"""
+        hit = self.peek(key)
+        if hit is not None:
+            value, age = hit
+            if age <= self.fresh:
+                return value, False
+            if age <= self.fresh + self.window and background is not None:
+                self.refresh(key, background)
+                STALE_SERVED.inc(self.name, "revalidate")
+                return value, True
+        try:
+            value = await asyncio.wait_for(load(), self.wait if hit is not None else None)
+        except Exception as e:
+            if hit is None:
+                raise
+            STALE_SERVED.inc(self.name, "timeout" if isinstance(e, TimeoutError) else "error")
+            if background is not None:
+                # 這次等不及，讓背景把它抓完
+                self.refresh(key, background)
+            return hit[0], True
+        self._put(key, value)
+        return value, False
@@ -0,0 +1,187 @@
+"""rating × relation 分布與進度
+
+原本要看分布只能用 table 把整個專案翻一遍。這裡在 DB 裡維護每一格的計數（LabelCount），
+所有 worker 共用同一份，讀取只是拿 20 格出來，不碰上游、也不掃整個專案。
+
+- 計數只算上游確認過的標註：自己寫成功 / 修改成功時（views.remember_write）更新一格，
+  outbox 要等送達才算，送失敗就從來沒算進去
+- CountedLabel 記每個 task 目前算在哪一格：修改是舊的那格減一、新的那格加一，
+  同一個 task 重複寫同一個答案不會重複算
+- 別人直接在 Label Studio 上標的、或計數寫失敗的，靠背景對帳補：最多每
+  LABEL_STUDIO_STATS_RECONCILE 秒（跟上游的 num_tasks_with_annotations 對不上時最快
+  RECONCILE_RETRY 秒）在背景把鏡像增量同步一次，再按 (rating, relation) 分組跟計數比，
+  不一樣就以鏡像為準重建。讀取從不在 request thread 上同步或重建
+"""
+import logging
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, connection, transaction
+from django.db.models import Count, F
+from django.utils import timezone
+
+from . import mirror
+from .models import CountedLabel, LabelCount, OutboxItem, SyncState, Task
+
+logger = logging.getLogger(__name__)
+
+# 背景對帳的最短間隔（秒）
+RECONCILE_INTERVAL = float(getattr(settings, "LABEL_STUDIO_STATS_RECONCILE", 300))
+# 跟上游的已標註數對不上時，下一次對帳最快幾秒後
+RECONCILE_RETRY = 30
+
+RATINGS = ("0", "1", "2", "3", "4")
+RELATIONS = ("E", "S", "C", "I")
+
+_reconcile_lock = threading.Lock()
+_reconciling = set()
+
+
+def _label(rating, relation):
+    rating = None if rating is None else str(rating).strip()
+    relation = None if relation is None else str(relation).strip().upper()
+    if rating in RATINGS and relation in RELATIONS:
+        return rating, relation
+    return None
+
+
+def _bump(project_id: int, cell, delta: int):
+    rating, relation = cell
+    cells = LabelCount.objects.filter(project_id=project_id, rating=rating, relation=relation)
+    if not cells.update(n=F("n") + delta):
+        LabelCount.objects.get_or_create(project_id=project_id, rating=rating, relation=relation)
+        cells.update(n=F("n") + delta)
+
+
+def record(project_id: int, task_id, rating, relation):
+    """上游確認了這個 task 的標註：從舊的那格（有的話）移到新的那格"""
+    label = _label(rating, relation)
+    if label is None:
+        return
+    task_id = int(task_id)
+    try:
+        with transaction.atomic():
+            counted = CountedLabel.objects.select_for_update().filter(project_id=project_id, task_id=task_id).first()
+            if counted is None:
+                CountedLabel.objects.create(project_id=project_id, task_id=task_id, rating=label[0], relation=label[1])
+            elif (counted.rating, counted.relation) == label:
+                return
+            else:
+                _bump(project_id, (counted.rating, counted.relation), -1)
+                counted.rating, counted.relation = label
+                counted.save(update_fields=["rating", "relation"])
+            _bump(project_id, label, 1)
+    except IntegrityError:
+        # 同一個 task 兩個寫入同時第一次記：其中一個會撞唯一鍵，差的那一筆留給對帳
+        logger.warning("concurrent first count of task %s in project %s", task_id, project_id)
+
+
+def mirrored_labels(project_id: int):
+    """鏡像裡上游確認過的 (task_id, rating, relation)；outbox 裡還沒送達的 task 不算"""
+    in_flight = OutboxItem.objects.filter(
+        project_id=project_id, status__in=[OutboxItem.PENDING, OutboxItem.SENDING],
+    ).values("task_id")
+    return Task.objects.filter(project_id=project_id, rating__in=RATINGS, relation__in=RELATIONS) \
+        .exclude(task_id__in=in_flight)
+
+
+def reconcile(project) -> dict:
+    """把鏡像增量同步一次，按 (rating, relation) 分組跟計數比，不一樣就以鏡像為準重建
+
+    回傳 {"local": 對帳前的已標註數, "mirror": 鏡像的已標註數, "rebuilt": bool}。在背景 thread 跑。
+    """
+    project_id = project.project_id
+    mirror.sync(project_id)
+    with transaction.atomic():
+        # 鎖住計數：對帳途中的寫入等這裡寫完再加上去
+        counted = {(c.rating, c.relation): c.n for c in LabelCount.objects.select_for_update()
+                   .filter(project_id=project_id) if c.n}
+        labels = mirrored_labels(project_id)
+        truth = {(r, rel): n for r, rel, n in labels.values_list("rating", "relation")
+                 .annotate(n=Count("id")).order_by()}
+        rebuilt = counted != truth
+        if rebuilt:
+            logger.info("project %s: label stats drifted from the mirror (%d counted, %d mirrored), rebuilding",
+                        project_id, sum(counted.values()), sum(truth.values()))
+            CountedLabel.objects.filter(project_id=project_id).delete()
+            CountedLabel.objects.bulk_create(
+                (CountedLabel(project_id=project_id, task_id=task_id, rating=r, relation=rel)
+                 for task_id, r, rel in labels.values_list("task_id", "rating", "relation").iterator()),
+                batch_size=1000)
+            LabelCount.objects.filter(project_id=project_id).delete()
+            LabelCount.objects.bulk_create(
+                LabelCount(project_id=project_id, rating=r, relation=rel, n=n) for (r, rel), n in truth.items())
+        SyncState.objects.filter(project_id=project_id).update(stats_reconciled_at=timezone.now())
+    return {"local": sum(counted.values()), "mirror": sum(truth.values()), "rebuilt": rebuilt}
+
+
+def _background_reconcile(project):
+    try:
+        close_old_connections()
+        reconcile(project)
+    except Exception:
+        logger.exception("label stats reconciliation of project %s failed", project.project_id)
+    finally:
+        with _reconcile_lock:
+            _reconciling.discard(project.project_id)
+        connection.close()
+
+
+def start_reconcile(project):
+    """背景對帳；同一個專案同時只有一個在跑"""
+    with _reconcile_lock:
+        if project.project_id in _reconciling:
+            return
+        _reconciling.add(project.project_id)
+    threading.Thread(target=_background_reconcile, args=(project,), daemon=True,
+                     name=f"stats-{project.project_id}").start()
+
+
+def reconcile_due(reconciled_at, drift) -> bool:
+    if reconciled_at is None:
+        return True
+    age = timezone.now() - reconciled_at
+    return age > timedelta(seconds=RECONCILE_INTERVAL) or (bool(drift) and age > timedelta(seconds=RECONCILE_RETRY))
+
+
+def upstream_counters(project) -> dict:
+    """上游的專案計數（有短期快取）；拿不到就空 dict（統計照樣回，只是沒有 drift）"""
+    from .views import get_access_token, get_project
+
+    try:
+        return get_project(project, get_access_token(project))
+    except Exception:
+        logger.warning("failed to load counters of project %s for label stats", project.project_id, exc_info=True)
+        return {}
+
+
+def snapshot(project) -> dict:
+    """讀 20 格計數與上游的專案計數；該對帳了就在背景對，不擋住這次讀取"""
+    project_id = project.project_id
+    cells = {(c.rating, c.relation): c.n for c in LabelCount.objects.filter(project_id=project_id)}
+    matrix = {r: {rel: cells.get((r, rel), 0) for rel in RELATIONS} for r in RATINGS}
+    labeled = sum(cells.values())
+    info = upstream_counters(project)
+    upstream = info.get("num_tasks_with_annotations")
+    drift = None if upstream is None else labeled - int(upstream)
+    task_number = info.get("task_number")
+    state = SyncState.objects.filter(project_id=project_id).first()
+    reconciled_at = state.stats_reconciled_at if state is not None else None
+    if reconcile_due(reconciled_at, drift):
+        start_reconcile(project)
+    return {
+        "labeled": labeled,
+        "task_number": task_number,
+        "progress": round(labeled / task_number, 4) if task_number else None,
+        "ratings": {r: sum(matrix[r].values()) for r in RATINGS},
+        "relations": {rel: sum(matrix[r][rel] for r in RATINGS) for rel in RELATIONS},
+        "matrix": matrix,
+        "queued": OutboxItem.objects.filter(
+            project_id=project_id, status__in=[OutboxItem.PENDING, OutboxItem.SENDING]).count(),
+        # 還沒對過帳：只有開始計數之後經過這裡確認的寫入
+        "complete": reconciled_at is not None,
+        "upstream_labeled": upstream,
+        "drift": drift,
+        "reconciled_at": None if reconciled_at is None else reconciled_at.isoformat().replace("+00:00", "Z"),
+    }
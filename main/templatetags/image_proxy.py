@@ -0,0 +1,11 @@
+from django import template
+
+from main import images
+
+register = template.Library()
+
+
+@register.filter
+def image_proxy(url, size="thumb"):
+    """{{ task.image_url|image_proxy:"card" }} → 本站的縮圖代理網址"""
+    return images.proxy_url(url, size)
@@ -0,0 +1,9 @@
+from django import template
+
+register = template.Library()
+
+
+@register.filter
+def suggestion(suggestions, task_id):
+    """{% with s=suggestions|suggestion:task.task_id %} → 這個 task 的 propagation.Suggestion 或 None"""
+    return (suggestions or {}).get(task_id)
@@ -1,3 +1,1159 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import importlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+import httpx
+import requests
+
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.urls import clear_url_caches, resolve
+from django.utils import timezone
+
+from djangoProject import urls as project_urls
+
+from . import (async_views, counters, export, fanin, images, ls_token, mirror, outbox, projects, propagation, stats,
+               views)
+from .bench.fake_ls import TASK_ID_BASE, FakeLabelStudio
+from .models import Lease, OutboxItem, SyncState, Task
+from .rows import UPSTREAM_FIELDS, TaskRow
+
+TOTAL = 10
+
+
+class FakeUpstreamMixin:
+    """測試共用一個本地 FakeLabelStudio；每個測試 reset 它，預設專案換成指向它的新 Project
+
+    新 Project 代表頁面快取、可重送清單等都從頭開始。功能開關（MIRROR / OUTBOX / LEASES）
+    是 views 的 module 常數，用 enable() 在單一測試裡打開。outbox 的背景 flusher、縮圖暖機與
+    統計的背景對帳都不啟動（背景 thread 碰 DB 會跟測試的 transaction 搶鎖），要送就在測試裡呼叫
+    outbox.flush()，要對帳就呼叫 stats.reconcile()。
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.ls = FakeLabelStudio(num_tasks=300).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.ls.stop()
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        self.ls.reset()
+        self.patch(mock.patch.dict(projects._projects))
+        self.project = self.add_project(projects.DEFAULT_PROJECT_ID, default=True)
+        self.patch(mock.patch.object(counters, "project_counters", counters.ProjectCounters()))
+        self.patch(mock.patch.object(outbox.flusher, "wake", lambda: None))
+        self.patch(mock.patch.object(images, "warm", lambda *args, **kwargs: None))
+        self.start_reconcile = self.patch(mock.patch.object(stats, "start_reconcile"))
+        self.patch(mock.patch.object(mirror, "SYNC_INTERVAL", 3600))
+
+    def add_project(self, project_id, ls=None, **conf):
+        """登記一個指向 ls（預設是共用的那個）的專案；預設專案以外的掛在 /p/<project_id>/"""
+        project = projects.Project(project_id, **{
+            **projects.DEFAULTS, "url": (ls or self.ls).url, "token": "test-refresh-token", "total": TOTAL, **conf})
+        self.addCleanup(project.executor.shutdown)
+        self.addCleanup(project.refresh_executor.shutdown)
+        projects._projects[project_id] = project
+        return project
+
+    def patch(self, patcher):
+        value = patcher.start()
+        self.addCleanup(patcher.stop)
+        return value
+
+    def enable(self, *flags):
+        for flag in flags:
+            self.patch(mock.patch.object(views, flag, True))
+
+    def label_upstream(self, inner_ids, rating="3", relation="E"):
+        for inner_id in inner_ids:
+            self.ls._store(TASK_ID_BASE + inner_id, views.build_annotation_payload(rating, relation)["result"])
+
+    def upstream_label(self, task_id):
+        """上游這個 task 最新的 (rating, relation)；沒標就 None"""
+        anns = [a for a in self.ls.annotations.values() if a["task"] == task_id]
+        if not anns:
+            return None
+        result = {b["from_name"]: b["value"]["choices"][0] for b in max(anns, key=lambda a: a["id"])["result"]}
+        return result["rating"], result["relation"]
+
+    def annotation_count(self, task_id=None):
+        return sum(1 for a in self.ls.annotations.values() if task_id is None or a["task"] == task_id)
+
+    def get_batch(self, client=None):
+        r = (client or self.client).get("/api/batch/")
+        self.assertEqual(r.status_code, 200)
+        return r
+
+    def post_batch(self, batch, client=None, **extra):
+        return (client or self.client).post("/", json.dumps({"batch": batch}),
+                                            content_type="application/json", **extra)
+
+
+def full_batch(n, rating="2", relation="S"):
+    return [{"num": rating, "aux": relation, "combo": f"{rating}{relation.lower()}"} for _ in range(n)]
+
+
+class IndexWriteTests(FakeUpstreamMixin, TestCase):
+
+    def test_post_writes_each_card_upstream(self):
+        self.get_batch()
+        r = self.post_batch(full_batch(TOTAL))
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(r.json()["errno"])
+        self.assertEqual(self.annotation_count(), TOTAL)
+        self.assertEqual(self.upstream_label(TASK_ID_BASE + 1), ("2", "S"))
+
+    def test_post_stops_at_first_unfinished_card(self):
+        self.get_batch()
+        batch = full_batch(TOTAL)
+        batch[4] = {"num": None, "aux": "E", "combo": "_e"}
+        self.post_batch(batch)
+        self.assertEqual(self.annotation_count(), 4)
+
+    def test_stream_reports_each_item_and_retries_failures(self):
+        self.get_batch()
+        batch = full_batch(TOTAL)
+        batch[3] = {"num": "9", "aux": "E", "combo": "9e"}
+        r = self.post_batch(batch, HTTP_ACCEPT="application/x-ndjson")
+        self.assertEqual(r["Content-Type"], "application/x-ndjson")
+        lines = [json.loads(line) for line in b"".join(r.streaming_content).splitlines()]
+        items = [line for line in lines if line["type"] == "item"]
+        self.assertEqual(len(items), TOTAL)
+        failed = [line for line in items if not line["ok"]]
+        self.assertEqual([line["index"] for line in failed], [3])
+        self.assertEqual(lines[-1]["type"], "summary")
+
+        task_id = failed[0]["task"]
+        r = self.client.post("/", json.dumps({"retry": [{"task": task_id, "num": "1", "aux": "C"}]}),
+                             content_type="application/json")
+        self.assertTrue(r.json()["errno"])
+        self.assertEqual(self.upstream_label(task_id), ("1", "C"))
+        # 已經送成功的不能再用 retry 寫
+        r = self.client.post("/", json.dumps({"retry": [{"task": task_id, "num": "0", "aux": "I"}]}),
+                             content_type="application/json")
+        self.assertFalse(r.json()["errno"])
+        self.assertEqual(self.upstream_label(task_id), ("1", "C"))
+
+    def test_edit_patches_existing_annotation(self):
+        self.get_batch()
+        self.post_batch(full_batch(TOTAL))
+        task_id = TASK_ID_BASE + 2
+        r = self.client.patch("/edit/", json.dumps({"task_id": task_id, "inner_id": 2, "rating": 4, "relation": "c"}),
+                              content_type="application/json")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(self.annotation_count(task_id), 1)
+        self.assertEqual(self.upstream_label(task_id), ("4", "C"))
+
+
+class ServerTimingTests(FakeUpstreamMixin, TestCase):
+
+    def upstream_calls(self, response):
+        parts = [p.strip() for p in response["Server-Timing"].split(",")]
+        upstream = [p for p in parts if p.startswith("upstream;")]
+        self.assertEqual(len(upstream), 1, response["Server-Timing"])
+        return int(upstream[0].split('desc="')[1].split(" ")[0])
+
+    def test_fanned_out_writes_count_toward_the_request(self):
+        self.get_batch()
+        r = self.post_batch(full_batch(TOTAL))
+        self.assertTrue(r.json()["errno"])
+        # 每張卡的 POST 在 thread pool 裡送，也要算進這個 request
+        self.assertGreaterEqual(self.upstream_calls(r), TOTAL)
+
+    def test_bulk_edit_counts_every_patch(self):
+        self.get_batch()
+        self.post_batch(full_batch(TOTAL))
+        edits = [{"task_id": TASK_ID_BASE + i, "inner_id": i, "rating": 1, "relation": "I"} for i in range(1, 6)]
+        r = self.client.patch("/edit/bulk/", json.dumps({"edits": edits}), content_type="application/json")
+        self.assertEqual(r.status_code, 200)
+        self.assertGreaterEqual(self.upstream_calls(r), len(edits))
+
+    def test_metrics_endpoint_reports_views_and_upstream_calls(self):
+        self.get_batch()
+        r = self.client.get("/metrics")
+        self.assertEqual(r.status_code, 200)
+        text = r.content.decode("utf-8")
+        self.assertIn('ls_view_duration_seconds_count{view="batch_api",method="GET",status="200"}', text)
+        self.assertIn("ls_upstream_request_duration_seconds_bucket{", text)
+        self.assertIn('ls_view_phase_seconds_count{view="batch_api",phase="token"}', text)
+
+
+class BulkWriteTests(FakeUpstreamMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.project = self.add_project(projects.DEFAULT_PROJECT_ID, default=True, bulk_writes=True)
+
+    def mixed_batch(self):
+        return full_batch(TOTAL // 2, "1", "E") + full_batch(TOTAL - TOTAL // 2, "0", "C")
+
+    def reject_bulk(self, when, status=400):
+        real = self.ls.handle
+
+        def handle(method, path, query, body):
+            if path == "/api/annotations/bulk/" and when(body):
+                return status, {"detail": "rejected"}, {}
+            return real(method, path, query, body)
+
+        self.patch(mock.patch.object(self.ls, "handle", handle))
+
+    def test_one_bulk_call_per_label_and_each_task_indexed(self):
+        self.get_batch()
+        r = self.post_batch(self.mixed_batch())
+        self.assertTrue(r.json()["errno"])
+        self.assertEqual(self.ls.counts["POST /api/annotations/bulk/"], 2)
+        self.assertEqual(self.ls.counts["POST /api/tasks/N/annotations/"], 0)
+        self.assertEqual(self.upstream_label(TASK_ID_BASE + 1), ("1", "E"))
+        self.assertEqual(self.upstream_label(TASK_ID_BASE + TOTAL), ("0", "C"))
+        # 每個 task 的 annotation id 都記下來了：修改走 PATCH，不會多建一筆
+        r = self.client.patch("/edit/", json.dumps({"task_id": TASK_ID_BASE + 1, "inner_id": 1, "rating": 2,
+                                                   "relation": "S"}), content_type="application/json")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(self.annotation_count(TASK_ID_BASE + 1), 1)
+        self.assertEqual(self.upstream_label(TASK_ID_BASE + 1), ("2", "S"))
+
+    def test_rejected_group_is_resent_one_task_at_a_time(self):
+        self.reject_bulk(lambda body: body["result"][0]["value"]["choices"] == ["0"])
+        self.get_batch()
+        r = self.post_batch(self.mixed_batch())
+        self.assertTrue(r.json()["errno"])
+        self.assertEqual(self.ls.counts["POST /api/tasks/N/annotations/"], TOTAL - TOTAL // 2)
+        self.assertEqual(self.annotation_count(), TOTAL)
+        self.assertTrue(self.project.bulk_writes)
+
+    def test_upstream_without_bulk_endpoint_falls_back_for_good(self):
+        tried = []
+        self.reject_bulk(lambda body: not tried.append(body), status=404)
+        self.get_batch()
+        with self.assertLogs("main.mirror", "WARNING"):
+            self.post_batch(self.mixed_batch())
+        self.assertEqual(self.annotation_count(), TOTAL)
+        self.assertFalse(self.project.bulk_writes)
+        self.get_batch()
+        self.post_batch(full_batch(TOTAL))
+        self.assertEqual(self.annotation_count(), 2 * TOTAL)
+        # 第一批的兩組各試過一次，之後不再試
+        self.assertEqual(len(tried), 2)
+
+
+class CacheTests(FakeUpstreamMixin, TestCase):
+
+    def test_batch_etag_and_compression(self):
+        r = self.get_batch()
+        tag = r["ETag"]
+        self.assertEqual(self.get_batch().status_code, 200)
+        r = self.client.get("/api/batch/", HTTP_IF_NONE_MATCH=tag)
+        self.assertEqual(r.status_code, 304)
+
+        r = self.client.get("/api/batch/", HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(r["Content-Encoding"], "gzip")
+        self.assertEqual(r["ETag"], tag)
+        self.assertEqual(len(json.loads(gzip.decompress(r.content))["rows"]), TOTAL)
+
+    def test_etag_changes_after_submit(self):
+        tag = self.get_batch()["ETag"]
+        self.post_batch(full_batch(TOTAL))
+        r = self.client.get("/api/batch/", HTTP_IF_NONE_MATCH=tag)
+        self.assertEqual(r.status_code, 200)
+
+    def test_history_page_is_cached(self):
+        self.label_upstream(range(1, 31))
+        query = {"current_inner_id": 1, "current_annotation_num": 1, "direction": "forward"}
+        first = self.client.get("/api/history/", query)
+        calls = self.ls.stats().get("GET /api/tasks/", 0)
+        second = self.client.get("/api/history/", query)
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(self.ls.stats().get("GET /api/tasks/", 0), calls)
+
+
+class FieldProjectionTests(FakeUpstreamMixin, TestCase):
+
+    def test_task_queries_ask_only_for_used_fields(self):
+        real, queries = self.ls.handle, []
+
+        def handle(method, path, query, body):
+            if path == "/api/tasks/":
+                queries.append(query)
+            return real(method, path, query, body)
+
+        self.patch(mock.patch.object(self.ls, "handle", handle))
+        self.get_batch()
+        self.assertTrue(queries)
+        for query in queries:
+            self.assertEqual(query["include"][0].split(","), list(UPSTREAM_FIELDS))
+
+    def test_rows_carry_labels_and_latest_annotation(self):
+        self.label_upstream([2], rating="4", relation="C")
+        self.label_upstream([2], rating="1", relation="S")
+        token = self.project.token_manager.get()
+        rows = views.get_unlabeled_task(self.project, token, 0, 3)
+        self.assertTrue(all(isinstance(row, TaskRow) for row in rows))
+        self.assertEqual([(r.inner_id, r.rating, r.relation) for r in rows],
+                         [(1, None, None), (2, "1", "S"), (3, None, None)])
+        latest = max(a["id"] for a in self.ls.annotations.values() if a["task"] == TASK_ID_BASE + 2)
+        self.assertEqual(rows[1].annotation_id, latest)
+        self.assertEqual(rows[0].image_url, f"{self.ls.url}/media/1.png")
+
+
+class FanInTests(FakeUpstreamMixin, TestCase):
+
+    def test_batch_waits_for_the_longest_chain_not_the_sum(self):
+        self.project.token_manager.get()
+        self.ls.latency = 0.2
+        self.addCleanup(setattr, self.ls, "latency", 0.0)
+        t0 = time.monotonic()
+        inner_id, num, tasks = views.fresh_batch(self.project, self.project.token_manager.get())
+        elapsed = time.monotonic() - t0
+        self.assertEqual((inner_id, num, len(tasks)), (1, 0, TOTAL))
+        # 游標與專案計數一起送，task 查詢只等游標：兩段延遲，不是三段
+        self.assertLess(elapsed, 0.55)
+        self.assertEqual(self.ls.counts["GET /api/projects/N"], 1)
+
+    def test_skips_unwanted_steps_and_rejects_cycles(self):
+        ran = []
+        steps = {
+            "a": ((), lambda: ran.append("a") or 1),
+            "b": (("a",), lambda a: ran.append("b") or a + 1),
+            "unused": ((), lambda: ran.append("unused")),
+        }
+        self.assertEqual(fanin.resolve(steps, ("b",)), {"b": 2})
+        self.assertEqual(ran, ["a", "b"])
+        with self.assertRaises(ValueError):
+            fanin.resolve({"x": (("y",), lambda y: y), "y": (("x",), lambda x: x)}, ("x",))
+
+    def test_failed_step_raises_its_error(self):
+        def boom():
+            raise requests.ConnectionError("down")
+
+        steps = {"ok": ((), lambda: 1), "bad": ((), boom)}
+        with self.assertRaises(requests.ConnectionError):
+            fanin.resolve(steps, ("ok", "bad"), self.project.executor)
+
+
+class StaleServingTests(FakeUpstreamMixin, TestCase):
+    """上游掛掉或太慢時退回上一批；用另一個專案，斷路器打開也不會留到別的測試"""
+
+    def setUp(self):
+        super().setUp()
+        self.other = self.add_project(7)
+        self.patch(mock.patch("main.ls_client.backoff_delay", lambda *args, **kwargs: 0))
+
+    def batch(self):
+        r = self.client.get("/p/7/api/batch/")
+        self.assertEqual(r.status_code, 200)
+        data = r.json()
+        return [row[1] for row in data["rows"]], data["stale"]
+
+    def upstream_down(self):
+        real = self.ls.handle
+
+        def handle(method, path, query, body):
+            if path == "/api/token/refresh/":
+                return real(method, path, query, body)
+            return 500, {"detail": "Internal server error"}, {}
+
+        self.patch(mock.patch.object(self.ls, "handle", handle))
+
+    def test_serves_last_batch_without_submitted_tasks_when_upstream_fails(self):
+        self.assertEqual(self.batch(), (list(range(1, TOTAL + 1)), False))
+        batch = full_batch(TOTAL)
+        batch[4] = {"num": None, "aux": "E", "combo": "_e"}
+        self.client.post("/p/7/", json.dumps({"batch": batch}), content_type="application/json")
+        self.upstream_down()
+        # 前四張已經寫上去了，退回的舊資料不能再給
+        self.assertEqual(self.batch(), (list(range(5, TOTAL + 1)), True))
+
+    def test_slow_upstream_serves_stale_then_stores_the_late_answer(self):
+        self.batch()
+        self.other.batch_cache.wait = 0.1
+        self.ls.latency = 0.3
+        self.addCleanup(setattr, self.ls, "latency", 0.0)
+        self.label_upstream([1, 2])
+        t0 = time.monotonic()
+        self.assertEqual(self.batch(), (list(range(1, TOTAL + 1)), True))
+        self.assertLess(time.monotonic() - t0, 0.3)
+        # 慢的那次在背景抓完、存起來
+        pending = self.other.batch_cache._inflight.get(self.other.project_id)
+        if pending is not None:
+            pending.result(timeout=5)
+        self.assertEqual([t.inner_id for t in self.other.batch_cache.peek(self.other.project_id)[0][2]],
+                         list(range(3, TOTAL + 3)))
+
+
+class PrefetchTests(FakeUpstreamMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.project.prefetcher = views.make_prefetcher(self.project)
+        self.addCleanup(self.project.prefetcher._executor.shutdown)
+
+    def inner_ids(self, r):
+        return [row[1] for row in r.json()["rows"]]
+
+    def test_next_batch_is_served_from_the_prefetch_buffer(self):
+        self.get_batch()
+        self.post_batch(full_batch(TOTAL))
+        # 送出後背景確認游標、抓好下一批；等它做完再看 GET 有沒有再打上游
+        self.project.prefetcher._pending[1].result(timeout=5)
+        fetched = self.ls.counts["GET /api/tasks/"]
+        r = self.get_batch()
+        self.assertEqual(self.inner_ids(r), list(range(TOTAL + 1, 2 * TOTAL + 1)))
+        self.assertEqual(self.ls.counts["GET /api/tasks/"], fetched)
+
+    def test_cursor_moved_by_someone_else_discards_the_speculative_batch(self):
+        self.get_batch()
+        self.post_batch(full_batch(TOTAL))
+        # 別人在上游直接標了接在後面的三筆：投機抓的 11.. 那批不能用
+        self.label_upstream(range(TOTAL + 1, TOTAL + 4))
+        self.project.prefetcher.on_submitted()
+        r = self.get_batch()
+        self.assertEqual(self.inner_ids(r), list(range(TOTAL + 4, 2 * TOTAL + 4)))
+
+
+class OutboxTests(FakeUpstreamMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.enable("MIRROR", "OUTBOX")
+
+    def submit(self):
+        self.get_batch()
+        r = self.post_batch(full_batch(TOTAL))
+        self.assertEqual(r.json()["mode"], "outbox")
+        return r
+
+    def test_submit_is_queued_then_flushed(self):
+        self.submit()
+        self.assertEqual(self.annotation_count(), 0)
+        self.assertEqual(OutboxItem.objects.filter(status=OutboxItem.PENDING).count(), TOTAL)
+        # 還沒送出的 task 不會再發給下一批
+        self.assertNotIn(TASK_ID_BASE + 1, [row[0] for row in self.get_batch().json()["rows"]])
+
+        self.assertEqual(outbox.flush(), TOTAL)
+        self.assertEqual(OutboxItem.objects.filter(status=OutboxItem.DONE).count(), TOTAL)
+        self.assertEqual(self.annotation_count(), TOTAL)
+
+    def test_resend_after_lost_response_does_not_duplicate(self):
+        self.submit()
+        item = OutboxItem.objects.order_by("id").first()
+        # 上一次其實寫進去了，只是沒收到回應
+        self.assertEqual(outbox.send(item)[0], OutboxItem.DONE)
+        OutboxItem.objects.filter(pk=item.pk).update(attempts=1)
+        outbox.flush()
+        self.assertEqual(self.annotation_count(item.task_id), 1)
+
+    def test_reclaimed_item_checks_upstream_before_resending(self):
+        self.submit()
+        # worker 認領、POST 成功之後就掛了，沒寫回結果
+        item = outbox.claim(1)[0]
+        self.assertEqual(item.attempts, 1)
+        self.assertEqual(outbox.send(item)[0], OutboxItem.DONE)
+        OutboxItem.objects.filter(pk=item.pk).update(claimed_at=item.claimed_at - outbox.CLAIM_TIMEOUT * 2)
+        outbox.flush()
+        self.assertEqual(OutboxItem.objects.get(pk=item.pk).status, OutboxItem.DONE)
+        self.assertEqual(self.annotation_count(item.task_id), 1)
+
+    def test_one_bad_item_does_not_strand_the_rest(self):
+        self.submit()
+        first = OutboxItem.objects.order_by("id").first()
+        send = outbox.send
+
+        def flaky(item):
+            if item.pk == first.pk:
+                raise RuntimeError("boom")
+            return send(item)
+
+        with mock.patch.object(outbox, "send", side_effect=flaky), self.assertLogs("main.outbox", "ERROR"):
+            outbox.flush()
+        self.assertFalse(OutboxItem.objects.filter(status=OutboxItem.SENDING).exists())
+        first.refresh_from_db()
+        self.assertEqual(first.status, OutboxItem.PENDING)
+        self.assertIn("boom", first.last_error)
+        self.assertEqual(self.annotation_count(), TOTAL - 1)
+
+    def test_non_json_success_fails_only_that_item(self):
+        self.submit()
+        item = outbox.claim(1)[0]
+        resp = requests.Response()
+        resp.status_code, resp._content = 201, b"<html>oops</html>"
+        with mock.patch.object(self.project.ls, "post", return_value=resp):
+            status, detail = outbox.send(item)
+        self.assertEqual(status, OutboxItem.FAILED)
+        self.assertIn("JSON", detail)
+
+    def test_failed_send_returns_task_to_unlabeled(self):
+        self.submit()
+        with mock.patch.object(outbox, "send", return_value=(OutboxItem.FAILED, "rejected")):
+            outbox.flush()
+        self.assertFalse(Task.objects.filter(project_id=self.project.project_id, rating__isnull=False).exists())
+
+    def test_edit_of_pending_item_amends_it(self):
+        self.submit()
+        task_id = TASK_ID_BASE + 1
+        r = self.client.patch("/edit/", json.dumps({"task_id": task_id, "inner_id": 1, "rating": 0, "relation": "i"}),
+                              content_type="application/json")
+        self.assertEqual(r.json()["action"], "queued")
+        outbox.flush()
+        self.assertEqual(self.annotation_count(task_id), 1)
+        self.assertEqual(self.upstream_label(task_id), ("0", "I"))
+
+    def test_edit_while_sending_waits_and_patches(self):
+        self.submit()
+        task_id = TASK_ID_BASE + 1
+        OutboxItem.objects.filter(task_id=task_id).update(status=OutboxItem.SENDING)
+
+        def finish_send(_):
+            # 等的時候 flusher 把那一筆送完了
+            item = OutboxItem.objects.get(task_id=task_id)
+            outbox._apply(item, *outbox.send(item))
+
+        with mock.patch.object(outbox.time, "sleep", side_effect=finish_send):
+            r = self.client.patch("/edit/", json.dumps(
+                {"task_id": task_id, "inner_id": 1, "rating": 4, "relation": "e"}), content_type="application/json")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json()["action"], "patch")
+        self.assertEqual(self.annotation_count(task_id), 1)
+        self.assertEqual(self.upstream_label(task_id), ("4", "E"))
+
+
+    def test_bulk_edit_waits_once_for_all_sending_items(self):
+        self.submit()
+        OutboxItem.objects.update(status=OutboxItem.SENDING)
+        edits = [{"task_id": TASK_ID_BASE + i, "inner_id": i, "rating": 1, "relation": "c"} for i in range(1, 6)]
+        self.patch(mock.patch.object(outbox, "AMEND_WAIT", 0.3))
+        start = time.monotonic()
+        r = self.client.patch("/edit/bulk/", json.dumps({"edits": edits}), content_type="application/json")
+        # 五筆共用一個期限，不是一筆等完再等下一筆
+        self.assertLess(time.monotonic() - start, 1.0)
+        self.assertEqual([row["status"] for row in r.json()["results"]], [409] * 5)
+
+    def test_flusher_starts_only_for_servers(self):
+        cases = [(["gunicorn"], {}, True), (["manage.py", "migrate"], {}, False),
+                 (["manage.py", "test"], {}, False), (["manage.py", "runserver"], {}, False),
+                 (["manage.py", "runserver"], {"RUN_MAIN": "true"}, True)]
+        for argv, env, expected in cases:
+            with mock.patch.object(sys, "argv", argv), mock.patch.dict(os.environ, env):
+                self.assertEqual(outbox._serves_requests(), expected, argv)
+
+
+class PropagationTests(FakeUpstreamMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        # 第二批的 12 號跟第一批的 2 號（"query 2" / "item 2"）是同一組，只差大小寫與標點
+        self.set_pair(12, "  QUERY, 2 ", "Item-2")
+
+    def set_pair(self, inner_id, query="query 2", item="item 2"):
+        data = self.ls.tasks[inner_id]["data"]
+        self.addCleanup(data.update, dict(data))
+        data.update(query=query, IT_NAME=item)
+
+    def mode(self, mode):
+        self.patch(mock.patch.object(propagation, "MODE", mode))
+
+    def second_batch(self, first):
+        self.get_batch()
+        self.post_batch(first)
+        return {row[1]: row for row in self.get_batch().json()["rows"]}
+
+    def test_prefill_suggests_the_label_of_the_same_pair(self):
+        self.mode("prefill")
+        rows = self.second_batch(full_batch(TOTAL, "3", "S"))
+        self.assertEqual(rows[12][5:8], ["3s", False, False])
+        self.assertEqual(self.annotation_count(), TOTAL)
+
+    def test_submit_writes_exact_matches_and_skips_them(self):
+        self.mode("submit")
+        rows = self.second_batch(full_batch(TOTAL, "3", "S"))
+        self.assertNotIn(12, rows)
+        self.assertEqual(self.upstream_label(TASK_ID_BASE + 12), ("3", "S"))
+        self.assertEqual(self.annotation_count(), TOTAL + 1)
+
+    def test_conflicting_labels_only_prefill(self):
+        self.mode("submit")
+        self.set_pair(3)
+        self.set_pair(6)
+        first = full_batch(TOTAL, "3", "S")
+        first[2] = first[5] = {"num": "0", "aux": "I", "combo": "0i"}
+        rows = self.second_batch(first)
+        # 2 號標 3S，3 號與 6 號標 0I：票多的是 0I，但有衝突，不自動送
+        self.assertEqual(rows[12][5:7], ["0i", True])
+        self.assertIsNone(self.upstream_label(TASK_ID_BASE + 12))
+
+
+class LeaseTests(FakeUpstreamMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.enable("LEASES")
+
+    def test_annotators_get_disjoint_batches(self):
+        a, b = self.client_class(), self.client_class()
+        rows_a = {row[0] for row in self.get_batch(a).json()["rows"]}
+        rows_b = {row[0] for row in self.get_batch(b).json()["rows"]}
+        self.assertEqual(len(rows_a), TOTAL)
+        self.assertEqual(len(rows_b), TOTAL)
+        self.assertFalse(rows_a & rows_b)
+
+        self.post_batch(full_batch(TOTAL), client=b)
+        self.assertEqual({a["task"] for a in self.ls.annotations.values()}, rows_b)
+
+    def test_post_without_lease_is_rejected(self):
+        self.get_batch()
+        Lease.objects.all().delete()
+        r = self.post_batch(full_batch(TOTAL))
+        self.assertEqual(r.status_code, 409)
+        self.assertEqual(self.annotation_count(), 0)
+
+
+class TokenTests(FakeUpstreamMixin, TestCase):
+
+    def refreshes(self):
+        return self.ls.counts["POST /api/token/refresh/"]
+
+    def test_concurrent_requests_refresh_once(self):
+        self.ls.latency = 0.1
+        self.addCleanup(setattr, self.ls, "latency", 0.0)
+        tokens = []
+        threads = [threading.Thread(target=lambda: tokens.append(self.project.token_manager.get())) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.refreshes(), 1)
+        self.assertEqual(len(set(tokens)), 1)
+
+    def test_invalidate_only_drops_the_rejected_token(self):
+        manager = self.project.token_manager
+        first = manager.get()
+        # 別人拿舊 token 被 401：手上這顆已經不是它了，不要再換一次
+        manager.invalidate("some-older-token")
+        self.assertEqual(manager.get(), first)
+        self.assertEqual(self.refreshes(), 1)
+        manager.invalidate(first)
+        manager.get()
+        self.assertEqual(self.refreshes(), 2)
+
+    def test_refreshes_before_expiry(self):
+        # 上游發的 token 剩不到 REFRESH_MARGIN 秒：每次都當作快過期、重新換
+        self.ls.token_ttl = ls_token.REFRESH_MARGIN // 2
+        self.addCleanup(setattr, self.ls, "token_ttl", 300)
+        manager = self.project.token_manager
+        manager.get()
+        self.assertIsNone(manager.cached())
+        manager.get()
+        self.assertEqual(self.refreshes(), 2)
+
+
+class ThrottleTests(FakeUpstreamMixin, TestCase):
+    """用另一個專案的那組 limiter（預設專案的是 module 層級共用的，改了會留到別的測試）"""
+
+    def setUp(self):
+        super().setUp()
+        self.other = self.add_project(7, max_workers=3, concurrency_min=1, concurrency_max=3)
+        self.other.token_manager.get()
+
+    def track_concurrency(self):
+        """包住 fake 的 handle，記上游同時在處理的最大請求數"""
+        real, lock, state = self.ls.handle, threading.Lock(), {"now": 0, "peak": 0}
+
+        def handle(*args):
+            with lock:
+                state["now"] += 1
+                state["peak"] = max(state["peak"], state["now"])
+            try:
+                return real(*args)
+            finally:
+                with lock:
+                    state["now"] -= 1
+
+        self.patch(mock.patch.object(self.ls, "handle", handle))
+        return state
+
+    def test_concurrency_stays_within_the_limit(self):
+        self.ls.latency = 0.05
+        self.addCleanup(setattr, self.ls, "latency", 0.0)
+        state = self.track_concurrency()
+        threads = [threading.Thread(target=self.other.ls.get, args=(f"/api/tasks/{TASK_ID_BASE + i}/",))
+                   for i in range(1, 13)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertLessEqual(state["peak"], 3)
+        self.assertEqual(self.other.limits.limiter.inflight, 0)
+
+    def test_throttled_response_halves_the_limit_and_pauses_the_bucket(self):
+        real, answered = self.ls.handle, []
+
+        def handle(method, path, query, body):
+            if not answered:
+                answered.append(path)
+                return 429, {"detail": "Request was throttled."}, {"Retry-After": "0.3"}
+            return real(method, path, query, body)
+
+        self.patch(mock.patch.object(self.ls, "handle", handle))
+        # 不靠重試的 backoff：重送要等的是整個 bucket 的暫停
+        self.patch(mock.patch("main.ls_client.backoff_delay", lambda *args, **kwargs: 0))
+        t0 = time.monotonic()
+        r = self.other.ls.get(f"/api/tasks/{TASK_ID_BASE + 1}/")
+        self.assertEqual(r.status_code, 200)
+        self.assertGreaterEqual(time.monotonic() - t0, 0.25)
+        # 3 砍半成 1.5，重送成功再加回 1 / 1.5
+        self.assertEqual(self.other.limits.limiter._limit, 1.5 + 1 / 1.5)
+
+
+class PooledClientTests(FakeUpstreamMixin, TestCase):
+
+    def fail_first(self, *statuses):
+        """上游的前幾個請求（不含換 token）依序回 statuses，之後照常；回傳 sleep 過的秒數"""
+        faults = [(status, {"detail": "injected"}) for status in statuses]
+        self.patch(mock.patch.object(self.ls, "_fault",
+                                     lambda path: faults.pop(0) if faults and path != "/api/token/refresh/" else None))
+        delays = []
+        self.patch(mock.patch("main.ls_client.time.sleep", delays.append))
+        return delays
+
+    def test_sequential_calls_reuse_one_connection(self):
+        for inner_id in range(1, 11):
+            self.assertEqual(self.project.ls.get(f"/api/tasks/{TASK_ID_BASE + inner_id}/").status_code, 200)
+        pools = self.project.ls.session.get_adapter(self.ls.url).poolmanager.pools
+        self.assertEqual(sum(pools[key].num_connections for key in pools.keys()), 1)
+
+    def test_throttled_post_is_resent_after_retry_after(self):
+        delays = self.fail_first(429)
+        r = self.project.ls.post(f"/api/tasks/{TASK_ID_BASE + 1}/annotations/",
+                                 json=views.build_annotation_payload("1", "E"))
+        self.assertEqual(r.status_code, 201)
+        # fake 的 429 帶 Retry-After: 0，照它等而不是用 jitter backoff
+        self.assertEqual(delays, [0.0])
+        self.assertEqual(self.annotation_count(TASK_ID_BASE + 1), 1)
+
+    def test_server_error_retries_get_but_not_post(self):
+        self.fail_first(500)
+        self.assertEqual(self.project.ls.get(f"/api/tasks/{TASK_ID_BASE + 1}/").status_code, 200)
+        self.fail_first(500)
+        r = self.project.ls.post(f"/api/tasks/{TASK_ID_BASE + 1}/annotations/",
+                                 json=views.build_annotation_payload("1", "E"))
+        self.assertEqual(r.status_code, 500)
+        self.assertEqual(self.annotation_count(), 0)
+
+
+class AsyncClientTests(FakeUpstreamMixin, TestCase):
+
+    def drop_once(self, error):
+        """httpx 的第一個請求在送出後斷掉（error），之後照常"""
+        real = httpx.AsyncClient.request
+        calls = []
+
+        async def request(client, method, url, **kwargs):
+            calls.append(method)
+            if len(calls) == 1:
+                raise error("connection dropped", request=httpx.Request(method, url))
+            return await real(client, method, url, **kwargs)
+
+        self.patch(mock.patch.object(httpx.AsyncClient, "request", request))
+        self.patch(mock.patch("main.ls_async.backoff_delay", lambda *args, **kwargs: 0))
+        return calls
+
+    def call(self, method, path, **kwargs):
+        async def run():
+            client = self.project.async_client()
+            try:
+                return await client.request(method, path, **kwargs)
+            finally:
+                await client.aclose()
+        return asyncio.run(run())
+
+    def test_dropped_connection_is_retried_for_idempotent_requests(self):
+        calls = self.drop_once(httpx.RemoteProtocolError)
+        r = self.call("GET", f"/api/tasks/{TASK_ID_BASE + 1}/")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(calls, ["GET", "GET"])
+        self.assertEqual(self.project.limits.limiter.inflight, 0)
+
+    def test_dropped_connection_counts_as_breaker_failure(self):
+        self.drop_once(httpx.ReadError)
+        with self.assertRaises(httpx.ReadError):
+            self.call("POST", "/api/annotations/", json={})
+        self.assertEqual(self.project.circuit._failures, 1)
+        self.assertEqual(self.project.limits.limiter.inflight, 0)
+
+
+class AsyncViewTests(FakeUpstreamMixin, TestCase):
+    """LABEL_STUDIO_ASYNC_VIEWS 打開時的頁面（async_views），一樣打 FakeLabelStudio"""
+
+    def setUp(self):
+        super().setUp()
+        self.use_urls(async_views=True)
+        self.addCleanup(self.use_urls, async_views=False)
+
+    def use_urls(self, async_views):
+        with self.settings(LABEL_STUDIO_ASYNC_VIEWS=async_views):
+            importlib.reload(project_urls)
+        clear_url_caches()
+
+    def test_routes_to_async_views(self):
+        self.assertIs(resolve("/api/batch/").func.__wrapped__, async_views.batch_api.__wrapped__)
+
+    def test_batch_and_write(self):
+        r = self.get_batch()
+        self.assertEqual([row[1] for row in r.json()["rows"]], list(range(1, TOTAL + 1)))
+        r = self.post_batch(full_batch(TOTAL))
+        self.assertTrue(r.json()["errno"])
+        self.assertEqual(self.annotation_count(), TOTAL)
+        self.assertEqual(self.upstream_label(TASK_ID_BASE + TOTAL), ("2", "S"))
+
+    def test_edit_patches_existing_annotation(self):
+        self.get_batch()
+        self.post_batch(full_batch(TOTAL))
+        task_id = TASK_ID_BASE + 3
+        r = self.client.patch("/edit/", json.dumps({"task_id": task_id, "inner_id": 3, "rating": 0, "relation": "I"}),
+                              content_type="application/json")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(self.annotation_count(task_id), 1)
+        self.assertEqual(self.upstream_label(task_id), ("0", "I"))
+
+    def test_unreachable_upstream_is_503(self):
+        self.add_project(projects.DEFAULT_PROJECT_ID, url="http://127.0.0.1:9", default=True)
+        self.patch(mock.patch("main.ls_async.backoff_delay", lambda *args, **kwargs: 0))
+        r = self.client.get("/api/batch/")
+        self.assertEqual(r.status_code, 503)
+        self.assertIn("Retry-After", r)
+
+
+class MultiProjectTests(FakeUpstreamMixin, TestCase):
+
+    def test_stuck_project_does_not_block_other_projects_refreshes(self):
+        other = self.add_project(2)
+        # 預設專案的背景重抓全部卡住
+        release = threading.Event()
+        self.addCleanup(release.set)
+        for _ in range(projects.REFRESH_WORKERS):
+            self.project.refresh_executor.submit(release.wait)
+
+        self.client.get("/p/2/api/batch/")
+        # 第二次起 batch_cache 是在背景重抓（等 STALE_WAIT 秒），卡在別人的 pool 上就會退回舊的一批
+        r = self.client.get("/p/2/api/batch/")
+        self.assertFalse(r.json()["stale"])
+        self.assertIsNot(other.refresh_executor, self.project.refresh_executor)
+
+
+    def second_instance(self):
+        """另一個 Label Studio（task / annotation id 跟預設專案那個完全重疊）上的專案 2"""
+        ls = FakeLabelStudio(num_tasks=50).start()
+        self.addCleanup(ls.stop)
+        self.add_project(2, ls)
+        return ls
+
+    def edit(self, prefix, task_id, rating, relation):
+        return self.client.patch(f"{prefix}edit/", json.dumps(
+            {"task_id": task_id, "inner_id": task_id - TASK_ID_BASE, "rating": rating, "relation": relation}),
+            content_type="application/json")
+
+    def test_routes_writes_to_each_projects_upstream(self):
+        ls2 = self.second_instance()
+        self.get_batch(self.client)
+        self.client.get("/p/2/api/batch/")
+        r = self.client.post("/p/2/", json.dumps({"batch": full_batch(TOTAL, "4", "E")}),
+                             content_type="application/json")
+        self.assertTrue(r.json()["errno"])
+        self.assertEqual(len(ls2.annotations), TOTAL)
+        self.assertEqual(self.annotation_count(), 0)
+        self.assertEqual(self.client.get("/p/404/api/batch/").status_code, 404)
+
+    def test_same_task_id_in_two_projects_stays_separate(self):
+        self.enable("MIRROR")
+        ls2 = self.second_instance()
+        for prefix in ("/", "/p/2/"):
+            self.client.get(f"{prefix}api/batch/")
+            self.client.post(prefix, json.dumps({"batch": full_batch(TOTAL, "2", "S")}),
+                             content_type="application/json")
+        task_id = TASK_ID_BASE + 1
+        self.assertEqual(Task.objects.filter(task_id=task_id, rating="2").count(), 2)
+
+        # 專案 2 的修改只 PATCH 它自己上游的那一筆，索引與鏡像也只動它自己的
+        self.assertEqual(self.edit("/p/2/", task_id, 0, "i").json()["action"], "patch")
+        anns = [a for a in ls2.annotations.values() if a["task"] == task_id]
+        self.assertEqual(len(anns), 1)
+        self.assertEqual(self.upstream_label(task_id), ("2", "S"))
+        self.assertEqual(Task.objects.get(project_id=2, task_id=task_id).rating, "0")
+        self.assertEqual(Task.objects.get(project_id=self.project.project_id, task_id=task_id).rating, "2")
+
+    def test_outbox_amend_only_touches_its_own_project(self):
+        self.enable("MIRROR", "OUTBOX")
+        self.second_instance()
+        for prefix in ("/", "/p/2/"):
+            self.client.get(f"{prefix}api/batch/")
+            self.client.post(prefix, json.dumps({"batch": full_batch(TOTAL, "2", "S")}),
+                             content_type="application/json")
+        task_id = TASK_ID_BASE + 1
+        self.assertEqual(self.edit("/p/2/", task_id, 3, "c").json()["action"], "queued")
+        labels = dict(OutboxItem.objects.filter(task_id=task_id).values_list("project_id", "rating"))
+        self.assertEqual(labels, {self.project.project_id: "2", 2: "3"})
+
+
+class ImageProxyTests(FakeUpstreamMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.patch(mock.patch.object(images, "CACHE_DIR", Path(tmp.name)))
+
+    def media(self, inner_id):
+        return f"{self.ls.url}/media/{inner_id}.png"
+
+    def test_proxy_caches_and_revalidates(self):
+        url = images.proxy_url(self.media(1), "card")
+        r = self.client.get(url)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r["Content-Type"], "image/jpeg")
+        self.assertIn("immutable", r["Cache-Control"])
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=r["ETag"]).status_code, 304)
+        self.assertEqual(self.client.get(images.proxy_url(self.media(1), "thumb")).status_code, 200)
+        # 兩種尺寸、三個 request，遠端只抓一次
+        self.assertEqual(self.ls.stats()["GET /media/N.png"], 1)
+
+    def test_rejects_tampered_token(self):
+        url = images.proxy_url(self.media(1))
+        self.assertEqual(self.client.get(url[:-2] + "xx/").status_code, 400)
+
+    def slow_fetches(self, slow_url, delay=0.5):
+        get = images._session.get
+
+        def slow(url, *args, **kwargs):
+            if url == slow_url:
+                time.sleep(delay)
+            return get(url, *args, **kwargs)
+
+        return mock.patch.object(images._session, "get", side_effect=slow)
+
+    def test_concurrent_requests_for_one_image_fetch_once(self):
+        url = self.media(2)
+        with self.slow_fetches(url, 0.2):
+            threads = [threading.Thread(target=images.source_digest, args=(url,)) for _ in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertEqual(self.ls.stats()["GET /media/N.png"], 1)
+
+    def test_slow_fetch_does_not_block_its_lock_stripe(self):
+        slow = self.media(3)
+        stripe = images._lock_for(slow)
+        other = next(self.media(i) for i in range(4, 1000) if images._lock_for(self.media(i)) is stripe)
+        with self.slow_fetches(slow, 1.0):
+            t = threading.Thread(target=images.source_digest, args=(slow,))
+            t.start()
+            time.sleep(0.1)
+            start = time.monotonic()
+            images.source_digest(other)
+            self.assertLess(time.monotonic() - start, 0.5)
+            t.join()
+
+
+class ExportTests(FakeUpstreamMixin, TestCase):
+
+    def test_export_pages_past_upstream_page_cap(self):
+        # 上游一頁最多 100 筆：要一路翻到空頁
+        self.label_upstream(range(1, 251))
+        rows = list(export.iter_rows(self.project.project_id))
+        self.assertEqual(len(rows), 250)
+        self.assertEqual([r.inner_id for r in rows], list(range(1, 251)))
+
+    def test_export_view_and_resume_after(self):
+        self.label_upstream(range(1, 21), rating="1", relation="I")
+        r = self.client.get("/export/", {"format": "ndjson", "after": 15})
+        rows = [json.loads(line) for line in b"".join(r.streaming_content).splitlines()]
+        self.assertEqual([row["inner_id"] for row in rows], [16, 17, 18, 19, 20])
+        self.assertEqual((rows[0]["rating"], rows[0]["relation"]), ("1", "I"))
+
+    def test_table_post_stays_csrf_exempt(self):
+        # export_labels 加在 table 前面時曾經把 table 的 @csrf_exempt 搶走
+        self.label_upstream(range(1, 31))
+        client = self.client_class(enforce_csrf_checks=True)
+        r = client.post("/table/", json.dumps({"current_inner_id": 21, "current_annotation_num": 21}),
+                        content_type="application/json")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(client.get("/export/").status_code, 200)
+
+
+class StatsTests(FakeUpstreamMixin, TestCase):
+
+    def stats(self):
+        r = self.client.get("/api/stats/")
+        self.assertEqual(r.status_code, 200)
+        return r.json()
+
+    def test_counts_confirmed_writes_and_moves_edits(self):
+        self.get_batch()
+        self.post_batch(full_batch(TOTAL, "2", "S"))
+        s = self.stats()
+        self.assertEqual(s["labeled"], TOTAL)
+        self.assertEqual(s["matrix"]["2"]["S"], TOTAL)
+        self.assertEqual(s["drift"], 0)
+
+        # 同一個答案改兩次只算一次
+        for _ in range(2):
+            self.client.patch("/edit/", json.dumps({"task_id": TASK_ID_BASE + 1, "inner_id": 1, "rating": 4,
+                                                    "relation": "e"}), content_type="application/json")
+        s = self.stats()
+        self.assertEqual(s["labeled"], TOTAL)
+        self.assertEqual(s["matrix"]["2"]["S"], TOTAL - 1)
+        self.assertEqual(s["matrix"]["4"]["E"], 1)
+
+    def test_read_path_never_syncs_upstream(self):
+        s = self.stats()
+        self.assertFalse(s["complete"])
+        self.assertEqual(self.ls.stats().get("GET /api/tasks/", 0), 0)
+        self.start_reconcile.assert_called_once_with(self.project)
+
+    def test_reconcile_picks_up_labels_made_elsewhere(self):
+        self.label_upstream(range(200, 205), rating="0", relation="I")
+        self.get_batch()
+        self.post_batch(full_batch(TOTAL, "2", "S"))
+        self.assertEqual(self.stats()["drift"], -5)
+
+        self.assertTrue(stats.reconcile(self.project)["rebuilt"])
+        s = self.stats()
+        self.assertEqual((s["labeled"], s["drift"], s["complete"]), (TOTAL + 5, 0, True))
+        self.assertEqual(s["matrix"]["0"]["I"], 5)
+        # 沒有漂移就只比對，不重建；重建後修改照樣是增量
+        self.assertFalse(stats.reconcile(self.project)["rebuilt"])
+        self.client.patch("/edit/", json.dumps({"task_id": TASK_ID_BASE + 200, "inner_id": 200, "rating": 1,
+                                                "relation": "c"}), content_type="application/json")
+        s = self.stats()
+        self.assertEqual((s["labeled"], s["matrix"]["0"]["I"], s["matrix"]["1"]["C"]), (TOTAL + 5, 4, 1))
+
+    def test_outbox_items_count_only_once_confirmed(self):
+        self.enable("MIRROR", "OUTBOX")
+        self.get_batch()
+        self.post_batch(full_batch(TOTAL))
+        s = self.stats()
+        self.assertEqual((s["labeled"], s["queued"]), (0, TOTAL))
+
+        first = OutboxItem.objects.order_by("id").first()
+        outbox._apply(first, OutboxItem.FAILED, "rejected")
+        outbox.flush()
+        s = self.stats()
+        self.assertEqual((s["labeled"], s["queued"]), (TOTAL - 1, 0))
+        self.assertEqual(s["ratings"]["2"], TOTAL - 1)
+        self.assertFalse(stats.reconcile(self.project)["rebuilt"])
+
+
+class MirrorSyncTests(FakeUpstreamMixin, TransactionTestCase):
+    """第一次同步在別的 thread 裡寫 DB，所以不包在 transaction 裡"""
+
+    def test_concurrent_first_requests_sync_once(self):
+        def slow_sync(project_id, *args, **kwargs):
+            time.sleep(0.2)
+            SyncState.objects.create(project_id=project_id, last_synced=timezone.now())
+
+        def first_request():
+            try:
+                mirror.ensure_fresh(self.project.project_id)
+            finally:
+                connection.close()
+
+        with mock.patch.object(mirror, "sync_project", side_effect=slow_sync) as sync:
+            threads = [threading.Thread(target=first_request) for _ in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertEqual(sync.call_count, 1)
+
+    def test_first_sync_mirrors_whole_project(self):
+        self.label_upstream(range(1, 6))
+        mirror.ensure_fresh(self.project.project_id)
+        self.assertEqual(Task.objects.filter(project_id=self.project.project_id).count(), 300)
+        self.assertEqual(mirror.cursor(self.project.project_id), (6, 5))
+
+
+class ImportLabelsTests(FakeUpstreamMixin, TransactionTestCase):
+    """import_labels 的 chunk 在別的 thread 裡寫 DB，所以不包在 transaction 裡"""
+
+    def setUp(self):
+        super().setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "labels.csv")
+
+    def write_csv(self, rows):
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write("task_id,inner_id,rating,relation\n")
+            for row in rows:
+                f.write(",".join(str(v) for v in row) + "\n")
+
+    def run_import(self, *args):
+        call_command("import_labels", self.path, "--chunk-size", "4", "--parallel", "2", *args,
+                     stdout=open(os.devnull, "w"), stderr=open(os.devnull, "w"))
+        with open(f"{self.path}.checkpoint.json", encoding="utf-8") as f:
+            return json.load(f)
+
+    def test_imports_validates_and_records_errors(self):
+        rows = [(TASK_ID_BASE + i, "", i % 5, "E") for i in range(1, 11)]
+        rows += [("", 20, 3, "Substitute"), (TASK_ID_BASE + 11, "", 9, "E"), ("", 9999, 1, "E")]
+        self.write_csv(rows)
+        checkpoint = self.run_import()
+        self.assertEqual(checkpoint, {"done": 13, "ok": 11, "failed": 2})
+        self.assertEqual(self.upstream_label(TASK_ID_BASE + 20), ("3", "S"))
+        self.assertIsNone(self.upstream_label(TASK_ID_BASE + 11))
+        with open(f"{self.path}.errors.ndjson", encoding="utf-8") as f:
+            self.assertEqual([json.loads(line)["line"] for line in f], [12, 13])
+
+    def test_resume_skips_done_rows_and_patches_instead_of_duplicating(self):
+        self.write_csv([(TASK_ID_BASE + i, "", 1, "C") for i in range(1, 9)])
+        self.run_import()
+        self.assertEqual(self.annotation_count(), 8)
+
+        # 第 5 列之後改了內容，checkpoint 退回第 4 列：只重做後面 4 列，而且是 PATCH
+        self.write_csv([(TASK_ID_BASE + i, "", 1 if i <= 4 else 4, "C") for i in range(1, 9)])
+        with open(f"{self.path}.checkpoint.json", "w", encoding="utf-8") as f:
+            json.dump({"done": 4, "ok": 4, "failed": 0}, f)
+        checkpoint = self.run_import()
+        self.assertEqual(checkpoint, {"done": 8, "ok": 8, "failed": 0})
+        self.assertEqual(self.annotation_count(), 8)
+        self.assertEqual(self.upstream_label(TASK_ID_BASE + 8), ("4", "C"))
+
+        # 全部做完之後再跑一次什麼都不送
+        patches = self.ls.stats().get("PATCH /api/annotations/N/", 0)
+        self.run_import()
+        self.assertEqual(self.ls.stats().get("PATCH /api/annotations/N/", 0), patches)
+
+    def test_last_row_wins_when_chunks_name_a_task_differently(self):
+        # 第一個 chunk 用 task_id、第二個用 inner_id 指同一個 task；第一個寫得比較慢
+        self.write_csv([(TASK_ID_BASE + 1, "", 1, "E"), (TASK_ID_BASE + 2, "", 1, "E"),
+                        ("", 1, 4, "C"), ("", 3, 4, "C")])
+        apply_edits = views.apply_edits
+
+        def slow_first_chunk(project, token, rows):
+            if any(row["rating"] == 1 for row in rows):
+                time.sleep(0.3)
+            return apply_edits(project, token, rows)
+
+        with mock.patch.object(views, "apply_edits", side_effect=slow_first_chunk):
+            call_command("import_labels", self.path, "--chunk-size", "2", "--parallel", "2",
+                         stdout=open(os.devnull, "w"), stderr=open(os.devnull, "w"))
+        self.assertEqual(self.upstream_label(TASK_ID_BASE + 1), ("4", "C"))
+
+    def test_last_row_wins_across_parallel_chunks(self):
+        self.write_csv([(TASK_ID_BASE + 1 + k % 2, "", k % 5, "E") for k in range(12)])
+        self.run_import()
+        self.assertEqual(self.upstream_label(TASK_ID_BASE + 1), ("0", "E"))
+        self.assertEqual(self.upstream_label(TASK_ID_BASE + 2), ("1", "E"))
@@ -0,0 +1,198 @@
+"""打 Label Studio 的流量控制（每個專案一組，同一專案的所有 view / thread 共用）
+
+- TokenBucket：每秒最多幾個請求（可短暫 burst）；收到帶 Retry-After 的 429 時整個桶暫停，
+  所有 view / thread 一起等，而不是各自撞牆
+- AdaptiveLimiter：AIMD 同時請求數。延遲維持在基準附近就慢慢加（每輪 +1），
+  遇到 429 / 5xx / 連線錯誤砍半，延遲明顯變長就小降
+
+LabelStudioClient 與 AsyncLabelStudioClient 每次送出前都會經過這兩關，
+所以 fan-out 的 thread pool 可以開到上限，實際並行數由 limiter 決定。
+兩者合成一個 Throttle，每個專案一組；下面的設定值是預設專案（與沒另外指定的專案）用的。
+"""
+import math
+import threading
+import time
+
+from django.conf import settings
+
+from . import metrics
+
+RATE_LIMIT = float(getattr(settings, "LABEL_STUDIO_RATE_LIMIT", 0) or 0)
+RATE_BURST = int(getattr(settings, "LABEL_STUDIO_RATE_BURST", 100))
+CONCURRENCY_MIN = int(getattr(settings, "LABEL_STUDIO_CONCURRENCY_MIN", 2))
+CONCURRENCY_MAX = int(getattr(settings, "LABEL_STUDIO_CONCURRENCY_MAX", 32))
+CONCURRENCY_INITIAL = int(getattr(settings, "LABEL_STUDIO_MAX_WORKERS", 8))
+# 延遲超過基準幾倍算「變慢」
+LATENCY_TOLERANCE = float(getattr(settings, "LABEL_STUDIO_LATENCY_TOLERANCE", 2.0))
+
+# async client 等名額時多久看一次
+POLL_INTERVAL = 0.005
+
+# fan-out 用的 thread pool 大小：開到 limiter 的上限，由 limiter 控制實際並行
+POOL_SIZE = CONCURRENCY_MAX
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """預約一個請求；回傳要等幾秒才能送（token 可以先欠著）"""
+        if not self.rate:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            return max(wait, self._paused_until - now)
+
+    def pause(self, seconds: float):
+        """上游叫我們等（Retry-After）：這段時間內大家都不送"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def available(self) -> float:
+        with self._lock:
+            now = time.monotonic()
+            return min(self.burst, self._tokens + (now - self._updated) * self.rate)
+
+
+class AdaptiveLimiter:
+
+    def __init__(self, initial: int, min_limit: int, max_limit: int, tolerance: float = LATENCY_TOLERANCE,
+                 backoff: float = 0.5):
+        self.min_limit = max(min_limit, 1)
+        self.max_limit = max(max_limit, self.min_limit)
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self._limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self._inflight = 0
+        # 「正常」延遲：比它低就立刻跟上，比它高只慢慢往上爬（換了新常態才會跟）
+        self._baseline = None
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    @property
+    def limit(self) -> int:
+        return max(self.min_limit, min(self.max_limit, math.floor(self._limit)))
+
+    @property
+    def inflight(self) -> int:
+        return self._inflight
+
+    def try_acquire(self) -> bool:
+        with self._cond:
+            if self._inflight < self.limit:
+                self._inflight += 1
+                return True
+            return False
+
+    def acquire(self):
+        with self._cond:
+            while self._inflight >= self.limit:
+                self._cond.wait()
+            self._inflight += 1
+
+    def release(self, latency: float = None, overloaded: bool = False, reason: str = ""):
+        with self._cond:
+            self._inflight -= 1
+            self._adjust(latency, overloaded, reason)
+            self._cond.notify_all()
+
+    def _adjust(self, latency, overloaded, reason):
+        now = time.monotonic()
+        # 同一波的失敗只算一次，不然一次 burst 的 429 會把 limit 砍到底
+        cooldown = self._baseline or 0.1
+        if overloaded:
+            if now - self._last_decrease > cooldown:
+                self._limit = max(self.min_limit, self._limit * self.backoff)
+                self._last_decrease = now
+                LIMIT_DECREASES.inc(reason or "overload")
+            return
+        if latency is None:
+            return
+        if self._baseline is None or latency < self._baseline:
+            self._baseline = latency
+        else:
+            self._baseline += (latency - self._baseline) * 0.01
+        if latency > self._baseline * self.tolerance:
+            if now - self._last_decrease > cooldown:
+                self._limit = max(self.min_limit, self._limit * 0.9)
+                self._last_decrease = now
+                LIMIT_DECREASES.inc("latency")
+            return
+        # 每一輪（limit 個成功）大約 +1
+        self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+
+
+def is_overload(status) -> bool:
+    """429 / 5xx / 連線錯誤（status 是例外名稱字串）都算上游吃不消"""
+    return not isinstance(status, int) or status == 429 or status >= 500
+
+
+class Throttle:
+    """一組 rate limit + AIMD 並行上限；每個專案各一組（見 main.projects），互不佔用名額"""
+
+    def __init__(self, rate: float = RATE_LIMIT, burst: int = RATE_BURST, initial: int = CONCURRENCY_INITIAL,
+                 min_limit: int = CONCURRENCY_MIN, max_limit: int = CONCURRENCY_MAX):
+        self.bucket = TokenBucket(rate, burst)
+        self.limiter = AdaptiveLimiter(initial, min_limit, max_limit)
+
+    def before_request(self) -> float:
+        """送出前：等 rate limit 與並行名額；回傳總共等了幾秒（sync 版）"""
+        t0 = time.perf_counter()
+        wait = self.bucket.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        self.limiter.acquire()
+        waited = time.perf_counter() - t0
+        THROTTLE_WAIT.observe(waited)
+        return waited
+
+    def after_request(self, status, latency: float, retry_after: float = None):
+        self.limiter.release(latency, is_overload(status), str(status))
+        if status == 429 and retry_after:
+            self.bucket.pause(retry_after)
+
+
+# 預設專案用的那一組
+default = Throttle()
+bucket = default.bucket
+limiter = default.limiter
+
+LIMIT_DECREASES = metrics.counter(
+    "ls_upstream_concurrency_decreases_total", "AIMD limit decreases, by reason", ("reason",))
+THROTTLE_WAIT = metrics.histogram(
+    "ls_upstream_throttle_wait_seconds", "Time spent waiting for the rate limiter / concurrency limit")
+CONCURRENCY_LIMIT = metrics.gauge(
+    "ls_upstream_concurrency_limit", "Current AIMD concurrency limit", labels=("project",))
+INFLIGHT = metrics.gauge(
+    "ls_upstream_inflight", "Label Studio requests currently in flight", labels=("project",))
+RATE = metrics.gauge(
+    "ls_upstream_rate_limit", "Token-bucket rate (requests per second, 0 = unlimited)", labels=("project",))
+RATE_TOKENS = metrics.gauge(
+    "ls_upstream_rate_tokens", "Tokens currently available in the bucket", labels=("project",))
+
+
+def expose(project_id, limits: Throttle):
+    """把一個專案的 limiter / bucket 掛到 /metrics（label project）"""
+    CONCURRENCY_LIMIT.bind(lambda: limits.limiter.limit, project_id)
+    INFLIGHT.bind(lambda: limits.limiter.inflight, project_id)
+    RATE.bind(lambda: limits.bucket.rate, project_id)
+    RATE_TOKENS.bind(limits.bucket.available, project_id)
+
+
+def before_request() -> float:
+    return default.before_request()
+
+
+def after_request(status, latency: float, retry_after: float = None):
+    default.after_request(status, latency, retry_after)
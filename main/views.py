@@ -1,7 +1,7 @@
 import json
 from django.utils import timezone as dj_tz
 from datetime import timezone as dt_tz
-from django.http import JsonResponse, HttpResponseBadRequest
+from django.http import HttpResponse, JsonResponse, HttpResponseBadRequest, StreamingHttpResponse
 import requests
 from django.conf import settings
 from django.shortcuts import render
@@ -9,25 +9,45 @@ from django.http import HttpResponseServerError
 from datetime import datetime, timezone
 from django.views.decorators.csrf import csrf_exempt
 from concurrent.futures import ThreadPoolExecutor, as_completed
-MAX_WORKERS = 8
-
-LS_URL = getattr(settings, "LABEL_STUDIO_URL")            # 例如: "https://app.humansignal.com"
-LS_TOKEN = getattr(settings, "LABEL_STUDIO_TOKEN")        # 這是你的 PAT（Personal Access Token）
-PROJECT_ID = int(getattr(settings, "PROJECT_ID"))
+import contextvars
+from . import (annotation_index, breaker, compact, counters, export, fanin, images, leases, metrics, mirror, outbox,
+               projects, propagation, stats)
+from .prefetch import BatchPrefetcher
+from .rows import UPSTREAM_FIELDS, TaskRow, dumps, parse_tasks
+# 上游網址、PAT、專案與一批幾張（TOTAL）都在 main.projects：每個專案各自的 token、連線池與並行上限。
+# 批次送出 / 批次修改的 thread pool 開到該專案 limiter 的上限，實際並行數由 throttle 的 AIMD 決定
+#（LABEL_STUDIO_MAX_WORKERS 現在是起始的並行數）
 MY_UID = int(getattr(settings, "MY_UID"))
-total = int(getattr(settings, "TOTAL"))
 
 ALLOWED_REL = {'E', 'S', 'C', 'I'}  # ESCI
-FETCH_NUM = 100
-task_ids = []
-
-
-def get_access_token():
-    refresh_url = f"{LS_URL}/api/token/refresh/"
-    r = requests.post(refresh_url, json={"refresh": LS_TOKEN}, timeout=15)
-    r.raise_for_status()
-    data = r.json()
-    return data["access"]
+# table 一頁幾筆
+FETCH_NUM = int(getattr(settings, "LABEL_STUDIO_FETCH_NUM", 100))
+# /edit/bulk/ 一次最多幾筆（table 一頁是 FETCH_NUM 筆）
+MAX_BULK_EDITS = int(getattr(settings, "LABEL_STUDIO_MAX_BULK_EDITS", 500))
+
+# True：index / table 讀本地鏡像（main.models.Task），上游只負責寫入與背景同步
+MIRROR = bool(getattr(settings, "LABEL_STUDIO_MIRROR", False))
+# True：每位標註者（session）各自租一段 inner_id 區間，取代 process 全域的 task_ids
+LEASES = bool(getattr(settings, "LABEL_STUDIO_LEASES", False))
+# True：index POST 只寫進本地 outbox 就回應，背景再送上游（需要鏡像才能馬上反映已標註）
+OUTBOX = MIRROR and bool(getattr(settings, "LABEL_STUDIO_OUTBOX", False))
+# True：index GET 先回空殼，卡片由前端打 /api/batch/ 分段畫（第一個畫面不用等整批）
+INDEX_SHELL = bool(getattr(settings, "LABEL_STUDIO_INDEX_SHELL", False))
+# 每個專案最多記住幾個寫失敗、可以單獨重送的 task
+RETRYABLE_MAX = 5000
+
+
+def get_access_token(project):
+    # 快取中的 access token 還沒快過期就直接用，不再每次打 /api/token/refresh/
+    with metrics.phase("token"):
+        return project.token_manager.get()
+
+def try_access_token(project):
+    """換不到 token（上游掛了）就回 None：ls client 之後會自己再試，有快取的頁面可以先退回舊資料"""
+    try:
+        return get_access_token(project)
+    except requests.RequestException:
+        return None
 
 def make_headers(access_token: str):
     return {
@@ -35,19 +55,8 @@ def make_headers(access_token: str):
         "Content-Type": "application/json",
     }
 
-def get_view_data(ls_url: str, token: str, view_id: int) -> dict:
-    headers = {"Authorization": f"Token {token}"}
-    r = requests.get(f"{ls_url}/api/dm/views/{view_id}/", headers=headers, timeout=20)
-    r.raise_for_status()
-    v = r.json()
-    # 不同版本有時把 filters/ordering 放在 data 裡
-    data = v.get("data") or {}
-    data["id"] = v.get("id", view_id)
-    return data
-
-def get_unlabeled_task(project_id: int, token: str, inner_id: int, page):
-
-    headers = make_headers(token)
+def build_task_query(project_id: int, inner_id: int, page, updated_after: str = None,
+                     unlabeled_only: bool = False) -> dict:
 
     query_obj = {
         "filters": {
@@ -63,51 +72,82 @@ def get_unlabeled_task(project_id: int, token: str, inner_id: int, page):
         },
         "ordering": ["tasks:inner_id"]   # 與 inner_id 比較對齊
     }
+    if updated_after:
+        # 增量同步：只要上次同步之後有異動的 task
+        query_obj["filters"]["items"].append({
+            "filter": "filter:tasks:updated_at",
+            "operator": "greater",
+            "type": "Datetime",
+            "value": updated_after
+        })
+    if unlabeled_only:
+        query_obj["filters"]["items"].append({
+            "filter": "filter:tasks:total_annotations",
+            "operator": "equal",
+            "type": "Number",
+            "value": 0
+        })
 
     params = {
         "project": project_id,
         "page_size": page,
         "page": 1,
         "fields": "task_only",
+        # 只要用得到的欄位（predictions、drafts、完整 annotations 之類都不要）
+        "include": ",".join(UPSTREAM_FIELDS),
         "query": json.dumps(query_obj)
     }
 
     # 若你在程式其他地方有定義 VIEW_ID，就自動帶上，確保與 UI 視圖一致
     if "VIEW_ID" in globals() and globals().get("VIEW_ID"):
         params["view"] = globals()["VIEW_ID"]
+    return params
 
-    r = requests.get(f"{LS_URL}/api/tasks/", headers=headers, params=params, timeout=20)
+def get_unlabeled_task(project, token: str, inner_id: int, page, updated_after: str = None,
+                       unlabeled_only: bool = False):
+    """inner_id 之後的 page 筆 → [TaskRow, ...]"""
+    r = project.ls.get("tasks/", token, params=build_task_query(project.project_id, inner_id, page, updated_after,
+                                                                 unlabeled_only))
     r.raise_for_status()
-    data = r.json()
-    return data.get("tasks", data) if isinstance(data, dict) else (data or [])
-
-def get_views_id(project_id, access_token):
-    headers = make_headers(access_token)
-    params = {"project": project_id}  # ← 用 project 當 key
-    r = requests.post(f"{LS_URL}/api/dm/actions/",
-                      headers=headers,
-                      params={"id": "next_task", "project": PROJECT_ID},
-                      json={"project": PROJECT_ID},
-                      timeout=20)
+    return parse_tasks(r.content)
+
+def get_next_task(project, access_token):
+    """下一個要標的 task 的 inner_id"""
+    with metrics.phase("cursor"):
+        r = project.ls.post("dm/actions/", access_token,
+                            params={"id": "next_task", "project": project.project_id},
+                            json={"project": project.project_id})
     r.raise_for_status()
+    return r.json()["inner_id"]
+
+def get_project(project, access_token):
+    """專案資訊（已標註數等計數）；短期快取，自己送出成功時在本地更新"""
+    def load():
+        with metrics.phase("counters"):
+            r_proj = project.ls.get(f"projects/{project.project_id}", access_token)
+        r_proj.raise_for_status()
+        return r_proj.json()
+    return counters.project_counters.get(project.project_id, load)
+
+def cursor_steps(project, access_token):
+    """游標的相依圖：next_task 與專案計數互不相依，一起送"""
+    return {
+        "next_task": ((), lambda: get_next_task(project, access_token)),
+        "counters": ((), lambda: get_project(project, access_token)),
+    }
 
-    r_proj = requests.get(f"{LS_URL}/api/projects/{PROJECT_ID}",
-                      headers=headers,
-                      timeout=20)
-    r_proj.raise_for_status()
-    print(r_proj.json())
-    num_tasks_with_annotations = r_proj.json()["num_tasks_with_annotations"]
-
-    return r.json()["inner_id"],num_tasks_with_annotations
-
-def post_annotation(access, task_id, rating="0", relation="I"):
+def get_views_id(project, access_token):
+    out = fanin.resolve(cursor_steps(project, access_token), ("next_task", "counters"), project.executor)
+    return out["next_task"], out["counters"]["num_tasks_with_annotations"]
 
+def validate_annotation(task_id, rating, relation):
+    """回傳 (task_id, rating, relation, None)；不合法時最後一欄是錯誤訊息"""
     try:
         task_id = int(task_id)
     except (TypeError, ValueError):
-        return False, f"task_id 非整數：{task_id!r}"
+        return None, None, None, f"task_id 非整數：{task_id!r}"
     if task_id <= 0:
-        return False, f"task_id 不可為 0 或負數：{task_id}"
+        return None, None, None, f"task_id 不可為 0 或負數：{task_id}"
 
     # rating / relation 正規化
     rating = str(rating).strip()
@@ -120,12 +160,12 @@ def post_annotation(access, task_id, rating="0", relation="I"):
     if relation not in allowed_rel:
         relation = full2abbr.get(relation.upper(), relation)
     if rating not in allowed_ratings:
-        return False, f"rating 僅允許 {sorted(allowed_ratings)}，收到：{rating}"
+        return None, None, None, f"rating 僅允許 {sorted(allowed_ratings)}，收到：{rating}"
     if relation not in allowed_rel:
-        return False, f"relation 僅允許 {sorted(allowed_rel)}，收到：{relation}"
-
-    headers = make_headers(access)
+        return None, None, None, f"relation 僅允許 {sorted(allowed_rel)}，收到：{relation}"
+    return task_id, rating, relation, None
 
+def build_annotation_payload(rating: str, relation: str, region_key: str = None) -> dict:
     now_iso = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
 
     # ---- payload：不要放 project / task ----
@@ -149,199 +189,750 @@ def post_annotation(access, task_id, rating="0", relation="I"):
             },
         ],
     }
+    if region_key:
+        # 固定的 region id：重送前可以從上游的 annotation 認出是不是自己寫過的
+        payload["result"][0]["id"] = f"{region_key}r"
+        payload["result"][1]["id"] = f"{region_key}n"
+    return payload
+
+def post_annotation(project, access, task_id, rating="0", relation="I"):
+
+    task_id, rating, relation, err = validate_annotation(task_id, rating, relation)
+    if err:
+        return False, err
 
+    payload = build_annotation_payload(rating, relation)
 
-    url = f"{LS_URL}/api/tasks/{task_id}/annotations/"
     try:
-        r = requests.post(url, headers=headers, json=payload, timeout=30)
+        r = project.ls.post(f"tasks/{task_id}/annotations/", access, json=payload)
         if r.status_code not in (200, 201):
             return False, f"annotation 失敗 {r.status_code} {r.text}"
         return True, r.json()
     except requests.RequestException as e:
         return False, f"HTTP 錯誤：{e}"
 
-@csrf_exempt
-def index(request):
-    access = get_access_token()
-    if request.method == 'GET':
+def iter_each(project, access, items):
+    """一筆一個 POST（thread pool 平行送）；每筆寫完就 yield (task_id, ok, annotation 或錯誤訊息)"""
+    def _send_one(it):
+        return it["task"], post_annotation(
+            project,
+            access,
+            it["task"],
+            it["rating"],
+            it["relation"],
+        )
+
+    # 每個 worker 都帶著呼叫端的 contextvars，上游時間與呼叫數才會算進這個 request 的 Server-Timing
+    with ThreadPoolExecutor(max_workers=project.pool_size) as executor:
+        future_map = {executor.submit(contextvars.copy_context().run, _send_one, it): it for it in items}
+        for fut in as_completed(future_map):
+            it = future_map[fut]
+            task_id = it["task"]
+            try:
+                task_id2, (ok1, err1) = fut.result()
+            except Exception as e:
+                yield task_id, False, str(e)
+            else:
+                yield task_id2, ok1, err1
+
+def bulk_groups(items):
+    """驗證後依 (rating, relation) 分組：{(rating, relation): [item, ...]}，以及驗證失敗的 [(task, False, 原因)]"""
+    groups, failed = {}, []
+    for it in items:
+        task_id, rating, relation, err = validate_annotation(it["task"], it["rating"], it["relation"])
+        if err:
+            failed.append((it["task"], False, err))
+            continue
+        groups.setdefault((rating, relation), []).append({**it, "task": task_id})
+    return groups, failed
+
+def bulk_body(project, task_ids, rating: str, relation: str) -> dict:
+    """/api/annotations/bulk/：同一份 result 建到 tasks 裡的每個 task 上"""
+    payload = build_annotation_payload(rating, relation)
+    return {"tasks": task_ids, "project": project.project_id, **payload}
+
+def bulk_outcome(project, resp, group):
+    """bulk 回應 → [(task_id, ok, annotation)]；None 表示這組要退回一筆一個 POST"""
+    if resp.status_code in (404, 405):
+        # 這個 Label Studio 沒有 bulk 端點：之後都不再試
+        if project.bulk_writes:
+            project.bulk_writes = False
+            mirror.logger.warning("project %s: Label Studio has no bulk annotation endpoint (%s), "
+                                  "falling back to one POST per task", project.project_id, resp.status_code)
+        return None
+    if resp.status_code not in (200, 201):
+        # 整組被拒（通常是某個 task 有問題）：一筆一筆送才知道是哪幾筆
+        return None
+    try:
+        created = resp.json()
+    except ValueError:
+        created = None
+    if isinstance(created, dict):
+        created = created.get("results") or created.get("annotations")
+    if not isinstance(created, list) or len(created) != len(group):
+        created = [None] * len(group)
+    results = []
+    for it, ann in zip(group, created):
+        # 上游依 tasks 的順序建立；帶了 task 欄位就以它為準
+        if isinstance(ann, dict):
+            ann = {"task": it["task"], **ann}
+        results.append((int(ann.get("task")) if isinstance(ann, dict) else it["task"], True, ann))
+    return results
+
+def iter_bulk(project, access, items):
+    """同一個 (rating, relation) 的 task 合成一個 /api/annotations/bulk/；不支援或整組被拒時退回 iter_each
+
+    一批最多 5 × 4 種組合，50 張卡片通常只要幾個上游呼叫。每組寫完就 yield，格式同 iter_each。
+    """
+    groups, failed = bulk_groups(items)
+    yield from failed
+
+    def _send_group(key):
+        group = groups[key]
+        if not project.bulk_writes:
+            return key, None
         try:
-            inner_id,num_tasks_with_annotations = (get_views_id(project_id=PROJECT_ID, access_token=access))
+            resp = project.ls.post("annotations/bulk/", access,
+                                   json=bulk_body(project, [it["task"] for it in group], *key))
+        except requests.RequestException as e:
+            # 不知道上游寫了沒有，跟一筆一個 POST 失敗時一樣回報，不重送
+            return key, [(it["task"], False, f"HTTP 錯誤：{e}") for it in group]
+        return key, bulk_outcome(project, resp, group)
+
+    fallback = []
+    with ThreadPoolExecutor(max_workers=max(1, min(len(groups), project.pool_size))) as executor:
+        for fut in as_completed([executor.submit(contextvars.copy_context().run, _send_group, key)
+                                 for key in groups]):
+            key, outcome = fut.result()
+            if outcome is None:
+                fallback.extend(groups[key])
+            else:
+                yield from outcome
+    if fallback:
+        yield from iter_each(project, access, fallback)
+
+def iter_write_batch(project, access, items):
+    """index POST 的上游寫入；依 project.bulk_writes 選 bulk 或一筆一個 POST，寫成功的記進本地狀態
+
+    每筆寫完就 yield (task_id, ok, annotation 或錯誤訊息)，串流模式拿來逐筆回報。
+    """
+    if project.bulk_writes and items:
+        results = iter_bulk(project, access, items)
+    else:
+        results = iter_each(project, access, items)
+    by_task = {it["task"]: it for it in items}
+    for task_id, ok, detail in results:
+        if ok:
+            it = by_task.get(task_id) or by_task.get(str(task_id)) or {}
+            remember_write(project, task_id, detail, it.get("rating"), it.get("relation"))
+        yield task_id, ok, detail
+
+def write_batch(project, access, items):
+    return list(iter_write_batch(project, access, items))
+
+def batch_items(batch, ids):
+    """把前端送來的 batch 跟這批 task id 對齊；遇到第一個沒標完的就截斷"""
+    cut_index = None
+    for idx, b in enumerate(batch):
+        if b['num'] is None or b['aux'] is None or '_' in b['combo']:
+            cut_index = idx
+            break
+
+    if cut_index is not None:
+        batch = batch[:cut_index]
+        ids = ids[:cut_index]
+
+    items = []
+    for task_id, data in zip(ids, batch):
+        items.append(
+            {
+                "task": task_id,
+                "rating": data["num"],
+                "relation": data["aux"],
+            }
+        )
+    return batch, items
+
+def retry_items(project, retry):
+    """串流模式重送失敗的那幾筆：[{"task", "num", "aux"}] → (items, 不在可重送清單裡的 [(task, False, 原因)])
+
+    只收最近寫失敗過的 task（project.retryable），不讓前端拿任意 task id 來寫。
+    """
+    items, rejected = [], []
+    for r in retry if isinstance(retry, list) else []:
+        if not isinstance(r, dict):
+            continue
+        try:
+            task_id = int(r.get("task"))
+        except (TypeError, ValueError):
+            rejected.append((r.get("task"), False, "task 非整數"))
+            continue
+        if task_id not in project.retryable:
+            rejected.append((task_id, False, "不在可重送清單（已送出或不是這裡失敗的）"))
+            continue
+        items.append({"task": task_id, "rating": r.get("num"), "relation": r.get("aux")})
+    return items, rejected
+
+def remember_failures(project, results, items):
+    """這次送出的 task 裡寫失敗的記進可重送清單，成功的拿掉"""
+    sent = {str(it["task"]) for it in items}
+    for task_id, ok, _ in results:
+        if str(task_id) not in sent:
+            continue
+        try:
+            task_id = int(task_id)
+        except (TypeError, ValueError):
+            continue
+        if ok:
+            project.retryable.pop(task_id, None)
+        else:
+            project.retryable[task_id] = True
+    while len(project.retryable) > RETRYABLE_MAX:
+        project.retryable.pop(next(iter(project.retryable)))
 
-            tasks = get_unlabeled_task(project_id=PROJECT_ID, token=access,inner_id=inner_id-1,page = total)
-            total_fetch = len(tasks)
+def queue_locally(project, access) -> bool:
+    """開了 outbox，或上游現在連不上（斷路器開著 / 換不到 token）：先寫進本地 outbox，連上後背景補送"""
+    return OUTBOX or access is None or project.circuit.is_open()
 
-            global task_ids
-            task_ids = [task["id"] for task in tasks]
+def outbox_response(failed, received: int, queued: int):
+    return JsonResponse({
+        "errno": not failed,
+        "mode": "outbox",
+        "received": received,
+        "queued": queued,
+        "failed": failed,
+    })
+
+def lease_expired_response():
+    return JsonResponse({
+        "errno": False,
+        "error": "lease expired; reload to get a new batch",
+    }, status=409)
+
+def batch_summary(results, received: int) -> dict:
+    failed = [r for r in results if not r[1]]
+    if failed:
+        return {
+            "errno": False,
+            "mode": "single-parallel",
+            "failed": failed,
+        }
 
+    return {
+        "errno": True,
+        "mode": "single-parallel",
+        "received": received,
+    }
+
+def batch_response(results, received: int):
+    return JsonResponse(batch_summary(results, received))
+
+def wants_stream(request) -> bool:
+    """前端要逐筆進度（Accept: application/x-ndjson）"""
+    return "application/x-ndjson" in request.headers.get("Accept", "")
+
+def stream_response(lines):
+    resp = StreamingHttpResponse(lines, content_type="application/x-ndjson")
+    resp["Cache-Control"] = "no-cache"
+    # nginx 不要整包緩衝，逐行送出去
+    resp["X-Accel-Buffering"] = "no"
+    return resp
+
+def progress_line(obj) -> str:
+    return dumps(obj).decode("utf-8") + "\n"
+
+def item_line(position, result) -> str:
+    """一筆寫完：index 是它在這次送出的 batch（或 retry）裡的位置"""
+    task_id, ok, detail = result
+    return progress_line({"type": "item", "index": position.get(task_id), "task": task_id, "ok": ok,
+                          "error": None if ok else str(detail)})
+
+def finish_batch(project, results, items, lease):
+    """寫完一批之後的本地收尾：計數、預抓、可重送清單、租約"""
+    # 專案計數在本地加上這次成功的筆數，下一頁不用等快取過期
+    counters.project_counters.add(project.project_id, sum(1 for _, ok, _ in results if ok))
+    remember_failures(project, results, items)
+    if project.prefetcher and items:
+        project.prefetcher.on_submitted()
+    if lease:
+        # 沒送出的（batch 被截斷的部分）回到待標清單，下次重新租
+        leases.release(lease)
+
+def stream_batch(project, access, items, received: int, lease=None, rejected=()):
+    """index POST 的串流版：每筆寫完送一行 {"type": "item", ...}，最後一行是 {"type": "summary", ...}
+
+    summary 跟非串流的回應一樣（errno / failed），前端靠 failed 只重送失敗的那幾筆。
+    """
+    position = {}
+    for k, it in enumerate(items):
+        position.setdefault(it["task"], k)
+        position.setdefault(str(it["task"]), k)
+    results = list(rejected)
+    try:
+        for r in rejected:
+            yield item_line(position, r)
+        for r in iter_write_batch(project, access, items):
+            results.append(r)
+            yield item_line(position, r)
+    finally:
+        # 前端中途斷線也要收尾（已經寫成功的照樣記）
+        finish_batch(project, results, items, lease)
+    yield progress_line({"type": "summary", **batch_summary(results, received)})
+
+def page_cursor(project, access):
+    """(下一個要標的 inner_id, 已標註數)"""
+    if MIRROR:
+        with metrics.phase("cursor"):
+            mirror.ensure_fresh(project.project_id)
+            return mirror.cursor(project.project_id)
+    return get_views_id(project, access_token=access)
+
+def page_tasks(project, access, inner_id: int, page):
+    with metrics.phase("fetch"):
+        if MIRROR:
+            return [TaskRow.from_model(t) for t in mirror.tasks_from(project.project_id, inner_id, page)]
+        return get_unlabeled_task(project, token=access, inner_id=inner_id, page=page)
+
+def fetch_history(project, access, start_inner_id: int):
+    """抓一頁歷史紀錄 → [TaskRow, ...]（快取存的就是這個，編號讀出時再依起點編）"""
+    with metrics.phase("fetch"):
+        # 你的原邏輯：用 (起點-1) 當條件抓 FETCH_NUM 筆
+        if MIRROR:
+            return [TaskRow.from_model(t) for t in mirror.tasks_from(project.project_id, start_inner_id - 1, FETCH_NUM)]
+        tasks = get_unlabeled_task(project, token=access, inner_id=start_inner_id - 1, page=FETCH_NUM)
+        annotation_index.remember_tasks(project.project_id, tasks)
+        project.labels.learn_rows(tasks)
+        return tasks
+
+def number_rows(rows, start_inner_id: int, start_ann_num: int):
+    """table.html 與 /history/ 用的 dict：inner_id / num_tasks_with_annotations 依起點依序編號"""
+    return [{
+        "task_id": row.task_id,
+        "inner_id": start_inner_id + i,
+        "num_tasks_with_annotations": start_ann_num + 1 + i,
+        "query": row.query,
+        "IT_NAME": row.it_name,
+        "image_url": row.image_url,
+        "rating": row.rating,
+        "relation": row.relation,
+        "thumb_url": images.proxy_url(row.image_url, "thumb"),
+        "card_url": images.proxy_url(row.image_url, "card"),
+    } for i, row in enumerate(rows)]
+
+def prefetch_history(project, start_inner_id: int, direction: str):
+    """使用者往哪個方向翻，就先把那個方向的下一頁放進快取"""
+    nxt = start_inner_id - FETCH_NUM if direction == "back" else start_inner_id + FETCH_NUM
+    if nxt + FETCH_NUM <= 1:
+        return
+    def load():
+        rows = fetch_history(project, get_access_token(project), nxt)
+        images.warm(lambda: [row.image_url for row in rows], sizes=("thumb",))
+        return rows
+    project.history_cache.prefetch(project.project_id, nxt, load)
+
+def history_page(project, access, start_inner_id: int, direction: str = "back"):
+    """([TaskRow, ...], 是不是舊資料)；上游太慢或掛掉時退回快取裡過期的那份"""
+    rows, stale = project.history_cache.serve(project.project_id, start_inner_id,
+                                              lambda: fetch_history(project, access, start_inner_id))
+    if not stale:
+        prefetch_history(project, start_inner_id, direction)
+    return rows, stale
+
+def remember_write(project, task_id, annotation, rating, relation, confirmed=True):
+    """寫入成功後同步更新本地鏡像、annotation 索引與歷史頁快取；這些失敗不影響這次寫入的結果
+
+    confirmed=False 是只排進 outbox、上游還沒收到的寫入：鏡像照樣先標起來，統計等送達才算
+    """
+    project.history_cache.invalidate_task(task_id)
+    project.labels.learn_write(task_id, rating, relation)
+    ann_id = annotation.get("id") if isinstance(annotation, dict) else annotation
+    updated_at = annotation.get("updated_at", "") if isinstance(annotation, dict) else ""
+    try:
+        # 沒開鏡像時 Task 表只給 /api/stats/ 用；還沒同步過就是空的，這裡的 update 不會動到任何列
+        mirror.record_annotation(project.project_id, task_id, ann_id, rating, relation, updated_at)
+        if confirmed:
+            stats.record(project.project_id, task_id, rating, relation)
+    except Exception:
+        mirror.logger.exception("failed to record annotation for task %s", task_id)
+
+def make_prefetcher(project):
+    return BatchPrefetcher(
+        lambda: get_views_id(project, access_token=get_access_token(project)),
+        lambda inner_id, page: get_unlabeled_task(project, get_access_token(project), inner_id, page),
+        project.total,
+        on_ready=lambda tasks: images.warm(lambda: task_image_urls(tasks)),
+    )
+
+# 不用本地鏡像時，下一批 task 在背景預抓（鏡像本身就是本地讀取，不需要）
+# 預抓的是每個專案 process 共用的「下一批」，跟每人一段的租約互斥
+if not MIRROR and not LEASES and getattr(settings, "LABEL_STUDIO_PREFETCH", False):
+    for _project in projects.registered():
+        _project.prefetcher = make_prefetcher(_project)
+
+def task_image_urls(tasks):
+    return [t.image_url for t in tasks]
+
+def warm_next_images(project, last_inner_id: int):
+    """鏡像模式沒有 prefetcher：直接從鏡像查接在這批後面的 task，先把圖縮好"""
+    if MIRROR:
+        images.warm(lambda: [t.image_url for t in mirror.tasks_from(project.project_id, last_inner_id, project.total)])
+
+def next_unlabeled(project, inner_id: int):
+    """>= inner_id 的第一個未標註 task 的 inner_id；沒有就 None"""
+    if MIRROR:
+        return mirror.next_unlabeled(project.project_id, inner_id)
+    tasks = get_unlabeled_task(project, get_access_token(project), inner_id - 1, 1, unlabeled_only=True)
+    return tasks[0].inner_id if tasks else None
+
+def lease_window(project, request, first_inner_id: int, num: int):
+    """替這個標註者租一段區間；回傳 (租約, 這批編號的起點 - 1)"""
+    lease = leases.acquire(project.project_id, leases.owner_key(request), first_inner_id, project.total,
+                           lambda inner_id: next_unlabeled(project, inner_id))
+    # 多人同時標時「已標註數 + 1」不再是這批的位置，改用區間起點的 inner_id 編號
+    return lease, lease.start_inner_id - 1
+
+def lease_tasks(lease, tasks):
+    # 區間可能比 total 短（卡在別人的租約前面），超出的不要
+    tasks = [t for t in tasks if (t.inner_id or lease.start_inner_id) <= lease.end_inner_id]
+    leases.attach(lease, [t.task_id for t in tasks])
+    return tasks
+
+# 上游太慢或掛掉時退回的「最後一份好資料」（project.batch_cache / project.cursor_cache）：
+# index 的上一批與 table 的游標每次都先試著抓新的（fresh=0），只有等超過 LABEL_STUDIO_STALE_WAIT 秒
+# 或失敗才用舊的；鏡像模式本來就讀本地，不需要
+
+def fresh_batch(project, access):
+    """(inner_id, 已標註數, tasks)；有預抓好的就直接用"""
+    batch = project.prefetcher.take() if project.prefetcher else None
+    if batch is not None:
+        return batch.inner_id, batch.num_tasks_with_annotations, batch.tasks
+    if MIRROR:
+        inner_id, num = page_cursor(project, access)
+        return inner_id, num, page_tasks(project, access, inner_id-1, project.total)
+    # task 查詢只等 next_task，不等專案計數
+    steps = {
+        **cursor_steps(project, access),
+        "tasks": (("next_task",), lambda inner_id: page_tasks(project, access, inner_id-1, project.total)),
+    }
+    out = fanin.resolve(steps, ("next_task", "counters", "tasks"), project.executor)
+    return out["next_task"], out["counters"]["num_tasks_with_annotations"], out["tasks"]
+
+def unsubmitted(project, inner_id: int, num: int, tasks):
+    """退回舊的一批時，拿掉之後已經寫過（或排進 outbox）的 task"""
+    ids = [t.task_id for t in tasks]
+    done = set(annotation_index.lookup_many(project.project_id, ids)) | outbox.queued_task_ids(project.project_id, ids)
+    keep = [t for t in tasks if t.task_id not in done]
+    first = (keep[0].inner_id or inner_id) if keep else inner_id + len(tasks)
+    return first, num + len(tasks) - len(keep), keep
+
+def load_batch(project, request, access):
+    """index GET 要的 (inner_id, 已標註數, tasks, 是不是舊資料)"""
+    if LEASES:
+        first_inner_id, num = page_cursor(project, access)
+        lease, num = lease_window(project, request, first_inner_id, num)
+        size = lease.end_inner_id - lease.start_inner_id + 1
+        tasks = lease_tasks(lease, page_tasks(project, access, lease.start_inner_id - 1, size))
+        warm_next_images(project, lease.end_inner_id)
+        return lease.start_inner_id, num, tasks, False
+
+    if MIRROR:
+        (inner_id, num, tasks), stale = fresh_batch(project, access), False
+    else:
+        (inner_id, num, tasks), stale = project.batch_cache.lookup(project.project_id,
+                                                                   lambda: fresh_batch(project, access))
+    if stale:
+        return (*unsubmitted(project, inner_id, num, tasks), True)
+    if project.prefetcher:
+        project.prefetcher.on_served(inner_id, num, tasks)
+    elif tasks:
+        warm_next_images(project, tasks[-1].inner_id)
+    return inner_id, num, tasks, False
+
+def table_cursor(project, access):
+    """(游標, 是不是舊資料)；上游太慢或掛掉時退回上一次拿到的"""
+    if MIRROR:
+        return page_cursor(project, access), False
+    return project.cursor_cache.lookup(project.project_id, lambda: page_cursor(project, access))
+
+def suggest_labels(project, tasks):
+    """{task_id: propagation.Suggestion}；鏡像模式第一次用時先把鏡像裡已標註的組合讀進來"""
+    if propagation.MODE == "off" or not tasks:
+        return {}
+    if MIRROR and not project.labels.seeded:
+        project.labels.learn_rows(mirror.labeled_tasks(project.project_id))
+        project.labels.seeded = True
+    return project.labels.suggest(tasks)
+
+def propagate(project, request, access, num: int, tasks, stale: bool):
+    """(已標註數, tasks, 建議)；"submit" 模式下完全相同且沒衝突的組合直接送出，不再發給標註者
+
+    送出走跟 index POST 一樣的路（outbox 或 write_batch）；上游連不上、拿的是舊資料時只預填。
+    """
+    suggestions = suggest_labels(project, tasks)
+    if propagation.MODE != "submit" or stale:
+        return num, tasks, suggestions
+    items = [{"task": t.task_id, "rating": s.rating, "relation": s.relation}
+             for t in tasks if (s := suggestions.get(t.task_id)) is not None and s.auto_submit]
+    if not items:
+        return num, tasks, suggestions
+    if queue_locally(project, access):
+        failed = {int(task_id) for task_id, _, _ in outbox.enqueue(project.project_id, items)}
+        done = {it["task"] for it in items} - failed
+    else:
+        done = {int(task_id) for task_id, ok, _ in write_batch(project, access, items) if ok}
+    if not done:
+        return num, tasks, suggestions
+    counters.project_counters.add(project.project_id, len(done))
+    tasks = [t for t in tasks if t.task_id not in done]
+    if LEASES:
+        lease = leases.current(project.project_id, leases.owner_key(request))
+        if lease is not None:
+            leases.attach(lease, [t.task_id for t in tasks])
+    return num + len(done), tasks, suggestions
+
+def upstream_unavailable_response(e: Exception, project=None):
+    circuit = project.circuit if project else breaker.circuit
+    resp = HttpResponse(f"Label Studio 暫時無法連線，請稍後再試。\n\n{e}", status=503,
+                        content_type="text/plain; charset=utf-8")
+    resp["Retry-After"] = str(max(1, round(getattr(e, "retry_after", 0) or circuit.retry_after() or 5)))
+    return resp
+
+def api_error_response(e: Exception, project=None):
+    # 連不上 / 逾時 / 斷路器開著（httpx 的在 async_views 另外接）
+    if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+        return upstream_unavailable_response(e, project)
+    # requests / httpx 的 HTTP 錯誤都帶 response
+    response = getattr(e, "response", None)
+    if response is not None:
+        # 回傳 API 失敗細節，方便你除錯
+        try:
+            detail = response.text
+        except Exception:
+            detail = str(e)
+        return HttpResponseServerError(f"Label Studio API error: {e}\n\n{detail}")
+    return HttpResponseServerError(f"Server error: {e}")
+
+def serve_batch(project, request, access):
+    """index GET 與 /api/batch/ 共用：(已標註數, tasks, 是不是舊資料, 建議)，並記下這批的 task_ids"""
+    inner_id, num, tasks, stale = load_batch(project, request, access)
+    if stale and not tasks:
+        raise breaker.CircuitOpenError(project.circuit.retry_after())
+    num, tasks, suggestions = propagate(project, request, access, num, tasks, stale)
+    if not LEASES:
+        project.task_ids = [task.task_id for task in tasks]
+    return num, tasks, stale, suggestions
+
+@csrf_exempt
+@projects.scoped
+def index(request, project):
+    access = try_access_token(project)
+    if request.method == 'GET':
+        if INDEX_SHELL:
+            # 先回空殼（導覽列 + spinner），卡片由前端打 /api/batch/ 分段畫出來
+            with metrics.phase("render"):
+                return render(request, "index.html", {
+                    "shell": True, "project_id": project.project_id, "base_path": project.base_path})
+        try:
+            num_tasks_with_annotations, tasks, stale, suggestions = serve_batch(project, request, access)
+        except Exception as e:
+            return api_error_response(e, project)
+        total_fetch = len(tasks)
+
+        with metrics.phase("render"):
             return render(request, "index.html", {
                 "tasks": enumerate(tasks, start=int(num_tasks_with_annotations)+1),
-                "project_id": PROJECT_ID,
+                "project_id": project.project_id,
+                "base_path": project.base_path,
                 "annotations":int(num_tasks_with_annotations)+1,
                 "total":total_fetch, # 這次抽取了幾個
-                "t": total_fetch-1  # 這次抽取了幾個
+                "t": total_fetch-1,  # 這次抽取了幾個
+                "stale": stale,
+                "suggestions": suggestions,
             })
-
-        except requests.HTTPError as e:
-            # 回傳 API 失敗細節，方便你除錯
-            try:
-                detail = e.response.text
-            except Exception:
-                detail = str(e)
-            return HttpResponseServerError(f"Label Studio API error: {e}\n\n{detail}")
-
-        except Exception as e:
-            return HttpResponseServerError(f"Server error: {e}")
     if request.method == 'POST':
         try:
             payload = json.loads(request.body.decode("utf-8"))
         except json.JSONDecodeError:
             return HttpResponseBadRequest("Invalid JSON")
 
-        batch = payload.get("batch", [])
-        cut_index = None
+        lease, rejected = None, []
+        if "retry" in payload:
+            # 串流模式只重送上次失敗的那幾筆
+            items, rejected = retry_items(project, payload["retry"])
+            batch = payload["retry"]
+        else:
+            if LEASES:
+                lease = leases.current(project.project_id, leases.owner_key(request))
+                if lease is None:
+                    return lease_expired_response()
+            batch, items = batch_items(payload.get("batch", []), lease.task_ids if lease else project.task_ids)
+
+        if queue_locally(project, access):
+            failed = outbox.enqueue(project.project_id, items)
+            if lease:
+                leases.release(lease)
+            return outbox_response(rejected + failed, len(batch), len(items) - len(failed))
+
+        if wants_stream(request):
+            return stream_response(stream_batch(project, access, items, len(batch), lease, rejected))
+
+        # 多線程（或 bulk）
+        results = rejected + write_batch(project, access, items)
+        finish_batch(project, results, items, lease)
+        return batch_response(results, len(batch))
+    return JsonResponse({'error': 'Only GET/POST allowed'}, status=405)
 
-        for idx, b in enumerate(batch):
-            if b['num'] is None or b['aux'] is None or '_' in b['combo']:
-                cut_index = idx
-                break
+def history_cursor(payload, direction: str = "back"):
+    """table 翻頁：由目前畫面最早的一筆推回上一頁（或往後一頁）的起點"""
+    if isinstance(payload, list):
+        payload = payload[0] if payload else {}
 
-        if cut_index is not None:
-            batch = batch[:cut_index]
-            task_ids = task_ids[:cut_index]
+    current_annotation_num = int(payload.get('current_annotation_num', 0))
+    current_inner_id = int(payload.get('current_inner_id', 0))
 
-        items = []
-        for task_id, data in zip(task_ids, batch):
-            items.append(
-                {
-                    "task": task_id,
-                    "rating": data["num"],
-                    "relation": data["aux"],
-                }
-            )
-
-
-        # 多線程
-        results = []
-
-        def _send_one(it):
-            return it["task"], post_annotation(
-                access,
-                it["task"],
-                it["rating"],
-                it["relation"],
-            )
-
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            future_map = {executor.submit(_send_one, it): it for it in items}
-            for fut in as_completed(future_map):
-                it = future_map[fut]
-                task_id = it["task"]
-                try:
-                    task_id2, (ok1, err1) = fut.result()
-                except Exception as e:
-                    results.append((task_id, False, str(e)))
-                else:
-                    results.append((task_id2, ok1, err1))
-
-        failed = [r for r in results if not r[1]]
-        if failed:
-            return JsonResponse({
-                "errno": False,
-                "mode": "single-parallel",
-                "failed": failed,
-            })
+    if direction == "forward":
+        return current_inner_id + FETCH_NUM - 1, current_annotation_num + FETCH_NUM - 1
 
-        return JsonResponse({
-            "errno": True,
-            "mode": "single-parallel",
-            "received": len(batch),
-        })
-    return JsonResponse({'error': 'Only GET/POST allowed'}, status=405)
+    start_inner_id = current_inner_id - FETCH_NUM - 1
+    start_ann_num  = current_annotation_num - FETCH_NUM -1
+    return start_inner_id, start_ann_num
 
-@csrf_exempt
-def table(request):
-    access = get_access_token()
-    base_inner_id, base_num_anns = get_views_id(project_id=PROJECT_ID, access_token=access)
-    def parse_rating_relation(task):
-
-        ann_raw = task.get("annotations_results")
-        ann_list = None
-        if isinstance(ann_raw, str):
-            try:
-                ann_list = json.loads(ann_raw)
-            except json.JSONDecodeError:
-                ann_list = []
-        elif isinstance(ann_raw, list):
-            ann_list = ann_raw
-        else:
-            ann_list = []
-
-        rating = None
-        relation = None
-
-        # 你原始資料看起來像是 [ [ {...}, {...} ] ] 結構，先拿第一組
-        if ann_list and isinstance(ann_list[0], list):
-            for ann in ann_list[0]:
-                if not isinstance(ann, dict):
-                    continue
-                if ann.get("from_name") == "rating":
-                    # 允許沒有 choices 或空陣列
-                    choices = (ann.get("value") or {}).get("choices") or []
-                    rating = choices[0] if choices else None
-                elif ann.get("from_name") == "relation":
-                    choices = (ann.get("value") or {}).get("choices") or []
-                    relation = choices[0] if choices else None
-
-        return rating, relation
-    def build_history_rows(tasks, start_inner_id: int, start_ann_num: int):
-
-        rows = []
-        inner_id = int(start_inner_id)
-        ann_num = int(start_ann_num)
-
-        for task in tasks:
-            data = task.get("data", {}) or {}
-            query = data.get("query")
-            it_name = data.get("IT_NAME")
-            image_url = data.get("image_url")
-            rating, relation = parse_rating_relation(task)
-            rows.append({
-                "task_id":task["id"],
-                "inner_id": inner_id,
-                "num_tasks_with_annotations": ann_num + 1,
-                "query": query,
-                "IT_NAME": it_name,
-                "image_url": image_url,
-                "rating": rating,
-                "relation": relation,
-            })
-            inner_id += 1
-            ann_num += 1
+def history_response(history_datas, start_inner_id: int, start_ann_num: int, stale: bool = False):
+    # 與前端 renderTable 期待一致
+    body = {
+        "history_datas": history_datas,
+        "annotations": start_ann_num + 1,
+        "inner_id": start_inner_id + 1,
+    }
+    if stale:
+        # 上游太慢或掛掉，這頁是快取裡過期的那份
+        body["stale"] = True
+    return JsonResponse(body)
+
+def read_history_query(request):
+    """GET /history/ 的參數：current_inner_id / current_annotation_num / direction"""
+    direction = request.GET.get("direction", "back")
+    if direction not in ("back", "forward"):
+        raise ValueError(direction)
+    start_inner_id, start_ann_num = history_cursor(request.GET, direction)
+    return start_inner_id, start_ann_num, direction
+
+@projects.scoped
+def history(request, project):
+    """keyset 分頁的歷史紀錄 API（以 inner_id 為游標）"""
+    if request.method != 'GET':
+        return JsonResponse({'error': 'Only GET allowed'}, status=405)
+    try:
+        start_inner_id, start_ann_num, direction = read_history_query(request)
+    except (TypeError, ValueError):
+        return HttpResponseBadRequest("Invalid fields: current_annotation_num/current_inner_id/direction")
 
-        return rows, inner_id, ann_num
+    # 歷史頁常常在快取裡；token 交給 ls client 在真的要打上游時才拿
+    try:
+        page, stale = history_page(project, None, start_inner_id, direction)
+    except Exception as e:
+        return api_error_response(e, project)
+    return history_response(number_rows(page, start_inner_id, start_ann_num), start_inner_id, start_ann_num, stale)
+
+@projects.scoped
+def batch_api(request, project):
+    """index 的這一批（精簡 JSON，支援 ETag / 壓縮）"""
+    if request.method != 'GET':
+        return JsonResponse({'error': 'Only GET allowed'}, status=405)
+    try:
+        num, tasks, stale, suggestions = serve_batch(project, request, try_access_token(project))
+    except Exception as e:
+        return api_error_response(e, project)
+    return compact.json_response(request, compact.batch_payload(num, tasks, stale, suggestions))
+
+@projects.scoped
+def history_api(request, project):
+    """/history/ 的精簡 JSON 版，參數相同"""
+    if request.method != 'GET':
+        return JsonResponse({'error': 'Only GET allowed'}, status=405)
+    try:
+        start_inner_id, start_ann_num, direction = read_history_query(request)
+    except (TypeError, ValueError):
+        return HttpResponseBadRequest("Invalid fields: current_annotation_num/current_inner_id/direction")
 
+    # 歷史頁常常在快取裡；token 交給 ls client 在真的要打上游時才拿
+    try:
+        page, stale = history_page(project, None, start_inner_id, direction)
+    except Exception as e:
+        return api_error_response(e, project)
+    return compact.json_response(request, compact.history_payload(page, start_inner_id, start_ann_num, stale))
+
+@csrf_exempt
+def outbox_status(request):
+    """GET：待送 / 失敗的 outbox 項目；POST {"retry": [id, ...]} 或 {"retry": "all"} 重送失敗項目"""
+    outbox.flusher.ensure_started()
     if request.method == 'GET':
-        # 這一頁的起始點（往回抓一頁）
-        start_inner_id = base_inner_id - FETCH_NUM
-        start_ann_num  = base_num_anns - FETCH_NUM
-
-        tasks = get_unlabeled_task(
-            project_id=PROJECT_ID,
-            token=access,
-            inner_id=start_inner_id - 1,  # 你的原邏輯：用 (起點-1) 當條件抓 FETCH_NUM 筆
-            page=FETCH_NUM
-        )
+        return JsonResponse(outbox.summary())
+    if request.method == 'POST':
+        try:
+            payload = json.loads((request.body or b'{}').decode('utf-8') or '{}')
+        except json.JSONDecodeError:
+            return HttpResponseBadRequest("Invalid JSON")
+        ids = payload.get("retry")
+        if ids != "all" and not isinstance(ids, list):
+            return HttpResponseBadRequest('retry must be a list of ids or "all"')
+        n = outbox.retry_failed(None if ids == "all" else ids)
+        return JsonResponse({"requeued": n})
+    return JsonResponse({'error': 'Only GET/POST allowed'}, status=405)
 
-        history_datas, end_inner_id, end_ann_num = build_history_rows(
-            tasks, start_inner_id, start_ann_num
-        )
+@projects.scoped
+def export_labels(request, project):
+    """串流匯出標註：?format=ndjson|csv&after=<inner_id>&all=1；中斷後用最後一列的 inner_id 當 after 續傳"""
+    if request.method != 'GET':
+        return JsonResponse({'error': 'Only GET allowed'}, status=405)
+    fmt = request.GET.get("format", "ndjson")
+    if fmt not in export.FORMATS:
+        return HttpResponseBadRequest("format must be ndjson or csv")
+    try:
+        after = int(request.GET.get("after") or 0)
+    except ValueError:
+        return HttpResponseBadRequest("Invalid after")
+
+    rows = export.iter_rows(project.project_id, after, labeled_only=request.GET.get("all") != "1")
+    resp = StreamingHttpResponse(
+        export.encode(rows, fmt, header=after == 0),
+        content_type="text/csv; charset=utf-8" if fmt == "csv" else "application/x-ndjson",
+    )
+    resp["Content-Disposition"] = f'attachment; filename="project-{project.project_id}-labels-after-{after}.{fmt}"'
+    return resp
+
+@projects.scoped
+def stats_api(request, project):
+    """rating × relation 分布與進度；讀 DB 裡的增量計數，背景跟鏡像對帳（見 main.stats）"""
+    if request.method != 'GET':
+        return JsonResponse({'error': 'Only GET allowed'}, status=405)
+    return JsonResponse({"project_id": project.project_id, **stats.snapshot(project)})
 
-        return render(request, 'table.html', {
-            "history_datas": history_datas,
-            "annotations": start_ann_num + 1,
-            "inner_id": start_inner_id + 1,
-            "t":FETCH_NUM-1 #
-        })
+@csrf_exempt
+@projects.scoped
+def table(request, project):
+    if request.method == 'GET':
+        access = try_access_token(project)
+        try:
+            (base_inner_id, base_num_anns), stale_cursor = table_cursor(project, access)
+            # 這一頁的起始點（往回抓一頁）
+            start_inner_id = base_inner_id - FETCH_NUM
+            start_ann_num  = base_num_anns - FETCH_NUM
+
+            page, stale = history_page(project, access, start_inner_id)
+        except Exception as e:
+            return api_error_response(e, project)
+
+        with metrics.phase("render"):
+            return render(request, 'table.html', {
+                "project_id": project.project_id,
+                "base_path": project.base_path,
+                "history_datas": number_rows(page, start_inner_id, start_ann_num),
+                "annotations": start_ann_num + 1,
+                "inner_id": start_inner_id + 1,
+                "t":FETCH_NUM-1, #
+                "stale": stale or stale_cursor,
+            })
     if request.method == 'POST':
         try:
             raw = (request.body or b'').decode('utf-8', errors='ignore').strip()
@@ -349,35 +940,18 @@ def table(request):
         except json.JSONDecodeError:
             return HttpResponseBadRequest("Invalid JSON")
 
-        if isinstance(payload, list):
-            payload = payload[0] if payload else {}
-
         try:
-            current_annotation_num = int(payload.get('current_annotation_num', 0))
-            current_inner_id = int(payload.get('current_inner_id', 0))
-        except (TypeError, ValueError):
+            start_inner_id, start_ann_num = history_cursor(payload)
+        except (TypeError, ValueError, AttributeError):
             return HttpResponseBadRequest("Invalid fields: current_annotation_num/current_inner_id")
 
-        start_inner_id = current_inner_id - FETCH_NUM - 1
-        start_ann_num  = current_annotation_num - FETCH_NUM -1
-
-        tasks = get_unlabeled_task(
-            project_id=PROJECT_ID,
-            token=access,
-            inner_id=start_inner_id - 1,
-            page=FETCH_NUM
-        )
-
-        history_datas, end_inner_id, end_ann_num = build_history_rows(
-            tasks, start_inner_id, start_ann_num
-        )
+        # 翻頁只需要歷史頁，不用游標與專案計數；token 等真的要打上游時才拿
+        try:
+            page, stale = history_page(project, None, start_inner_id)
+        except Exception as e:
+            return api_error_response(e, project)
 
-        # 與前端 renderTable 期待一致
-        return JsonResponse({
-            "history_datas": history_datas,
-            "annotations": start_ann_num + 1,
-            "inner_id": start_inner_id + 1,
-        })
+        return history_response(number_rows(page, start_inner_id, start_ann_num), start_inner_id, start_ann_num, stale)
 
     return JsonResponse({'error': 'Only GET/POST allowed'}, status=405)
 
@@ -408,173 +982,331 @@ def _build_result_blocks(rating: int, relation: str):
         }
     ]
 
-def _find_annotation_id(task_id: int, project_id: int, token: str):
-    headers = make_headers(token)
+def _latest_annotation(anns):
+    ann_sorted = sorted(anns, key=lambda x: (x.get("updated_at") or x.get("created_at") or "", x.get("id") or 0))
+    return ann_sorted[-1].get("id")
 
+def annotation_id_from_list(obj):
+    arr = obj if isinstance(obj, list) else (obj.get("results") or obj.get("data") or [])
+    if arr:
+        return _latest_annotation(arr)
+    return None
+
+def annotation_id_from_task(t):
+    anns = t.get("annotations") or []
+    if isinstance(anns, list) and anns:
+        return _latest_annotation(anns)
+    ids = t.get("annotations_ids") or t.get("annotation_ids") or []
+    if isinstance(ids, list) and ids:
+        return ids[-1]
+    return None
+
+def _find_annotation_id(project, task_id: int, token: str):
     # 1) 查 annotations
     try:
-        r = requests.get(
-            _ls("annotations/"),                     # ← 有 /api 與尾斜線
-            headers=headers,
-            params={"taskID": task_id, "project": project_id},
-            timeout=30
+        r = project.ls.get(
+            "annotations/",                          # ← 有 /api 與尾斜線
+            token,
+            params={"taskID": task_id, "project": project.project_id},
         )
         if r.ok:
-            obj = r.json()
-            arr = obj if isinstance(obj, list) else (obj.get("results") or obj.get("data") or [])
-            if arr:
-                arr_sorted = sorted(arr, key=lambda x: (x.get("updated_at") or x.get("created_at") or "", x.get("id") or 0))
-                return arr_sorted[-1].get("id")
+            ann_id = annotation_id_from_list(r.json())
+            if ann_id:
+                return ann_id
     except Exception:
         pass
 
     # 2) 查 task
     try:
-        r2 = requests.get(
-            _ls(f"tasks/{task_id}/"),               # ← 有 /api 與尾斜線
-            headers=headers,
-            params={"project": project_id},
-            timeout=30
+        r2 = project.ls.get(
+            f"tasks/{task_id}/",                    # ← 有 /api 與尾斜線
+            token,
+            params={"project": project.project_id},
         )
         if r2.ok:
-            t = r2.json()
-            anns = t.get("annotations") or []
-            if isinstance(anns, list) and anns:
-                ann_sorted = sorted(anns, key=lambda x: (x.get("updated_at") or x.get("created_at") or "", x.get("id") or 0))
-                return ann_sorted[-1].get("id")
-            ids = t.get("annotations_ids") or t.get("annotation_ids") or []
-            if isinstance(ids, list) and ids:
-                return ids[-1]
+            return annotation_id_from_task(r2.json())
     except Exception:
         pass
 
     return None
 
+def validate_edit(payload):
+    """驗證一筆修改；回傳 (fields, None) 或 (None, 錯誤訊息)"""
+    # 讀參數
+    try:
+        task_id  = int(payload.get('task_id'))
+        inner_id = int(payload.get('inner_id'))
+        rating   = int(payload.get('rating'))
+        relation = str(payload.get('relation') or '').upper()
+        lead_time = float(payload.get("lead_time") or 0.0)
+    except (TypeError, ValueError, AttributeError):
+        return None, 'Invalid types for task_id/inner_id/rating/relation'
 
-def _ls(path: str) -> str:
+    if rating < 0 or rating > 4:
+        return None, 'rating must be 0..4'
+    if relation not in ALLOWED_REL:
+        return None, "relation must be one of 'E','S','C','I'"
 
-    if not path:
-        path = ""
-    path = str(path)
+    return {
+        "task_id": task_id,
+        "inner_id": inner_id,
+        "rating": rating,
+        "relation": relation,
+        "lead_time": lead_time,
+    }, None
+
+def parse_edit(payload):
+    """驗證一筆修改；回傳 (fields, None) 或 (None, 錯誤 JsonResponse)"""
+    fields, error = validate_edit(payload)
+    if error:
+        return None, JsonResponse({'error': error}, status=400)
+    return fields, None
+
+def parse_bulk_edit(payload):
+    """整批先驗證完才送；有任何一筆不合法就整批退回，並指出是哪幾筆"""
+    edits = payload.get("edits") if isinstance(payload, dict) else payload
+    if not isinstance(edits, list) or not edits:
+        return None, JsonResponse({'error': 'edits must be a non-empty list'}, status=400)
+    if len(edits) > MAX_BULK_EDITS:
+        return None, JsonResponse({'error': f'at most {MAX_BULK_EDITS} edits per request'}, status=400)
+
+    rows, errors, seen = [], [], set()
+    for i, item in enumerate(edits):
+        fields, error = validate_edit(item if isinstance(item, dict) else {})
+        if fields and fields["task_id"] in seen:
+            # 同一個 task 併發寫兩次，結果看誰先到；直接擋掉
+            error = f'duplicate task_id {fields["task_id"]}'
+        if error:
+            errors.append({"index": i, "error": error})
+            continue
+        seen.add(fields["task_id"])
+        rows.append(fields)
+    if errors:
+        return None, JsonResponse({'error': 'Invalid edits', 'errors': errors}, status=400)
+    return rows, None
+
+def edit_request(project, ann_id, fields):
+    """已有 annotation 就 PATCH，沒有就新建；回傳 (method, path, kwargs, action)"""
+    task_id = fields["task_id"]
+    result_blocks = _build_result_blocks(fields["rating"], fields["relation"])
+    if ann_id:
+        body = {
+            "lead_time": fields["lead_time"],
+            "result": result_blocks,
+            "draft_id": 0,
+            "parent_prediction": None,
+            "parent_annotation": None,
+            "started_at": _iso_utc_now(),
+        }
+        return "PATCH", f"annotations/{ann_id}/", {   # ← 有 /api 與尾斜線
+            "params": {"taskID": task_id, "project": project.project_id},
+            "json": body,
+        }, "patch"
+
+    body = {
+        "task": task_id,                                # ← 新建時 body 需要 task
+        "project": project.project_id,
+        "lead_time": fields["lead_time"],
+        "result": result_blocks,
+        "draft_id": 0,
+        "parent_prediction": None,
+        "parent_annotation": None,
+        "started_at": _iso_utc_now(),
+    }
+    return "POST", "annotations/", {"json": body}, "create"   # body 內含 "task": task_id
 
-    # 已是完整 URL：原樣返回
-    if path.startswith("http://") or path.startswith("https://"):
-        return path
+def response_body(resp):
+    ctype = (resp.headers.get('content-type') or '').lower()
+    return resp.json() if 'application/json' in ctype else {"raw": resp.text}
 
-    # 去掉開頭斜線
-    p = path.lstrip('/')
+def edit_outcome(resp, action, ann_id, fields):
+    """上游回應 → (HTTP 狀態, 回應內容)"""
+    # 統一錯誤處理（若 LS 回 HTML，就不要整頁丟回前端）
+    ctype = (resp.headers.get('content-type') or '').lower()
+    if not (200 <= resp.status_code < 400):
+        detail = resp.json() if 'application/json' in ctype else resp.text[:800]
+        return resp.status_code, {
+            "error": "LS API error",
+            "status": resp.status_code,
+            "url": str(resp.url),
+            "detail": detail,
+        }
 
-    # 沒帶 api/ 就自動補
-    if not p.startswith("api/"):
-        p = "api/" + p
+    # ✅ 成功回傳
+    out = response_body(resp)
+    ann_id_final = (out.get("id") if isinstance(out, dict) else None) or ann_id
 
-    return f"{LS_URL.rstrip('/')}/{p}"
+    return 200, {
+        "ok": True,
+        "action": action,
+        "annotation_id": ann_id_final,
+        "task_id": fields["task_id"],
+        "inner_id": fields["inner_id"],
+        "rating": fields["rating"],
+        "relation": fields["relation"],
+        "ls_response": out,
+    }
 
-@csrf_exempt
-def edit_task(request):
+def queued_edits(project, rows, wait=None):
+    """task 還在 outbox 裡沒送出：改那一筆就好。回傳 {task_id: (HTTP 狀態, 回應內容)}，不在 outbox 的是 None
+
+    直接寫上游的話會查不到 annotation 而新建一筆，之後 outbox 送出時又把舊值蓋回去。
+    正在送的那幾筆一起等它們送完（共用一個最多 wait 秒的期限，預設 LABEL_STUDIO_OUTBOX_AMEND_WAIT），
+    送完就是 None，照一般修改 PATCH 剛建立的 annotation；等不到才回 409。
+    """
+    if not OUTBOX or not rows:
+        return {f["task_id"]: None for f in rows}
+    states = outbox.amend(project.project_id, {f["task_id"]: (str(f["rating"]), f["relation"]) for f in rows},
+                          wait=outbox.AMEND_WAIT if wait is None else wait)
+    return {f["task_id"]: queued_outcome(project, f, states[f["task_id"]]) for f in rows}
+
+def queued_edit(project, fields, wait=None):
+    """單筆的 queued_edits；不在 outbox 回傳 None"""
+    return queued_edits(project, [fields], wait)[fields["task_id"]]
+
+def queued_outcome(project, fields, state):
+    if state is None:
+        return None
+    if state == "sending":
+        return 409, {"error": "annotation is being sent to Label Studio, retry shortly",
+                     "task_id": fields["task_id"], "inner_id": fields["inner_id"]}
+    remember_write(project, fields["task_id"], None, fields["rating"], fields["relation"], confirmed=False)
+    return 200, {
+        "ok": True,
+        "action": "queued",
+        "annotation_id": None,
+        "task_id": fields["task_id"],
+        "inner_id": fields["inner_id"],
+        "rating": fields["rating"],
+        "relation": fields["relation"],
+    }
+
+def send_edit(project, token, fields, indexed_id=None):
+    """只打網路：有索引就直接寫，沒有（或索引過期回 404）才查上游；回傳 (resp, action, ann_id)"""
+    ann_id = indexed_id or _find_annotation_id(project, fields["task_id"], token)
+    method, path, kwargs, action = edit_request(project, ann_id, fields)
+    resp = project.ls.request(method, path, token, **kwargs)
+    if indexed_id and resp.status_code == 404:
+        ann_id = _find_annotation_id(project, fields["task_id"], token)
+        method, path, kwargs, action = edit_request(project, ann_id, fields)
+        resp = project.ls.request(method, path, token, **kwargs)
+    return resp, action, ann_id
+
+def finish_edit(project, resp, action, ann_id, fields, indexed_id=None):
+    """寫回本地狀態（索引 / 鏡像 / 歷史快取）；回傳 edit_outcome"""
+    if indexed_id and ann_id != indexed_id:
+        # 索引過期（上游刪掉了）
+        annotation_index.forget(project.project_id, indexed_id)
+    if 200 <= resp.status_code < 400:
+        out = response_body(resp)
+        remember_write(project, fields["task_id"], out if isinstance(out, dict) and out.get("id") else ann_id,
+                       fields["rating"], fields["relation"])
+    return edit_outcome(resp, action, ann_id, fields)
+
+def bulk_row(fields, status, body):
+    """批次結果的一列；不帶 ls_response，避免一次回傳幾百筆上游物件"""
+    row = {k: v for k, v in body.items() if k != "ls_response"}
+    row.setdefault("ok", False)
+    row.setdefault("task_id", fields["task_id"])
+    row.setdefault("inner_id", fields["inner_id"])
+    row["status"] = status
+    return row
+
+def bulk_response(rows):
+    ok = sum(1 for r in rows if r["ok"])
+    return JsonResponse({"ok": ok == len(rows), "succeeded": ok, "failed": len(rows) - ok, "results": rows})
+
+def read_edit_body(request):
+    """edit_task 共用的前置檢查；回傳 (payload, None) 或 (None, 錯誤回應)"""
     method = request.method.upper()
     if method == 'POST' and request.headers.get('X-HTTP-Method-Override','').upper() == 'PATCH':
         method = 'PATCH'
     if method != 'PATCH':
-        return JsonResponse({'error':'Only PATCH allowed'}, status=405)
+        return None, JsonResponse({'error':'Only PATCH allowed'}, status=405)
 
     raw = (request.body or b'').decode('utf-8', errors='ignore').strip()
     if not raw:
-        return HttpResponseBadRequest('Empty body')
+        return None, HttpResponseBadRequest('Empty body')
     try:
-        payload = json.loads(raw)
+        return json.loads(raw), None
     except json.JSONDecodeError as e:
-        return JsonResponse({'error':'Invalid JSON','detail':str(e)}, status=400)
-
-    # 讀參數
-    try:
-        task_id  = int(payload.get('task_id'))
-        inner_id = int(payload.get('inner_id'))
-        rating   = int(payload.get('rating'))
-        relation = str(payload.get('relation') or '').upper()
-    except (TypeError, ValueError):
-        return JsonResponse({'error':'Invalid types for task_id/inner_id/rating/relation'}, status=400)
+        return None, JsonResponse({'error':'Invalid JSON','detail':str(e)}, status=400)
 
-    if rating < 0 or rating > 4:
-        return JsonResponse({'error':'rating must be 0..4'}, status=400)
-    if relation not in ALLOWED_REL:
-        return JsonResponse({'error':"relation must be one of 'E','S','C','I'"}, status=400)
+@csrf_exempt
+@projects.scoped
+def edit_task(request, project):
+    payload, err = read_edit_body(request)
+    if err:
+        return err
+    fields, err = parse_edit(payload)
+    if err:
+        return err
+
+    queued = queued_edit(project, fields)
+    if queued is not None:
+        return JsonResponse(queued[1], status=queued[0])
 
     try:
-        token = get_access_token()
+        token = get_access_token(project)
     except Exception as e:
         return JsonResponse({'error':'failed to get access token', 'detail':str(e)}, status=500)
 
-    headers = make_headers(token)  # 若沒有 make_headers()，改成你定義的 _ls_headers(token)
-    result_blocks = _build_result_blocks(rating, relation)
-
+    # 先查本地索引，有就直接 PATCH；沒有才打上游找
+    indexed_id = annotation_index.lookup(project.project_id, fields["task_id"])
     try:
-        # 先找是否已有 annotation
-        ann_id = _find_annotation_id(task_id, PROJECT_ID, token)
-
-        if ann_id:
-            body = {
-                "lead_time": float(payload.get("lead_time") or 0.0),
-                "result": result_blocks,
-                "draft_id": 0,
-                "parent_prediction": None,
-                "parent_annotation": None,
-                "started_at": _iso_utc_now(),
-            }
-            resp = requests.patch(
-                _ls(f"annotations/{ann_id}/"),  # ← 有 /api 與尾斜線
-                headers=headers,
-                params={"taskID": task_id, "project": PROJECT_ID},
-                json=body,
-                timeout=30
-            )
-            action = "patch"
-        else:
-            body = {
-                "task": task_id,                                # ← 新建時 body 需要 task
-                "project": PROJECT_ID,
-                "lead_time": float(payload.get("lead_time") or 0.0),
-                "result": result_blocks,
-                "draft_id": 0,
-                "parent_prediction": None,
-                "parent_annotation": None,
-                "started_at": _iso_utc_now(),
-            }
-            resp = requests.post(
-                _ls("annotations/"),  # ← 有 /api 與尾斜線
-                headers=headers,
-                json=body,  # body 內含 "task": task_id
-                timeout=30
-            )
-            action = "create"
+        resp, action, ann_id = send_edit(project, token, fields, indexed_id)
     except requests.RequestException as e:
         return JsonResponse({'error': 'request to LS failed', 'detail': str(e)}, status=502)
 
-    # 統一錯誤處理（若 LS 回 HTML，就不要整頁丟回前端）
-    if not resp.ok:
-        ctype = (resp.headers.get('content-type') or '').lower()
-        detail = resp.json() if 'application/json' in ctype else resp.text[:800]
-        return JsonResponse(
-            {"error": "LS API error",
-             "status": resp.status_code,
-             "url": resp.url,
-             "detail": detail},
-            status=resp.status_code
-        )
+    status, body = finish_edit(project, resp, action, ann_id, fields, indexed_id)
+    return JsonResponse(body, status=status)
 
-    # ✅ 成功回傳（注意：這段要放在上面 if 之外）
-    ctype = (resp.headers.get('content-type') or '').lower()
-    out = resp.json() if 'application/json' in ctype else {"raw": resp.text}
-    ann_id_final = (out.get("id") if isinstance(out, dict) else None) or ann_id
+@csrf_exempt
+@projects.scoped
+def edit_bulk(request, project):
+    """一次改多筆：整批先驗證，再用 thread pool 平行查 / 寫，回傳每一列的結果"""
+    payload, err = read_edit_body(request)
+    if err:
+        return err
+    rows, err = parse_bulk_edit(payload)
+    if err:
+        return err
 
-    return JsonResponse({
-        "ok": True,
-        "action": action,
-        "annotation_id": ann_id_final,
-        "task_id": task_id,
-        "inner_id": inner_id,
-        "rating": rating,
-        "relation": relation,
-        "ls_response": out,
-    }, status=200)
+    try:
+        token = get_access_token(project)
+    except Exception as e:
+        return JsonResponse({'error':'failed to get access token', 'detail':str(e)}, status=500)
+    return bulk_response(apply_edits(project, token, rows))
+
+def apply_edits(project, token, rows):
+    """一批已驗證的修改（task_id 不重複）：有 annotation 就 PATCH、沒有就新建；回傳每一列的 bulk_row
 
+    edit_bulk 與 manage.py import_labels 共用。
+    """
+    queued = queued_edits(project, rows)
+    indexed = annotation_index.lookup_many(project.project_id, [f["task_id"] for f in rows])
+
+    def _send(fields):
+        if queued[fields["task_id"]] is not None:
+            return None, None
+        try:
+            return send_edit(project, token, fields, indexed.get(fields["task_id"])), None
+        except requests.RequestException as e:
+            return None, str(e)
+
+    # 網路在 thread pool 裡平行跑，本地寫回集中在這個 thread（SQLite 比較不會 lock）
+    with ThreadPoolExecutor(max_workers=project.pool_size) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, _send, fields) for fields in rows]
+        sent = [fut.result() for fut in futures]
+
+    results = []
+    for fields, (out, error) in zip(rows, sent):
+        if queued[fields["task_id"]] is not None:
+            results.append(bulk_row(fields, *queued[fields["task_id"]]))
+            continue
+        if error is not None:
+            results.append(bulk_row(fields, 502, {'error': 'request to LS failed', 'detail': error}))
+            continue
+        status, body = finish_edit(project, *out, fields, indexed.get(fields["task_id"]))
+        results.append(bulk_row(fields, status, body))
+    return results